@@ -0,0 +1,211 @@
+"""Batch API mode for catching up on a backlog of unread messages.
+
+After downtime the inbox can hold hundreds of unread emails. Drafts are
+never sent automatically, so instead of one synchronous gpt-4o call per
+message the requests are written to a JSONL file, submitted through the
+OpenAI Batch API (half the price, separate rate limits) and the drafts are
+created in bulk once the batch completes, usually well within the 24h
+completion window.
+
+Submitted batches are recorded in a state file under CACHE_DIR, so a
+restart resumes polling them instead of losing or resubmitting the work.
+Their messages are 'batched' in the work queue meanwhile, so the
+synchronous path leaves them alone. Messages the batch could not answer
+fall back to the synchronous path.
+"""
+import os
+import json
+import time
+import datetime
+
+from models import EmailMessage
+from work_queue import BATCHED, DRAFTED, FETCHED, GENERATED
+from transport import CACHE_DIR, read_cache, write_cache
+from metrics import API_CALLS, MESSAGES, TIME_TO_DRAFT_SECONDS, record_usage, timed
+
+# A poll with at least this many new messages goes through the Batch API
+# (0 disables the automatic switch; --backlog still works)
+BACKLOG_THRESHOLD = int(os.getenv('BACKLOG_THRESHOLD', '0'))
+# Seconds between status checks in wait()
+BATCH_POLL_SECONDS = float(os.getenv('BATCH_POLL_SECONDS', '30'))
+BATCH_DIR = os.path.join(CACHE_DIR, 'batches')
+ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+# Batch API limit on requests per input file
+MAX_BATCH_REQUESTS = 50000
+
+FINISHED = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def batch_line(custom_id, request):
+    """One line of a Batch API input file"""
+    return json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': ENDPOINT,
+                       'body': request}, ensure_ascii=False)
+
+
+def parse_results(content):
+    """Map custom_id -> ChatCompletion for the successful lines of an output file"""
+    from openai.types.chat import ChatCompletion
+
+    results = {}
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get('response') or {}
+        if item.get('error') or response.get('status_code') != 200:
+            continue
+        results[item['custom_id']] = ChatCompletion.model_validate(response['body'])
+    return results
+
+
+class BacklogBatcher:
+    """Submits replies for many messages as one batch and drafts the results.
+
+    submit() is cheap and returns immediately; collect() checks the pending
+    batches once and drafts the replies of those that have finished, so it
+    can run at the start of every poll. wait() blocks until none are left.
+    """
+
+    def __init__(self, auto_reply, batch_dir=BATCH_DIR):
+        self.auto_reply = auto_reply
+        self.batch_dir = batch_dir
+        self.log = auto_reply.log
+        slug = ''.join(c if c.isalnum() else '_' for c in str(auto_reply.name))
+        self.state_path = os.path.join(batch_dir, f'{slug}.json')
+        self.pending = read_cache(self.state_path) or []
+        # Messages still waiting in a batch from before a restart are not new
+        for entry in self.pending:
+            auto_reply.processed_message_ids.update(entry['messages'])
+
+    @property
+    def client(self):
+        return self.auto_reply.openai_client
+
+    def _save(self):
+        write_cache(self.state_path, self.pending)
+
+    def submit(self, messages):
+        """Build the reply requests for messages and submit them as batches"""
+        auto_reply = self.auto_reply
+        wanted = []
+        for msg in messages:
+            if auto_reply.is_blocked_sender(auto_reply.extract_email_address(msg.sender)):
+                MESSAGES.inc(outcome='blocked')
+                continue
+            wanted.append(msg)
+        auto_reply.work_queue.enqueue(auto_reply.name, wanted)
+
+        def build(msg):
+            try:
+                return msg, auto_reply.build_reply_request(msg)
+            except Exception as error:
+                self.log.error("batch_request_failed", message_id=msg.id, error=str(error))
+                return msg, None
+
+        with timed('batch_build'):
+            built = self.auto_reply.parallel_map(build, wanted)
+        # Whatever could not be prepared goes the synchronous way right away
+        for msg, request in built:
+            if request is None:
+                auto_reply.process_message(msg)
+        built = [(msg, request) for msg, request in built if request is not None]
+
+        for start in range(0, len(built), MAX_BATCH_REQUESTS):
+            self._submit_chunk(built[start:start + MAX_BATCH_REQUESTS])
+
+    def _submit_chunk(self, built):
+        if not built:
+            return
+        os.makedirs(self.batch_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        input_path = os.path.join(self.batch_dir, f'{os.path.basename(self.state_path)[:-5]}-{stamp}.jsonl')
+        with open(input_path, 'w', encoding='utf-8') as f:
+            for msg, request in built:
+                f.write(batch_line(msg.id, request) + '\n')
+
+        with timed('batch_submit'):
+            API_CALLS.inc(service='openai', method='files.create')
+            with open(input_path, 'rb') as f:
+                upload = self.client.files.create(file=f, purpose='batch')
+            API_CALLS.inc(service='openai', method='batches.create')
+            batch = self.client.batches.create(
+                input_file_id=upload.id, endpoint=ENDPOINT,
+                completion_window=COMPLETION_WINDOW,
+                metadata={'mailbox': str(self.auto_reply.name)})
+
+        self.pending.append({'batch_id': batch.id, 'input_path': input_path,
+                             'messages': {msg.id: msg.to_state() for msg, _ in built}})
+        self._save()
+        # Only now: a crash before this point leaves them to the synchronous path
+        self.auto_reply.work_queue.mark(self.auto_reply.name, [msg.id for msg, _ in built], BATCHED)
+        self.log.info("batch_submitted", batch_id=batch.id, requests=len(built))
+
+    def _download(self, file_id):
+        if not file_id:
+            return ''
+        API_CALLS.inc(service='openai', method='files.content')
+        return self.client.files.content(file_id).text
+
+    def collect(self):
+        """Draft the replies of every finished batch; returns how many were drafted"""
+        drafted = 0
+        for entry in list(self.pending):
+            try:
+                API_CALLS.inc(service='openai', method='batches.retrieve')
+                batch = self.client.batches.retrieve(entry['batch_id'])
+                if batch.status not in FINISHED:
+                    continue
+                # Expired and cancelled batches still return what they finished
+                results = parse_results(self._download(batch.output_file_id))
+            except Exception as error:
+                # Checked again on the next poll
+                self.log.warning("batch_check_failed", batch_id=entry['batch_id'], error=str(error))
+                continue
+            self.log.info("batch_finished", batch_id=batch.id, status=batch.status,
+                          completed=len(results), requests=len(entry['messages']))
+            drafted += self._draft_all(entry['messages'], results)
+            self.pending.remove(entry)
+            self._save()
+            try:
+                os.remove(entry['input_path'])
+            except OSError:
+                pass
+        return drafted
+
+    def _draft_all(self, messages, results):
+        auto_reply = self.auto_reply
+
+        def draft(msg):
+            completion = results.get(msg.id)
+            queue = auto_reply.work_queue
+            if completion is None:
+                # Not answered by the batch: generate it synchronously instead
+                self.log.warning("batch_item_missing", message_id=msg.id)
+                queue.mark(auto_reply.name, [msg.id], FETCHED)
+                auto_reply.process_message(msg)
+                return False
+            record_usage(completion.usage)
+            reply = completion.choices[0].message.content.strip()
+            if not auto_reply.create_draft_reply(msg, reply):
+                # The queue retries the draft with this reply
+                queue.mark(auto_reply.name, [msg.id], GENERATED, reply)
+                MESSAGES.inc(outcome='failed')
+                return False
+            queue.mark(auto_reply.name, [msg.id], DRAFTED)
+            MESSAGES.inc(outcome='drafted')
+            if msg.internal_date:
+                TIME_TO_DRAFT_SECONDS.observe(time.time() - msg.internal_date / 1000)
+            return True
+
+        with timed('batch_drafts'):
+            return sum(self.auto_reply.parallel_map(draft, [EmailMessage.from_state(state)
+                                         for state in messages.values()]))
+
+    def wait(self, poll_seconds=BATCH_POLL_SECONDS):
+        """Collect until every pending batch is done; returns how many were drafted"""
+        drafted = self.collect()
+        while self.pending:
+            time.sleep(poll_seconds)
+            drafted += self.collect()
+        return drafted
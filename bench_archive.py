@@ -0,0 +1,92 @@
+"""Benchmark for compressed archive bodies (body_codec.py).
+
+Builds archive documents the way mongodb.py does, one per message with
+the whole thread as context, from stand-in threads: a customer message,
+our signed reply and --follow-ups more messages, each quoting the one
+before as mail clients do. The documents are encoded with bodies stored
+as text, zstd-compressed, and zstd-compressed with a dictionary trained on
+a --train share of the bodies, then:
+
+- storage: BSON bytes of all documents, as MongoDB stores them;
+- read: documents/s decoding the BSON and reading the two bodies the
+  indexer reads (lazy_document), and reading every body.
+
+Usage: python bench_archive.py [--threads 2000] [--follow-ups 3] [--train 0.2] [--level 9]
+"""
+import time
+import random
+import argparse
+import datetime
+
+import bson
+
+from standins import OWN_ADDRESS, Mailbox
+from models import EmailThread
+from body_codec import BodyCodec, encode_document, lazy_document
+
+
+def make_documents(thread_count, follow_ups, seed=0):
+    mailbox = Mailbox(seed=seed)
+    mailbox.seed_history(thread_count)
+    rng = random.Random(seed)
+    for thread_id, ids in list(mailbox.threads.items()):
+        for n in range(follow_ups):
+            previous = mailbox.messages[mailbox.threads[thread_id][-1]]
+            quoted = EmailThread.from_gmail({'id': thread_id, 'messages': [previous]})[0].body
+            ours = n % 2
+            mailbox.add_message(
+                thread_id, f"Fast Book Ads <{OWN_ADDRESS}>" if ours else f"Customer <c{thread_id}@example.com>",
+                'customer@example.com' if ours else OWN_ADDRESS, 'Re: Domanda', mailbox._body(rng.randint(1, 2))
+                + '\n\nOn Mon, 3 Mar 2025 wrote:\n' + '\n'.join('> ' + line for line in quoted.splitlines()),
+                ['SENT'] if ours else ['INBOX'])
+    stored_at = datetime.datetime.utcnow()
+    documents = []
+    for thread_id, ids in mailbox.threads.items():
+        thread = EmailThread.from_gmail({'id': thread_id, 'messages': [mailbox.messages[i] for i in ids]})
+        documents.extend(message.to_document(thread, stored_at=stored_at) for message in thread)
+    return documents
+
+
+def read(encoded, codec, every_body):
+    start = time.perf_counter()
+    characters = 0
+    for data in encoded:
+        document = lazy_document(bson.decode(data), codec)
+        messages = document['thread_context']['messages']
+        for entry in (messages if every_body else messages[:2]):
+            characters += len(entry.get('body') or '')
+    return len(encoded) / (time.perf_counter() - start), characters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compressed archive bodies benchmark")
+    parser.add_argument('--threads', type=int, default=2000)
+    parser.add_argument('--follow-ups', type=int, default=3)
+    parser.add_argument('--train', type=float, default=0.2, help="share of the bodies to train on")
+    parser.add_argument('--level', type=int, default=9)
+    args = parser.parse_args()
+
+    documents = make_documents(args.threads, args.follow_ups)
+    bodies = [document['body'] for document in documents]
+    trained = BodyCodec(level=args.level)
+    trained.train(random.Random(1).sample(bodies, max(1, int(len(bodies) * args.train))))
+    encodings = [('text', None), ('zstd', BodyCodec(level=args.level)), ('zstd+dict', trained)]
+    print(f"{len(documents)} documents, {args.threads} threads of {2 + args.follow_ups} messages, "
+          f"{sum(len(body) for body in bodies) / len(bodies):.0f} characters per body")
+    print(f"{'encoding':<10} {'storage':>9} {'ratio':>6} {'encode/s':>9} {'read 2/s':>9} {'read all/s':>11}")
+
+    baseline = None
+    for name, codec in encodings:
+        start = time.perf_counter()
+        encoded = [bson.encode(encode_document(document, codec)) for document in documents]
+        encode_rate = len(documents) / (time.perf_counter() - start)
+        size = sum(len(data) for data in encoded)
+        baseline = baseline or size
+        pairs_rate, _ = read(encoded, codec or BodyCodec(), every_body=False)
+        all_rate, _ = read(encoded, codec or BodyCodec(), every_body=True)
+        print(f"{name:<10} {size / 2 ** 20:7.1f}MB {baseline / size:5.2f}x {encode_rate:9.0f} "
+              f"{pairs_rate:9.0f} {all_rate:11.0f}")
+
+
+if __name__ == '__main__':
+    main()
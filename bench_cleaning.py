@@ -0,0 +1,89 @@
+"""Corpus benchmark for email body cleaning.
+
+Runs the two cleaners the project used to have and cleaning.clean_body over
+the bodies in message_data.txt (chunks separated by two blank lines: a new
+message followed by its quoted history) and reports, for each:
+
+- time per body,
+- characters kept, with an estimate of the tokens that would be embedded
+  and sent to the LLM (~4 characters per token),
+- how many bodies still contain a reply header, the Customer Success
+  Assistant signature or a tracking link.
+
+Usage: python bench_cleaning.py [--corpus message_data.txt] [--repeat 20]
+"""
+import re
+import time
+import argparse
+
+from cleaning import clean_body
+
+RESIDUE = {
+    'reply header': re.compile(r'ha scritto:|wrote:', re.IGNORECASE),
+    'signature': re.compile(r'Customer Success Assistant'),
+    'tracking link': re.compile(r'bit\.ly|mail-sig'),
+}
+
+
+def legacy_auto_reply(body):
+    """GmailAutoReply.clean_email_body before the cleaning engine"""
+    cleaned_lines = []
+    for line in body.split('\n'):
+        if line.strip().startswith('>'):
+            break
+        if 'From:' in line and 'To:' in line:
+            break
+        cleaned_lines.append(line)
+    return '\n'.join(cleaned_lines).strip()
+
+
+def legacy_indexer(body_text):
+    """vector_search.clean_reply_body before the cleaning engine"""
+    match = re.compile(r"On.*wrote:", re.IGNORECASE).search(body_text)
+    if match:
+        body_text = body_text[:match.start()]
+    match = re.compile(r"---.*Original Message.*---", re.IGNORECASE).search(body_text)
+    if match:
+        body_text = body_text[:match.start()]
+    cleaned_lines = [line for line in body_text.split('\n') if not line.strip().startswith('>')]
+    return "\n".join(cleaned_lines).strip()
+
+
+def load_bodies(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    return [chunk for chunk in text.split('\n\n\n') if chunk.strip()]
+
+
+def measure(function, bodies, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [function(body) for body in bodies]
+        best = min(best, time.perf_counter() - start)
+    return best / len(bodies) * 1e6, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Email body cleaning benchmark")
+    parser.add_argument('--corpus', default='message_data.txt')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    bodies = load_bodies(args.corpus)
+    raw_chars = sum(len(body) for body in bodies)
+    print(f"{len(bodies)} bodies, {raw_chars} characters (~{raw_chars // 4} tokens)")
+    print(f"{'cleaner':<22} {'us/body':>8} {'chars':>7} {'~tokens':>8}  bodies still containing")
+
+    for name, function in (('auto-reply (old)', legacy_auto_reply),
+                           ('indexer (old)', legacy_indexer),
+                           ('cleaning.clean_body', clean_body)):
+        micros, outputs = measure(function, bodies, args.repeat)
+        chars = sum(len(output) for output in outputs)
+        residue = ', '.join(f"{label} {sum(1 for output in outputs if pattern.search(output))}"
+                            for label, pattern in RESIDUE.items())
+        print(f"{name:<22} {micros:8.1f} {chars:7d} {chars // 4:8d}  {residue}")
+
+
+if __name__ == '__main__':
+    main()
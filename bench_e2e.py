@@ -0,0 +1,230 @@
+"""Offline end-to-end benchmark for the auto-reply pipeline and the indexing job.
+
+Starts the Gmail and OpenAI stand-in servers and the Pinecone stand-in from
+standins.py and then runs these phases:
+
+1. ingest: vector_search.find_first_conversation_with_reply over a seeded
+   history of answered threads.
+2. replay: synthetic customer messages delivered in rounds, each round
+   driven through GmailAutoReply.get_new_messages -> process_new_messages
+   -> create_draft_reply. With --error-rate, the replies that failed are
+   retried by further polls until the work queue is empty.
+3. backlog (with --backlog): the same number of messages delivered at once
+   and drafted through the Batch API mode in backlog.py.
+
+It reports throughput, p50/p99 per-message latency and the calls each
+stand-in received. Results are reproducible for a given --seed.
+
+Usage: python bench_e2e.py [--messages 200] [--latency-ms 20] [--error-rate 0.0]
+                           [--follow-up-ratio 0.0] [--workers 1] [--history 100] [--backlog] [--json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import statistics
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('OPENAI_API_KEY', 'standin')
+os.environ['METRICS_PORT'] = '0'
+# Retry failed replies within the run rather than after 30 s
+os.environ.setdefault('QUEUE_RETRY_BASE_SECONDS', '0.05')
+
+from standins import Faults, Mailbox, GmailStandin, OpenAIStandin, PineconeStandin, gmail_service
+from transport import TransportConfig, build_openai_http_client
+from metrics import configure_logging
+
+# Gmail lists at most this many unread messages per poll
+ROUND_SIZE = 50
+# Extra polls after the last round, while failed work is being retried
+MAX_SETTLE_POLLS = 50
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def make_standins(args):
+    def faults(offset):
+        return Faults(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                      error_rate=args.error_rate, seed=args.seed + offset)
+
+    mailbox = Mailbox(seed=args.seed, bulk_ratio=args.bulk_ratio,
+                      follow_up_ratio=args.follow_up_ratio)
+    gmail = GmailStandin(mailbox, faults(1)).start()
+    openai_standin = OpenAIStandin(faults(2)).start()
+    pinecone = PineconeStandin(faults(3))
+    return mailbox, gmail, openai_standin, pinecone
+
+
+def run_ingest(args, mailbox, gmail, pinecone):
+    import vector_search
+    from gmail_auto_response import INDEX_NAME
+
+    mailbox.seed_history(args.history)
+    service = gmail_service(gmail.url)
+    index = pinecone.Index(INDEX_NAME)
+    error = None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            vector_search.find_first_conversation_with_reply(service, pinecone, index)
+    except Exception as exc:
+        # The job has no retries; with injected errors it may stop early
+        error = repr(exc)
+    elapsed = time.perf_counter() - start
+    return {'threads': args.history, 'seconds': elapsed,
+            'threads_per_second': args.history / elapsed if elapsed else 0.0,
+            'indexed': len(index.vectors), 'error': error}
+
+
+def make_auto_reply(args, gmail, openai_standin, pinecone, name=None):
+    import tempfile
+    from openai import OpenAI
+    from gmail_auto_response import GmailAutoReply, INDEX_NAME
+    from work_queue import WorkQueue
+
+    transport = TransportConfig()
+    openai_client = OpenAI(api_key='standin', base_url=openai_standin.url + 'v1',
+                           http_client=build_openai_http_client(transport))
+    auto_reply = GmailAutoReply(name=name, openai_client=openai_client, pc=pinecone,
+                                index=pinecone.Index(INDEX_NAME), max_workers=args.workers,
+                                transport=transport, backlog_threshold=0,
+                                # The stand-in's message ids repeat from run to run
+                                work_queue=WorkQueue(os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')))
+    auto_reply.service = gmail_service(gmail.url)
+    return auto_reply
+
+
+def run_replay(args, mailbox, gmail, openai_standin, pinecone):
+    auto_reply = make_auto_reply(args, gmail, openai_standin, pinecone)
+
+    latencies = []
+    process_message = auto_reply.process_message
+
+    def timed_process_message(msg):
+        start = time.perf_counter()
+        process_message(msg)
+        latencies.append(time.perf_counter() - start)
+
+    auto_reply.process_message = timed_process_message
+
+    drafts_before = len(mailbox.drafts)
+    remaining = args.messages
+    start = time.perf_counter()
+    while remaining > 0:
+        batch = min(ROUND_SIZE, remaining)
+        mailbox.deliver(batch)
+        auto_reply.poll_once()
+        remaining -= batch
+    # Failed fetches are listed again and failed replies retried by later polls
+    for _ in range(MAX_SETTLE_POLLS):
+        counts = auto_reply.work_queue.counts(auto_reply.name)
+        if not counts.get('fetched') and not counts.get('generated') and \
+                len(mailbox.drafts) - drafts_before + counts['dead'] >= args.messages:
+            break
+        time.sleep(0.1)
+        auto_reply.poll_once()
+    elapsed = time.perf_counter() - start
+
+    return {'messages': args.messages, 'seconds': elapsed,
+            'messages_per_second': args.messages / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'mean_ms': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+            'processed': len(latencies),
+            'drafts': len(mailbox.drafts) - drafts_before,
+            'dead_letters': auto_reply.work_queue.counts(auto_reply.name)['dead']}
+
+
+def run_backlog(args, mailbox, gmail, openai_standin, pinecone):
+    import tempfile
+    from backlog import BacklogBatcher
+
+    auto_reply = make_auto_reply(args, gmail, openai_standin, pinecone, name='bench-backlog')
+    # Only the backlog should be listed, not the replay's messages
+    for message in mailbox.messages.values():
+        auto_reply.processed_message_ids.add(message['id'])
+    auto_reply._backlog = BacklogBatcher(auto_reply, batch_dir=tempfile.mkdtemp())
+
+    drafts_before = len(mailbox.drafts)
+    mailbox.deliver(args.messages)
+    start = time.perf_counter()
+    messages = auto_reply.get_new_messages(all_pages=True)
+    auto_reply.backlog.submit(messages)
+    submitted = time.perf_counter() - start
+    auto_reply.backlog.wait(poll_seconds=0.05)
+    elapsed = time.perf_counter() - start
+    return {'messages': len(messages), 'seconds': elapsed, 'submit_seconds': submitted,
+            'messages_per_second': len(messages) / elapsed if elapsed else 0.0,
+            'drafts': len(mailbox.drafts) - drafts_before}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark")
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--history', type=int, default=100,
+                        help="answered threads to seed for the indexing phase")
+    parser.add_argument('--latency-ms', type=float, default=20.0,
+                        help="latency injected into every stand-in call")
+    parser.add_argument('--jitter-ms', type=float, default=5.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--bulk-ratio', type=float, default=0.0,
+                        help="share of delivered messages that are newsletters")
+    parser.add_argument('--follow-up-ratio', type=float, default=0.0,
+                        help="share of delivered messages sent into a recent customer thread")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backlog', action='store_true',
+                        help="also draft --messages at once through the Batch API mode")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    configure_logging('CRITICAL')
+    mailbox, gmail, openai_standin, pinecone = make_standins(args)
+    results = {
+        'config': vars(args),
+        'ingest': run_ingest(args, mailbox, gmail, pinecone),
+        'replay': run_replay(args, mailbox, gmail, openai_standin, pinecone),
+    }
+    if args.backlog:
+        results['backlog'] = run_backlog(args, mailbox, gmail, openai_standin, pinecone)
+    results['calls'] = {
+        'gmail': dict(gmail.calls),
+        'openai': dict(openai_standin.calls),
+        'pinecone': dict(pinecone.calls),
+    }
+    results['openai_tokens'] = dict(openai_standin.tokens)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    ingest, replay = results['ingest'], results['replay']
+    print(f"ingest  {ingest['threads']} threads in {ingest['seconds']:.2f}s "
+          f"({ingest['threads_per_second']:.1f}/s), {ingest['indexed']} vectors"
+          + (f", stopped by {ingest['error']}" if ingest['error'] else ""))
+    print(f"replay  {replay['messages']} messages in {replay['seconds']:.2f}s "
+          f"({replay['messages_per_second']:.1f}/s), {replay['drafts']} drafts"
+          + (f", {replay['dead_letters']} dead letters" if replay['dead_letters'] else ""))
+    print(f"        latency p50 {replay['p50_ms']:.1f} ms  p99 {replay['p99_ms']:.1f} ms  "
+          f"mean {replay['mean_ms']:.1f} ms")
+    if 'backlog' in results:
+        backlog = results['backlog']
+        print(f"backlog {backlog['messages']} messages in {backlog['seconds']:.2f}s "
+              f"({backlog['messages_per_second']:.1f}/s, submitted in "
+              f"{backlog['submit_seconds']:.2f}s), {backlog['drafts']} drafts")
+    for service, calls in results['calls'].items():
+        print(f"calls   {service:<8} total {sum(calls.values()):>6}  "
+              + ", ".join(f"{route}={count}" for route, count in sorted(calls.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Micro-benchmark for header extraction from Gmail thread payloads.
+
+Builds threads shaped like real threads.get(format='full') responses, with
+the Received / DKIM / ARC trace headers that make up most of a delivered
+message's header list, and compares the per-header next(...) scans the
+code used to do with headers.MessageHeaders, which reads the list once.
+
+Usage: python bench_headers.py [--threads 200] [--messages 8] [--trace 40] [--repeat 5]
+"""
+import time
+import random
+import argparse
+import statistics
+
+from headers import MessageHeaders, header_map
+
+ENCODED_SUBJECT = '=?UTF-8?Q?Re:_Informazioni_sulla_campagna_pubblicitaria_=E2=9C=A8?='
+
+
+def make_message(rng, n, trace, subject):
+    headers = [{'name': name, 'value': f"from mx{rng.randrange(100)}.google.com by {n}"}
+               for name in ('Received', 'X-Received', 'ARC-Seal', 'ARC-Message-Signature',
+                            'ARC-Authentication-Results', 'DKIM-Signature', 'X-Google-Smtp-Source')
+               for _ in range(max(1, trace // 7))]
+    headers += [
+        {'name': 'MIME-Version', 'value': '1.0'},
+        {'name': 'From', 'value': f"Cliente {n} <cliente{n}@example.com>"},
+        {'name': 'Date', 'value': 'Mon, 3 Mar 2025 10:%02d:00 +0100' % (n % 60)},
+        {'name': 'Message-ID', 'value': f"<{n}@mail.example.com>"},
+        {'name': 'Subject', 'value': subject},
+        {'name': 'To', 'value': 'info@fastbookads.com'},
+        {'name': 'Content-Type', 'value': 'multipart/alternative; boundary="000"'},
+    ]
+    # Header order varies between senders
+    rng.shuffle(headers)
+    return {'id': str(n), 'payload': {'headers': headers}}
+
+
+def scan_case_sensitive(message):
+    """What get_new_messages / get_thread_history did"""
+    headers = message['payload'].get('headers', [])
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
+    sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
+    date = next((h['value'] for h in headers if h['name'] == 'Date'), 'Unknown Date')
+    message_id = next((h['value'] for h in headers if h['name'] == 'Message-ID'), '')
+    return subject, sender, date, message_id
+
+
+def scan_lowercase(message):
+    """What GmailMongoDB.get_email_content did"""
+    headers = message['payload']['headers']
+    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
+    sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown Sender')
+    to = next((h['value'] for h in headers if h['name'].lower() == 'to'), 'Unknown Recipient')
+    date = next((h['value'] for h in headers if h['name'].lower() == 'date'), None)
+    return subject, sender, to, date
+
+
+def single_pass(message):
+    return header_map(message['payload']['headers'])
+
+
+def parsed(message):
+    return MessageHeaders.from_message(message)
+
+
+def measure(function, messages, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            function(message)
+        runs.append(time.perf_counter() - start)
+    return min(runs) / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Header extraction micro-benchmark")
+    parser.add_argument('--threads', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=8, help="messages per thread")
+    parser.add_argument('--trace', type=int, default=40, help="trace headers per message")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    # Half the threads have an RFC 2047 encoded subject, repeated by every reply
+    messages = [make_message(rng, t * args.messages + m, args.trace,
+                             ENCODED_SUBJECT.replace('campagna', f'campagna_{t}') if t % 2
+                             else f"Domanda {t}")
+                for t in range(args.threads) for m in range(args.messages)]
+    headers_per_message = statistics.fmean(len(m['payload']['headers']) for m in messages)
+    print(f"{len(messages)} messages, {headers_per_message:.0f} headers each")
+
+    baseline = None
+    for name, function in (('next() scans, case-sensitive', scan_case_sensitive),
+                           ('next() scans, .lower()', scan_lowercase),
+                           ('header_map (one pass)', single_pass),
+                           ('MessageHeaders (+RFC 2047)', parsed)):
+        micros = measure(function, messages, args.repeat)
+        baseline = baseline or micros
+        print(f"{name:<32} {micros:8.2f} us/message  {baseline / micros:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
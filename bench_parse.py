@@ -0,0 +1,77 @@
+"""Benchmark for the fetch/parse pipeline used by the indexing backfill.
+
+Builds answered threads with the stand-in mailbox (half of them HTML-only,
+so BeautifulSoup is on the path as it is for many real senders), then runs
+vector_search.parse_reply_pair over them:
+
+- sequentially, fetch then parse on one thread, as the backfill used to;
+- through pipeline.fetch_parse with the parsing in-line (--processes 0) and
+  in process pools of 1, 2, 4, ... up to the number of cores.
+
+Fetches sleep for --latency-ms to stand in for the Gmail round trip.
+The speed-up column is relative to the sequential run.
+
+Usage: python bench_parse.py [--threads 400] [--latency-ms 20] [--fetch-workers 8]
+                             [--chunk-size 16]
+"""
+import os
+import copy
+import time
+import argparse
+
+from standins import Mailbox
+from pipeline import fetch_parse
+from vector_search import parse_reply_pair
+
+
+def make_threads(count):
+    mailbox = Mailbox(seed=0)
+    mailbox.seed_history(count)
+    threads = []
+    for n, (thread_id, ids) in enumerate(mailbox.threads.items()):
+        messages = [copy.deepcopy(mailbox.messages[i]) for i in ids]
+        if n % 2:
+            for message in messages:
+                payload = message['payload']
+                payload['parts'] = [part for part in payload['parts'] if part['mimeType'] == 'text/html']
+        threads.append({'id': thread_id, 'messages': messages})
+    return threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch/parse pipeline benchmark")
+    parser.add_argument('--threads', type=int, default=400)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=16)
+    args = parser.parse_args()
+
+    resources = {thread['id']: thread for thread in make_threads(args.threads)}
+    ids = list(resources)
+    latency = args.latency_ms / 1000
+
+    def fetch(thread_id):
+        time.sleep(latency)
+        return resources[thread_id]
+
+    cores = os.cpu_count() or 1
+    print(f"{len(ids)} threads, {args.latency_ms:.0f} ms per fetch, {cores} cores")
+
+    start = time.perf_counter()
+    expected = [parse_reply_pair(fetch(thread_id)) for thread_id in ids]
+    baseline = time.perf_counter() - start
+    print(f"{'sequential':<22} {baseline:7.2f}s  {len(ids) / baseline:7.1f} threads/s   1.00x")
+
+    processes = [0] + [n for n in (1, 2, 4, 8, 16, 32, 64) if n < cores] + [cores]
+    for count in sorted(set(processes)):
+        start = time.perf_counter()
+        results = list(fetch_parse(ids, fetch, parse_reply_pair, fetch_workers=args.fetch_workers,
+                                   processes=count, chunk_size=args.chunk_size))
+        elapsed = time.perf_counter() - start
+        assert results == expected
+        label = 'pipeline, in-line' if count == 0 else f"pipeline, {count} process{'es' if count > 1 else ''}"
+        print(f"{label:<22} {elapsed:7.2f}s  {len(ids) / elapsed:7.1f} threads/s  {baseline / elapsed:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
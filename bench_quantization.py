@@ -0,0 +1,89 @@
+"""Benchmark for the quantized local index (local_vectors.py).
+
+Builds a corpus of unit vectors (clustered, like embeddings of similar
+emails, or loaded from a corpus snapshot with --snapshot), takes queries
+near random corpus vectors, and compares LocalIndex.query with each storage
+format against exact float32 dot products:
+
+- recall@1: how often the best match is the exact best match;
+- memory: bytes held by the in-process matrix;
+- ms/query, without re-scoring (the quantized scores decide) and with the
+  candidates re-scored against the float32 originals memory-mapped from disk.
+
+Usage: python bench_quantization.py [--vectors 20000] [--queries 200] [--clusters 500]
+                                    [--spread 0.03] [--snapshot DIR]
+"""
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from local_vectors import DTYPES, RESCORE_FACTOR, LocalIndex, QuantizedVectors
+
+
+def make_vectors(centers, count, rng, noise):
+    """count unit vectors around randomly chosen centers"""
+    vectors = centers[rng.integers(len(centers), size=count)]
+    vectors = vectors + noise * rng.standard_normal(vectors.shape, dtype=np.float32)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def make_queries(corpus, count, spread, seed=1):
+    """New emails: vectors around random corpus vectors, as far from them as
+    the other members of their cluster are"""
+    rng = np.random.default_rng(seed)
+    return make_vectors(corpus, count, rng, spread / np.sqrt(corpus.shape[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantized local index benchmark")
+    parser.add_argument('--vectors', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--clusters', type=int, default=500)
+    parser.add_argument('--spread', type=float, default=0.03,
+                        help="cluster noise relative to a random unit vector: small values make "
+                             "near-duplicate replies, whose scores differ in the third decimal")
+    parser.add_argument('--snapshot', help="corpus_snapshot.py export made with --embed")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        from corpus_snapshot import load_embeddings
+
+        _, corpus = load_embeddings(args.snapshot)
+        corpus = np.array(corpus)
+    else:
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((args.clusters, 1024), dtype=np.float32) / np.sqrt(1024)
+        corpus = make_vectors(centers, args.vectors, rng, args.spread / np.sqrt(1024))
+    queries = make_queries(corpus, args.queries, args.spread)
+    scores = np.sort(corpus @ queries.T, axis=0)
+    exact = np.argmax(corpus @ queries.T, axis=0)
+    ids = [str(i) for i in range(len(corpus))]
+    metadata = [{} for _ in ids]
+    print(f"{len(corpus)} vectors x {corpus.shape[1]}, {len(queries)} queries, "
+          f"re-scoring {RESCORE_FACTOR} x top_k, median gap between the two best scores "
+          f"{np.median(scores[-1] - scores[-2]):.4f}")
+    print(f"{'format':<8} {'re-score':<12} {'memory':>9} {'ratio':>6} {'recall@1':>9} {'ms/query':>9}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for dtype in DTYPES:
+            quantized = QuantizedVectors.quantize(corpus, dtype)
+            quantized.originals = corpus
+            quantized.save(directory)
+            modes = [('none', QuantizedVectors(quantized.codes, quantized.scales))]
+            if dtype != 'float32':
+                modes.append(('originals', QuantizedVectors.load(directory)))
+            for mode, vectors in modes:
+                index = LocalIndex(ids, vectors, metadata)
+                start = time.perf_counter()
+                found = [int(index.query(top_k=1, vector=query).matches[0]['id']) for query in queries]
+                elapsed = time.perf_counter() - start
+                recall = float(np.mean(np.asarray(found) == exact))
+                print(f"{dtype:<8} {mode:<12} {vectors.nbytes / 2 ** 20:7.1f}MB "
+                      f"{corpus.nbytes / vectors.nbytes:5.2f}x {recall:9.3f} "
+                      f"{1000 * elapsed / len(queries):9.2f}")
+
+
+if __name__ == '__main__':
+    main()
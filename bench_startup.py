@@ -0,0 +1,65 @@
+"""Startup-time benchmark for GmailAutoReply.
+
+Every run starts a fresh interpreter and times how long it takes to import
+gmail_auto_response, construct GmailAutoReply, authenticate (when a token is
+available) and open the index handle with the cached index metadata.
+
+Usage: python bench_startup.py [--runs 5] [--authenticate]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = r'''
+import json, sys, time
+timings = {}
+start = time.perf_counter()
+import gmail_auto_response
+timings['import'] = time.perf_counter() - start
+
+t = time.perf_counter()
+auto_reply = gmail_auto_response.GmailAutoReply(skip_index_check=True)
+timings['construct'] = time.perf_counter() - t
+
+if sys.argv[1] == '1':
+    t = time.perf_counter()
+    auto_reply.authenticate()
+    timings['authenticate'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    auto_reply.index
+    timings['index'] = time.perf_counter() - t
+
+timings['ready'] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def run_once(authenticate):
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, '1' if authenticate else '0'],
+        check=True, capture_output=True, text=True
+    ).stdout
+    # The last line is the timings; anything above it is the app's own output
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--authenticate', action='store_true',
+                        help="also time authenticate() and the index handle; needs "
+                             "token_client.json and a warm .cache/ from a previous run")
+    args = parser.parse_args()
+
+    runs = [run_once(args.authenticate) for _ in range(args.runs)]
+    print(f"{'stage':<14}{'median ms':>12}{'max ms':>12}")
+    for stage in runs[0]:
+        values = [run[stage] * 1000 for run in runs]
+        print(f"{stage:<14}{statistics.median(values):>12.1f}{max(values):>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
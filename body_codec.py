@@ -0,0 +1,296 @@
+"""Compressed message bodies in the MongoDB archive (zstd, via zstandard).
+
+An archive document stores its message's body, and again every body of
+its thread in thread_context.messages, once per archived message of the
+thread. Plain text, that makes the collection, and the working set the
+indexer scans, several times larger than the mail. encode_document()
+stores each body as BSON binary (subtype BODY_SUBTYPE) holding a zstd
+frame, and leaves out the thread entries' snippets, which are the first
+characters of their bodies. The top-level snippet stays, as a readable
+preview.
+
+zstd compresses a single short email poorly: there is too little text to
+learn from. A dictionary trained on the archive's own bodies holds the
+greetings, signatures and quoted replies they share, and gives several
+times the ratio on short mail:
+
+    python body_codec.py train           # sample the archive, store a dictionary
+    python body_codec.py compress        # re-encode documents stored as text
+
+Dictionaries are stored in the body_dictionaries collection, keyed by the
+id zstd writes into each frame, so any reader finds the one a body needs,
+and bodies compressed with an older dictionary still read after a new one
+is trained. Documents stored as text read as before.
+
+Readers get the documents through lazy_document(), whose bodies are only
+decompressed when read: the indexer reads two bodies per thread and
+never pays for the others. Whether one of our replies is in a body is
+recorded in has_signature when the document is written, as the bodies
+can no longer be searched with $regex. bench_archive.py measures the
+storage and read throughput of each encoding.
+
+zstandard is only needed here and is imported on first use;
+ARCHIVE_BODY_COMPRESSION=none stores text as before.
+"""
+import os
+import argparse
+import datetime
+import threading
+from typing import Dict, Iterable, Optional
+
+from models import SIGNATURE
+from metrics import get_logger
+
+log = get_logger(__name__)
+
+ARCHIVE_BODY_COMPRESSION = os.getenv('ARCHIVE_BODY_COMPRESSION', 'zstd')
+ZSTD_LEVEL = int(os.getenv('ARCHIVE_ZSTD_LEVEL', '9'))
+# 110 KB is zstd's default dictionary size; larger ones barely help mail
+DICTIONARY_SIZE = int(os.getenv('ARCHIVE_DICTIONARY_SIZE', str(110 * 1024)))
+DICTIONARY_SAMPLES = 20000
+# BSON binary subtypes 0x80-0xff are user defined
+BODY_SUBTYPE = 0x80
+# Set on a stored message whose body contains our signature
+SIGNATURE_FIELD = 'has_signature'
+# Set on the documents encoded with a codec, including those whose bodies
+# stayed text (empty, or no smaller compressed), so compress skips them
+ENCODING_FIELD = 'body_encoding'
+
+
+class BodyCodec:
+    """zstd compression of bodies, with the dictionaries of a
+    body_dictionaries collection (or none)"""
+
+    def __init__(self, dictionaries=None, level: int = ZSTD_LEVEL):
+        self.dictionaries = dictionaries
+        self.level = level
+        # dict id -> zstandard.ZstdCompressionDict; 0 is no dictionary
+        self._by_id = {}
+        # The dictionary compress() uses: None until looked up, 0 for none
+        self._active = None
+        self._lock = threading.Lock()
+        # Compressor and decompressor objects are not thread-safe
+        self._local = threading.local()
+
+    @classmethod
+    def for_collection(cls, collection) -> 'BodyCodec':
+        """Codec with the dictionaries stored next to an archive collection"""
+        return cls(collection.database['body_dictionaries'])
+
+    def train(self, bodies: Iterable[str], size: int = DICTIONARY_SIZE) -> int:
+        """Train a dictionary on bodies, store it and compress with it from
+        now on; returns its id"""
+        import zstandard
+        from bson import Binary
+
+        samples = [body.encode('utf-8') for body in bodies if body]
+        dictionary = zstandard.train_dictionary(size, samples, level=self.level)
+        dict_id = dictionary.dict_id()
+        if self.dictionaries is not None:
+            self.dictionaries.replace_one({'_id': dict_id}, {
+                'data': Binary(dictionary.as_bytes()), 'samples': len(samples),
+                'trained_at': datetime.datetime.utcnow()}, upsert=True)
+        log.info("body_dictionary_trained", dict_id=dict_id, samples=len(samples),
+                 kilobytes=round(len(dictionary.as_bytes()) / 1024, 1))
+        self.use(dictionary)
+        return dict_id
+
+    def use(self, dictionary):
+        """Compress with dictionary (a zstandard.ZstdCompressionDict) from now on"""
+        with self._lock:
+            self._by_id[dictionary.dict_id()] = dictionary
+            self._active = dictionary.dict_id()
+
+    def _dictionary(self, dict_id: int):
+        import zstandard
+
+        if not dict_id:
+            return None
+        dictionary = self._by_id.get(dict_id)
+        if dictionary is None:
+            stored = self.dictionaries.find_one({'_id': dict_id}) if self.dictionaries is not None else None
+            if stored is None:
+                raise ValueError(f"body compressed with unknown dictionary {dict_id}")
+            dictionary = zstandard.ZstdCompressionDict(bytes(stored['data']))
+            with self._lock:
+                self._by_id[dict_id] = dictionary
+        return dictionary
+
+    @property
+    def active(self) -> int:
+        """Id of the dictionary compress() uses, 0 for none: the newest stored"""
+        if self._active is None:
+            newest = None
+            if self.dictionaries is not None:
+                newest = next(iter(self.dictionaries.find({}, {'_id': 1}).sort('trained_at', -1).limit(1)),
+                              None)
+            self._active = newest['_id'] if newest else 0
+        return self._active
+
+    def _coder(self, kind: str, dict_id: int):
+        import zstandard
+
+        coders = self._local.__dict__.setdefault(kind, {})
+        coder = coders.get(dict_id)
+        if coder is None:
+            dictionary = self._dictionary(dict_id)
+            if kind == 'compress':
+                coder = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+            else:
+                coder = zstandard.ZstdDecompressor(dict_data=dictionary)
+            coders[dict_id] = coder
+        return coder
+
+    def compress(self, text: Optional[str]):
+        """text as BSON binary, or text itself when compressing does not make it smaller"""
+        from bson import Binary
+
+        if not text:
+            return text
+        raw = text.encode('utf-8')
+        data = self._coder('compress', self.active).compress(raw)
+        if len(data) >= len(raw):
+            return text
+        return Binary(data, BODY_SUBTYPE)
+
+    def decompress(self, value) -> Optional[str]:
+        """Body text of a stored value, compressed or not"""
+        import zstandard
+
+        if value is None or isinstance(value, str):
+            return value
+        data = bytes(value)
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        return self._coder('decompress', dict_id).decompress(data).decode('utf-8')
+
+
+class ArchiveMessage(dict):
+    """Archive document or thread entry whose body is decompressed when it
+    is first read"""
+
+    __slots__ = ('codec',)
+
+    def __init__(self, fields, codec: BodyCodec):
+        super().__init__(fields)
+        self.codec = codec
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if key == 'body' and value is not None and not isinstance(value, str):
+            value = self.codec.decompress(value)
+            self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+def lazy_document(document: Dict, codec: BodyCodec) -> ArchiveMessage:
+    """document as read from the archive, with lazily decompressed bodies"""
+    document = ArchiveMessage(document, codec)
+    context = document.get('thread_context')
+    if context and 'messages' in context:
+        context = dict(context)
+        context['messages'] = [ArchiveMessage(entry, codec) for entry in context['messages']]
+        document['thread_context'] = context
+    return document
+
+
+def _encode_message(message: Dict, codec: Optional[BodyCodec], snippet: bool) -> Dict:
+    message = dict(message)
+    body = message.get('body')
+    if isinstance(body, str):
+        message[SIGNATURE_FIELD] = SIGNATURE in body
+        if codec is not None:
+            message['body'] = codec.compress(body)
+    if not snippet and codec is not None:
+        message.pop('snippet', None)
+    return message
+
+
+def encode_document(document: Dict, codec: Optional[BodyCodec]) -> Dict:
+    """Archive document (models.EmailMessage.to_document) as stored: bodies
+    compressed with codec (kept as text if it is None) and flagged with
+    SIGNATURE_FIELD, and with ENCODING_FIELD if there is a codec"""
+    document = _encode_message(document, codec, snippet=True)
+    if codec is not None:
+        document[ENCODING_FIELD] = 'zstd'
+    context = document.get('thread_context')
+    if context and 'messages' in context:
+        document['thread_context'] = dict(context, messages=[
+            _encode_message(entry, codec, snippet=False) for entry in context['messages']])
+    return document
+
+
+def archive_codec(db) -> Optional[BodyCodec]:
+    """The codec documents are written with (ARCHIVE_BODY_COMPRESSION), or
+    None to store text"""
+    if ARCHIVE_BODY_COMPRESSION == 'none':
+        return None
+    if ARCHIVE_BODY_COMPRESSION != 'zstd':
+        raise ValueError(f"unsupported ARCHIVE_BODY_COMPRESSION {ARCHIVE_BODY_COMPRESSION!r}")
+    return BodyCodec(db['body_dictionaries'])
+
+
+def sample_bodies(collection, count: int = DICTIONARY_SAMPLES, codec: Optional[BodyCodec] = None):
+    """Bodies of count random archive documents and of their thread entries"""
+    codec = codec or BodyCodec.for_collection(collection)
+    for document in collection.aggregate([
+            {'$sample': {'size': count}},
+            {'$project': {'_id': 0, 'body': 1, 'thread_context.messages.body': 1}}]):
+        document = lazy_document(document, codec)
+        yield document.get('body')
+        for entry in document.get('thread_context', {}).get('messages', []):
+            yield entry.get('body')
+
+
+def compress_collection(collection, codec: BodyCodec, batch_size: int = 500) -> int:
+    """Re-encode the documents stored as text, that no codec has encoded
+    yet; returns how many were rewritten"""
+    from pymongo import ReplaceOne
+
+    count = 0
+    batch = []
+    with collection.find({'body': {'$type': 'string'}, ENCODING_FIELD: {'$exists': False}}
+                         ).batch_size(batch_size) as cursor:
+        for document in cursor:
+            batch.append(ReplaceOne({'_id': document['_id']}, encode_document(document, codec)))
+            if len(batch) == batch_size:
+                count += collection.bulk_write(batch, ordered=False).modified_count
+                batch = []
+    if batch:
+        count += collection.bulk_write(batch, ordered=False).modified_count
+    log.info("archive_compressed", documents=count, dictionary=codec.active)
+    return count
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    from pymongo import MongoClient
+    from metrics import configure_logging
+
+    parser = argparse.ArgumentParser(description="Compressed bodies of the MongoDB archive")
+    commands = parser.add_subparsers(dest='command', required=True)
+    train = commands.add_parser('train', help="train and store a dictionary on sampled bodies")
+    train.add_argument('--samples', type=int, default=DICTIONARY_SAMPLES, help="documents to sample")
+    train.add_argument('--size', type=int, default=DICTIONARY_SIZE, help="dictionary bytes")
+    commands.add_parser('compress', help="compress the bodies still stored as text")
+    args = parser.parse_args()
+
+    configure_logging()
+    client = MongoClient(os.getenv('MONGODB_URI'))
+    try:
+        collection = client['email_history']['email_history']
+        codec = BodyCodec.for_collection(collection)
+        if args.command == 'train':
+            codec.train(sample_bodies(collection, args.samples, codec), args.size)
+        else:
+            compress_collection(collection, codec)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Email body cleaning: quoted history, forwarded blocks, signatures and
+tracking links.
+
+Everything is one precompiled alternation applied with a single re.sub, so
+the text is scanned once in C with no per-line Python loop:
+
+- a reply header in Italian or English ("Il giorno ... ha scritto:",
+  "On ... wrote:", which Gmail often wraps over two or three lines, and
+  which must carry a time, a date or an address to count as one), a
+  forwarded or original-message block, an Outlook-style From:/Sent: header
+  or an RFC 3676 "-- " signature delimiter cuts the rest of the text;
+- quoted lines ("> ...") and mobile footers are dropped line by line, so
+  answers written between quoted lines survive;
+- the "Customer Success Assistant" signature block and the bit.ly /
+  mail-sig tracking links (and leftover <mailto:...> fragments) are removed
+  wherever they appear.
+
+A second, trivial pass collapses the blank lines the removals leave behind.
+"""
+import re
+
+# Leading indentation or quote markers a header line may carry
+_LEAD = r'^[ \t>]*'
+
+# Part of a reply header before or after its date: up to 200 characters,
+# wrapped over several lines but never across a blank one
+_HEADER_SPAN = r'(?:[^\n]|\n(?![ \t]*\n)){0,200}?'
+# What tells a reply header from prose that happens to start with Il / On and
+# to contain "ha scritto:" / "wrote:": a time, a numeric date or an address
+# (Gmail often mangles it to "<x@y.com" or breaks the line after the "<")
+_HEADER = (_HEADER_SPAN + r'(?:\d{1,2}:\d{2}\b|\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b|<[ \t\n]*[^\s<>@]+@)'
+           + _HEADER_SPAN)
+
+_CUT = '|'.join([
+    # Il giorno mer 21 mag 2025 alle ore 12:51 Nome <x@y.com> ha scritto:
+    # Il 12/05/2025 10:00, Nome ha scritto:   (often wrapped)
+    _LEAD + r'Il\b' + _HEADER + r'\bha scritto:',
+    # On Wed, May 21, 2025 at 12:51 PM Name <x@y.com> wrote:
+    _LEAD + r'On\b' + _HEADER + r'\bwrote:',
+    # ---------- Forwarded message --------- / ----- Original Message -----
+    _LEAD + r'-{2,}[ \t]*(?:Forwarded message|Messaggio inoltrato|Original Message|'
+            r'Messaggio originale)[ \t]*-*',
+    _LEAD + r'(?:Begin forwarded message|Inizio messaggio inoltrato):',
+    # Outlook: From: ... / Sent: ...  or  Da: ... / Inviato: ...
+    _LEAD + r'(?:From|Da):[^\n]*\n' + _LEAD[1:] + r'(?:Sent|Date|Inviato|Data):',
+    # RFC 3676 signature delimiter
+    r'^--[ \t]?$',
+])
+
+_DROP_LINE = '|'.join([
+    _LEAD + r'>[^\n]*\n?',
+    r'^[ \t]*(?:Sent from my|Inviato da(?:l mio)?|Inviato dal mio) (?:iPhone|iPad|Android|'
+    r'smartphone|Samsung|Huawei|dispositivo)[^\n]*\n?',
+])
+
+_SIGNATURE = (
+    # Optional name line, the title, then any of the brand / link lines. The
+    # name is an optional group *after* the line anchor, so lines that start
+    # with neither are rejected without a second attempt at the title
+    r"^[ \t]*(?:[A-Z][\w.' -]{0,30}\n[ \t]*)?Customer Success Assistant[ \t]*\n?"
+    r'(?:[ \t]*(?:Fast Book Ads(?: Team)?|\*?fastbookads\.com\*?[^\n]*|\[https?://[^\]\s]*\])'
+    r'[ \t]*\n?)*'
+)
+
+# Gated on the first character so the branches cost one check per position
+_TRACKING = r'(?=[\[<h ])(?:' + '|'.join([
+    r'\[https?://[^\]\s]*mail-sig[^\]\s]*\]',
+    r'<?https?://(?:bit\.ly|[\w.-]*googleusercontent\.com/mail-sig)/[^\s>*\]]*>?\*?',
+    r' ?<mailto:[^\s>]*>?',
+]) + ')'
+
+PATTERN = re.compile(
+    rf'(?:{_CUT})[\s\S]*\Z|{_DROP_LINE}|{_SIGNATURE}|{_TRACKING}',
+    re.MULTILINE,
+)
+BLANK_LINES = re.compile(r'\n[ \t]*(?:\n[ \t]*)+\n')
+
+
+def clean_body(text: str) -> str:
+    """Text the sender actually wrote in this message, without quoted history,
+    forwarded blocks, signature or tracking links."""
+    if not text:
+        return ''
+    return BLANK_LINES.sub('\n\n', PATTERN.sub('', text)).strip()
@@ -0,0 +1,255 @@
+"""Columnar snapshot of the reply corpus (Parquet, via pyarrow).
+
+The corpus otherwise lives in Pinecone metadata (truncated to 15,000
+characters), in MongoDB documents with nested thread context, and in the
+flat message_data.txt dump, and none of them is quick to scan in bulk.
+export_snapshot() writes one row per (original message, our first reply)
+pair of the MongoDB archive:
+
+    reply_id       Gmail id of the reply, also the Pinecone vector id
+    thread_id
+    original_text  cleaned, not truncated
+    reply_text     cleaned, not truncated
+    language       'it' / 'en'
+    sent_at        timestamp[ms, UTC] of the reply
+    month          'YYYY-MM' of sent_at
+    embed_model    model that produced the embedding
+    embedding      fixed_size_list<float32>[dimension], null without --embed
+
+The dataset is hive-partitioned by language and month, so re-embedding one
+month or evaluating one language reads only those files. The embedding
+column is a fixed-size list of float32, whose values buffer is one
+contiguous array: load_embeddings() hands it to NumPy as an (n, dimension)
+matrix without copying it. import_snapshot() upserts the stored vectors
+into a Pinecone index without calling the embedding API again.
+
+pyarrow is only needed here and is imported on first use.
+
+Usage: python corpus_snapshot.py export [--out snapshots/corpus] [--embed]
+       python corpus_snapshot.py import [--snapshot snapshots/corpus] [--index NAME]
+"""
+import os
+import argparse
+import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from indexing import (EMBED_MODEL, UPSERT_BATCH, ArchiveIndexer, document_messages, embed_texts,
+                      pair_texts)
+from models import vector_metadata
+from index_versions import EMBED_MODELS, open_registry
+from metrics import API_CALLS, get_logger, timed
+
+log = get_logger(__name__)
+
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', os.path.join('snapshots', 'corpus'))
+DIMENSION = 1024
+PARTITIONING = ['language', 'month']
+# Rows per record batch: a few MB of text plus 4 KB of embedding each
+ROWS_PER_BATCH = int(os.getenv('SNAPSHOT_BATCH_ROWS', '1000'))
+
+
+def schema(dimension: int = DIMENSION, model: str = EMBED_MODEL):
+    import pyarrow as pa
+
+    return pa.schema([
+        ('reply_id', pa.string()),
+        ('thread_id', pa.string()),
+        ('original_text', pa.large_string()),
+        ('reply_text', pa.large_string()),
+        ('language', pa.string()),
+        ('sent_at', pa.timestamp('ms', tz='UTC')),
+        ('month', pa.string()),
+        ('embed_model', pa.string()),
+        ('embedding', pa.list_(pa.float32(), dimension)),
+    ], metadata={'embed_model': model, 'dimension': str(dimension)})
+
+
+def snapshot_row(document: Dict) -> Optional[Dict]:
+    """Row for an archive document (see indexing.ArchiveIndexer.documents)"""
+    found = document_messages(document)
+    if found is None:
+        return None
+    original, reply = found
+    original_text, reply_text, language = pair_texts(original.get('body') or '', reply['body'])
+    sent_at = reply.get('sent_at')
+    if sent_at is not None and sent_at.tzinfo is None:
+        # Mongo hands back naive UTC datetimes
+        sent_at = sent_at.replace(tzinfo=datetime.timezone.utc)
+    return {
+        'reply_id': reply['message_id'],
+        'thread_id': document['thread_id'],
+        'original_text': original_text,
+        'reply_text': reply_text,
+        'language': language,
+        'sent_at': sent_at,
+        'month': sent_at.strftime('%Y-%m') if sent_at else 'unknown',
+        'embed_model': None,
+        'embedding': None,
+    }
+
+
+def _record_batches(rows: Iterable[Dict], arrow_schema, pc=None, model=EMBED_MODEL) -> Iterator:
+    import pyarrow as pa
+
+    def batch(chunk):
+        if pc is not None:
+            for row, values in zip(chunk, embed_texts(pc, [row['original_text'] for row in chunk], model)):
+                row['embedding'] = values
+                row['embed_model'] = model
+        return pa.RecordBatch.from_pylist(chunk, schema=arrow_schema)
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == ROWS_PER_BATCH:
+            yield batch(chunk)
+            chunk = []
+    if chunk:
+        yield batch(chunk)
+
+
+def export_snapshot(collection, path: str = SNAPSHOT_DIR, pc=None, model: str = EMBED_MODEL) -> int:
+    """Write the pairs of an email_history collection to a partitioned
+    Parquet dataset at path, replacing the partitions it writes. With a
+    Pinecone client the original texts are embedded with model too.
+    Returns the row count."""
+    import pyarrow.dataset as ds
+
+    arrow_schema = schema(EMBED_MODELS[model]['dimension'], model)
+    rows = (snapshot_row(document) for document in
+            ArchiveIndexer(collection, pc=None, index=None, index_name='snapshot').documents())
+    count = 0
+
+    def counted(batches):
+        nonlocal count
+        for record_batch in batches:
+            count += record_batch.num_rows
+            yield record_batch
+
+    file_format = ds.ParquetFileFormat()
+    with timed('snapshot_export'):
+        ds.write_dataset(
+            counted(_record_batches((row for row in rows if row is not None), arrow_schema, pc, model)),
+            path,
+            schema=arrow_schema,
+            format=file_format,
+            # Text compresses well; the float32 embeddings barely do
+            file_options=file_format.make_write_options(
+                compression='zstd', use_dictionary=['language', 'month', 'embed_model']),
+            partitioning=PARTITIONING,
+            partitioning_flavor='hive',
+            existing_data_behavior='delete_matching',
+        )
+    log.info("snapshot_exported", path=path, rows=count, embedded=pc is not None)
+    return count
+
+
+def open_snapshot(path: str = SNAPSHOT_DIR):
+    """The snapshot as a pyarrow dataset, partition columns included"""
+    import pyarrow.dataset as ds
+
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+
+def embedding_matrix(embeddings):
+    """(n, dimension) float32 view over a fixed_size_list<float32> array,
+    sharing its memory; the array must have no nulls"""
+    import pyarrow as pa
+
+    if isinstance(embeddings, pa.ChunkedArray):
+        # One copy, only when the column spans several record batches
+        embeddings = embeddings.combine_chunks()
+    if embeddings.null_count:
+        raise ValueError("snapshot rows without an embedding; export it with --embed")
+    dimension = embeddings.type.list_size
+    # flatten() honours the array's offset; to_numpy refuses to copy
+    return embeddings.flatten().to_numpy(zero_copy_only=True).reshape(-1, dimension)
+
+
+def load_embeddings(path: str = SNAPSHOT_DIR, filter=None) -> Tuple[List[str], 'numpy.ndarray']:
+    """Vector ids and their embeddings as an (n, dimension) float32 matrix.
+
+    filter is a pyarrow.dataset expression, e.g.
+    pyarrow.dataset.field('language') == 'it'.
+    """
+    table = open_snapshot(path).to_table(columns=['reply_id', 'embedding'], filter=filter)
+    return table.column('reply_id').to_pylist(), embedding_matrix(table.column('embedding'))
+
+
+def import_snapshot(index, path: str = SNAPSHOT_DIR, filter=None, model: str = EMBED_MODEL) -> int:
+    """Upsert the snapshot's stored embeddings into index; returns the count.
+
+    Rows embedded with another model than the index's are refused, since
+    their vectors do not live in the same space as the queries.
+    """
+    import pyarrow.compute as compute
+
+    dataset = open_snapshot(path)
+    count = 0
+    columns = ['reply_id', 'original_text', 'reply_text', 'language', 'sent_at', 'embed_model',
+               'embedding']
+    for record_batch in dataset.to_batches(columns=columns, filter=filter, batch_size=UPSERT_BATCH):
+        if not record_batch.num_rows:
+            continue
+        models = set(compute.unique(record_batch.column('embed_model')).to_pylist())
+        if models != {model}:
+            raise ValueError(f"snapshot embedded with {sorted(map(str, models))}, index uses {model}")
+        vectors = embedding_matrix(record_batch.column('embedding'))
+        rows = [dict(zip(columns, values)) for values in
+                zip(*(record_batch.column(name).to_pylist() for name in columns[:-1]))]
+        API_CALLS.inc(service='pinecone', method='upsert')
+        with timed('upsert'):
+            index.upsert(vectors=[{
+                'id': row['reply_id'],
+                'values': values.tolist(),
+                'metadata': vector_metadata(row['original_text'], row['reply_text'], row['sent_at'],
+                                            row['language']),
+            } for row, values in zip(rows, vectors)])
+        count += len(rows)
+    log.info("snapshot_imported", path=path, vectors=count)
+    return count
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    from transport import TransportConfig, build_pinecone
+    from metrics import configure_logging
+    from gmail_auto_response import connect_index
+
+    parser = argparse.ArgumentParser(description="Export / import the reply corpus as Parquet")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help="MongoDB archive -> Parquet")
+    export.add_argument('--out', default=SNAPSHOT_DIR)
+    export.add_argument('--embed', action='store_true', help="also store the embeddings")
+    export.add_argument('--model', default=EMBED_MODEL, choices=sorted(EMBED_MODELS))
+    load = commands.add_parser('import', help="Parquet -> Pinecone index, without re-embedding")
+    load.add_argument('--snapshot', default=SNAPSHOT_DIR)
+    load.add_argument('--index', help="index version to fill (default: the active one)")
+    args = parser.parse_args()
+
+    configure_logging()
+    transport = TransportConfig()
+    pc = None
+    if args.command == 'import' or args.embed:
+        pc = build_pinecone(os.environ.get("PINECONE_API_KEY"), transport)
+    if args.command == 'export':
+        from pymongo import MongoClient
+
+        client = MongoClient(os.getenv('MONGODB_URI'))
+        try:
+            export_snapshot(client['email_history']['email_history'], args.out, pc=pc,
+                            model=args.model)
+        finally:
+            client.close()
+    else:
+        registry = open_registry()
+        version = registry.version(args.index) if args.index else registry.active()
+        import_snapshot(connect_index(pc, transport, index_name=version.name, version=version,
+                                      writable=True),
+                        args.snapshot, model=version.model)
+
+
+if __name__ == '__main__':
+    main()
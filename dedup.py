@@ -0,0 +1,215 @@
+"""Near-duplicate pruning of reply pairs before they are embedded.
+
+Most of our replies are templates, answering the same handful of
+questions in the same words (see message_data.txt), so the archive holds
+many pairs that differ in a name or a date. Each one costs an embedding
+call, index space and query time, and the near-identical matches crowd
+the top_k of a search. Deduplicator drops them on the way to
+upsert_pairs:
+
+- each pair's cleaned original and reply are split into word 3-grams,
+  hashed, and summarised by NUM_PERM min-hashes: the share of min-hashes
+  two pairs have in common estimates the Jaccard similarity of their
+  shingle sets;
+- the signature is cut into BANDS bands, and each band is looked up in a
+  hash table of the representatives kept so far (LSH): pairs at
+  DEDUP_THRESHOLD similarity share a band with high probability, pairs
+  far below it almost never;
+- a pair whose estimated similarity to one of those candidates reaches
+  DEDUP_THRESHOLD joins its cluster and is not upserted; otherwise it is
+  kept and becomes a representative.
+
+Each pair costs one signature and at most BANDS candidate checks, so the
+stage is linear in the number of pairs, and keeps only the
+representatives' signatures in memory. The first pair of a cluster is the
+one embedded (its original stands for the cluster's near-identical
+ones). Once the run has upserted, apply() sets on each representative
+with duplicates the number of pairs it stands for (DUPLICATES_FIELD), and
+the reply text and sent_at of the cluster's latest pair, so the index
+suggests the current wording and the recency filter sees the latest use.
+
+Clusters only span one run: a full rebuild (`indexing.py --full`,
+index_versions.py) deduplicates the whole archive, an incremental run its
+new pairs. `python dedup.py` reports what it would prune from a corpus
+snapshot, without indexing anything.
+"""
+import os
+import re
+import zlib
+import argparse
+from typing import Dict, Iterable, Iterator, Optional
+
+from metrics import API_CALLS, get_logger, timed
+
+log = get_logger(__name__)
+
+# Estimated Jaccard similarity of the shingles from which pairs are merged
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', '0.8'))
+NUM_PERM = 128
+# 16 bands of 8 rows: a pair at similarity s shares a band with probability
+# 1 - (1 - s^8)^16, 0.94 at 0.8 and 0.01 at 0.4
+BANDS = 16
+SHINGLE_WORDS = 3
+DUPLICATES_FIELD = 'duplicates'
+_WORD = re.compile(r'\w+')
+
+
+def shingles(text: str):
+    """crc32 hashes of the word SHINGLE_WORDS-grams of text, as uint64"""
+    import numpy as np
+
+    words = _WORD.findall(text.lower())
+    grams = {' '.join(words[i:i + SHINGLE_WORDS])
+             for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64,
+                       count=len(grams))
+
+
+class MinHasher:
+    """NUM_PERM min-hash signatures of shingle sets"""
+
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = 1):
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashes: the high 32 bits of a * h + b mod 2**64, for
+        # odd a (the low bits of the product only depend on those of h)
+        self.a = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str):
+        """(num_perm,) uint32 signature of text"""
+        import numpy as np
+
+        hashes = shingles(text)
+        with np.errstate(over='ignore'):
+            values = (self.a[:, None] * hashes[None, :] + self.b[:, None]) >> np.uint64(32)
+        return values.min(axis=1).astype(np.uint32)
+
+
+class Deduplicator:
+    """Streaming MinHash/LSH clustering of pairs (indexing.Pair)"""
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = NUM_PERM,
+                 bands: int = BANDS):
+        if num_perm % bands:
+            raise ValueError(f"{num_perm} permutations do not split into {bands} bands")
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm)
+        self.rows = num_perm // bands
+        # One table per band: band bytes -> first representative with them
+        self._tables = [{} for _ in range(bands)]
+        self._signatures = {}
+        # representative id -> its sent_at
+        self._sent_at = {}
+        # representative id -> [pairs it stands for, metadata of the latest
+        # pair if newer than the representative, else None]
+        self.clusters = {}
+        self.seen = 0
+
+    def _match(self, signature) -> Optional[str]:
+        """The most similar representative at the threshold or above, if any"""
+        import numpy as np
+
+        best, best_similarity = None, self.threshold
+        checked = set()
+        for band, table in enumerate(self._tables):
+            candidate = table.get(signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            if candidate is None or candidate in checked:
+                continue
+            checked.add(candidate)
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        return best
+
+    def add(self, vector_id: str, text: str) -> Optional[str]:
+        """Cluster text: returns the representative it duplicates, or None if
+        it becomes one itself"""
+        self.seen += 1
+        signature = self.hasher.signature(text)
+        representative = self._match(signature)
+        if representative is not None:
+            return representative
+        self._signatures[vector_id] = signature
+        for band, table in enumerate(self._tables):
+            table.setdefault(signature[band * self.rows:(band + 1) * self.rows].tobytes(), vector_id)
+        return None
+
+    def filter(self, pairs: Iterable) -> Iterator:
+        """The pairs that are not near-duplicates of an earlier one"""
+        for pair in pairs:
+            vector_id, original_text, metadata = pair
+            with timed('dedup'):
+                representative = self.add(vector_id, original_text + '\n' + metadata['reply_message'])
+            if representative is None:
+                self._sent_at[vector_id] = metadata['sent_at']
+                yield pair
+                continue
+            cluster = self.clusters.setdefault(representative, [1, None])
+            cluster[0] += 1
+            latest = cluster[1]['sent_at'] if cluster[1] is not None else self._sent_at[representative]
+            # Input order varies (the Gmail backfill reads newest first):
+            # only a strictly newer pair replaces the representative's text
+            if metadata['sent_at'] > latest:
+                cluster[1] = metadata
+
+    @property
+    def kept(self) -> int:
+        return len(self._signatures)
+
+    def report(self) -> Dict:
+        """How much the pairs seen so far shrank"""
+        largest = max((count for count, _ in self.clusters.values()), default=1)
+        return {
+            'pairs': self.seen,
+            'kept': self.kept,
+            'pruned': self.seen - self.kept,
+            'shrink': round(1 - self.kept / self.seen, 3) if self.seen else 0.0,
+            'clusters_with_duplicates': len(self.clusters),
+            'largest_cluster': largest,
+        }
+
+    def apply(self, index) -> int:
+        """Set the cluster size, and the latest reply and sent_at if a
+        duplicate is newer, on the upserted representatives that have
+        duplicates; returns how many"""
+        if not self.clusters:
+            return 0
+        for representative, (count, latest) in self.clusters.items():
+            metadata = {DUPLICATES_FIELD: count}
+            if latest is not None:
+                metadata.update(reply_message=latest['reply_message'], sent_at=latest['sent_at'])
+            API_CALLS.inc(service='pinecone', method='update')
+            with timed('upsert'):
+                index.update(id=representative, set_metadata=metadata)
+        return len(self.clusters)
+
+
+def main():
+    from corpus_snapshot import SNAPSHOT_DIR, open_snapshot
+    from models import vector_metadata
+    from metrics import configure_logging
+
+    parser = argparse.ArgumentParser(description="Report the near-duplicate pairs of a corpus snapshot")
+    parser.add_argument('--snapshot', default=SNAPSHOT_DIR)
+    parser.add_argument('--threshold', type=float, default=DEDUP_THRESHOLD)
+    args = parser.parse_args()
+
+    configure_logging()
+    deduplicator = Deduplicator(args.threshold)
+    columns = ['reply_id', 'original_text', 'reply_text', 'language', 'sent_at']
+
+    def pairs():
+        for batch in open_snapshot(args.snapshot).to_batches(columns=columns):
+            for reply_id, original, reply, language, sent_at in zip(
+                    *(batch.column(name).to_pylist() for name in columns)):
+                yield reply_id, original, vector_metadata(original, reply, sent_at, language)
+
+    for _ in deduplicator.filter(pairs()):
+        pass
+    log.info("dedup_report", threshold=args.threshold, **deduplicator.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,536 @@
+"""Coordinator / worker mode: answer the mailboxes from several machines.
+
+One process per mailbox set (multi_mailbox.py) cannot scale past one
+machine, and nothing takes over when it dies. In this mode the work queue
+lives in MongoDB, which the archive already uses, and the work is split:
+
+- the coordinator lists every mailbox each poll and enqueues the messages
+  to answer. Any number of coordinators can run; the one holding the
+  'coordinator' lease polls and the others wait to take it over;
+- workers, on any host, claim jobs with find_one_and_update, which leases
+  one job atomically, run them like GmailAutoReply.run_job and heartbeat
+  the leases of the jobs in progress. A worker that dies stops
+  heartbeating and its jobs are claimed again after LEASE_SECONDS.
+
+The coordinator only talks to Gmail and MongoDB; workers answer with
+OpenAI and Pinecone like multi_mailbox.py. The index registry
+(index_versions.py) is kept in MongoDB in this mode, so a switch made on
+any host reaches every worker (`INDEX_REGISTRY=mongo python
+index_versions.py ...` to manage it).
+
+Workers only share the jobs collection, so throughput grows with their
+number until OpenAI's rate limits, which each worker budgets for on its
+own (OPENAI_RPM / OPENAI_TPM should be split between them).
+
+There is one job per thread, not per message: a message arriving in a
+thread whose reply is being written replaces the job's message, and the
+worker holding it finds its lease superseded when it finishes. So two
+workers never write replies to one thread at the same time, and the reply
+is always to the thread's latest message. The job stages and the retry,
+backoff and dead-letter rules are the ones of work_queue.py, and
+MongoWorkQueue can stand in for WorkQueue anywhere.
+
+Every node needs the accounts file and the mailbox tokens. Locally, with
+one mongod:
+
+    MONGODB_URI=mongodb://localhost:27017 python distributed.py coordinator accounts.json
+    MONGODB_URI=mongodb://localhost:27017 python distributed.py worker accounts.json  # x N
+    MONGODB_URI=mongodb://localhost:27017 python distributed.py status
+"""
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from models import EmailMessage
+from work_queue import (DRAFTED, FETCHED, GENERATED, KEEP_DONE_DAYS, MAX_ATTEMPTS, PENDING,
+                        PURGE_INTERVAL_SECONDS, SKIPPED, Job, retry_delay, worker_id)
+from metrics import get_logger
+
+log = get_logger(__name__)
+
+DATABASE = 'email_history'
+# Shorter than the SQLite queue's: leases are heartbeated, and a dead
+# worker's jobs should move to another one quickly
+LEASE_SECONDS = float(os.getenv('DISTRIBUTED_LEASE_SECONDS', '60'))
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', os.getenv('GLOBAL_CONCURRENCY', '4')))
+# Wait between claims while the queue is empty
+WORKER_IDLE_SECONDS = float(os.getenv('WORKER_IDLE_SECONDS', '2'))
+
+
+def job_key(mailbox: str, thread_id: str) -> str:
+    return f"{mailbox}/{thread_id}"
+
+
+def _job(document: Dict, owner: str) -> Job:
+    return Job(document['mailbox'], document['message_id'], document['state'],
+               EmailMessage.from_state(document['message']), document.get('reply'),
+               document['attempts'], owner)
+
+
+class MongoWorkQueue:
+    """WorkQueue over the reply_jobs and reply_dead_letters collections,
+    one job per (mailbox, thread)"""
+
+    def __init__(self, db, lease_seconds: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        self.jobs = db['reply_jobs']
+        self.dead = db['reply_dead_letters']
+        self.locks = db['reply_locks']
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._purged_at = None
+        self.jobs.create_index([('state', 1), ('available_at', 1)])
+        self.jobs.create_index([('mailbox', 1), ('message_ids', 1)])
+        self.dead.create_index([('mailbox', 1), ('message_id', 1)])
+
+    def close(self):
+        pass
+
+    def _owned(self, job: Job) -> Dict:
+        """Filter matching job while its claimer still holds it for its message"""
+        return {'_id': job_key(job.mailbox, job.message.thread_id), 'lease_owner': job.owner,
+                'message_id': job.message_id}
+
+    def enqueue(self, mailbox: str, messages: Iterable[EmailMessage]) -> int:
+        """Make each message the job of its thread, unless the thread's job
+        already has it or a later message; dead messages are left alone.
+        Returns how many jobs were added or replaced."""
+        from pymongo.errors import DuplicateKeyError
+
+        messages = list(messages)
+        dead = self._dead_ids(mailbox, [message.id for message in messages])
+        added = 0
+        for message in messages:
+            if message.id in dead:
+                continue
+            now = time.time()
+            key = job_key(mailbox, message.thread_id)
+            try:
+                result = self.jobs.update_one(
+                    {'_id': key, 'message_ids': {'$ne': message.id},
+                     '$or': [{'message.internal_date': {'$lte': message.internal_date or 0}},
+                             {'message.internal_date': None}]},
+                    {'$set': {'mailbox': mailbox, 'thread_id': message.thread_id, 'message_id': message.id,
+                              'message': message.to_state(), 'state': FETCHED, 'reply': None,
+                              'attempts': 0, 'last_error': None, 'available_at': now, 'updated_at': now},
+                     '$addToSet': {'message_ids': message.id},
+                     '$setOnInsert': {'created_at': now, 'lease_owner': None, 'lease_expires_at': None}},
+                    upsert=True)
+                added += bool(result.upserted_id is not None or result.modified_count)
+            except DuplicateKeyError:
+                # Known, or older than the thread's job: answered by its reply
+                self.jobs.update_one({'_id': key}, {'$addToSet': {'message_ids': message.id}})
+        return added
+
+    def supersede(self, mailbox: str, messages: Iterable[Tuple[str, str]]):
+        """Record (message id, thread id) pairs as known to their thread's
+        job, whose newer message answers them"""
+        for message_id, thread_id in messages:
+            self.jobs.update_one({'_id': job_key(mailbox, thread_id)},
+                                 {'$addToSet': {'message_ids': message_id}})
+
+    def _dead_ids(self, mailbox: str, message_ids: List[str]):
+        return {document['message_id'] for document in self.dead.find(
+            {'mailbox': mailbox, 'message_id': {'$in': message_ids}}, {'message_id': 1})}
+
+    def known(self, mailbox: str, message_ids: Iterable[str]):
+        """The ids among message_ids that are queued, done or dead"""
+        message_ids = list(message_ids)
+        found = self._dead_ids(mailbox, message_ids)
+        for document in self.jobs.find({'mailbox': mailbox, 'message_ids': {'$in': message_ids}},
+                                       {'message_ids': 1}):
+            found.update(set(document['message_ids']).intersection(message_ids))
+        return found
+
+    def claim(self, mailbox: Union[str, Iterable[str], None], owner: str, limit: int = 1,
+              message_ids: Optional[List[str]] = None) -> List[Job]:
+        """Lease up to limit due jobs of mailbox (a name, several names or
+        None for any), only those in message_ids if given; each
+        find_one_and_update leases one job atomically"""
+        from pymongo import ReturnDocument
+
+        if message_ids is not None and not message_ids:
+            return []
+        now = time.time()
+        query = {'state': {'$in': list(PENDING)}, 'available_at': {'$lte': now},
+                 '$or': [{'lease_owner': None}, {'lease_expires_at': {'$lte': now}}]}
+        if isinstance(mailbox, str):
+            query['mailbox'] = mailbox
+        elif mailbox is not None:
+            query['mailbox'] = {'$in': list(mailbox)}
+        if message_ids is not None:
+            query['message_id'] = {'$in': list(message_ids)}
+        jobs = []
+        for _ in range(limit):
+            document = self.jobs.find_one_and_update(
+                query, {'$set': {'lease_owner': owner, 'lease_expires_at': now + self.lease_seconds,
+                                 'updated_at': now}},
+                sort=[('available_at', 1)], return_document=ReturnDocument.AFTER)
+            if document is None:
+                break
+            jobs.append(_job(document, owner))
+        return jobs
+
+    def heartbeat(self, jobs: Iterable[Job]) -> int:
+        """Extend the leases of jobs still held; returns how many were"""
+        jobs = list(jobs)
+        if not jobs:
+            return 0
+        now = time.time()
+        held = 0
+        for owner in {job.owner for job in jobs}:
+            held += self.jobs.update_many(
+                {'_id': {'$in': [job_key(job.mailbox, job.message.thread_id) for job in jobs
+                                 if job.owner == owner]}, 'lease_owner': owner},
+                {'$set': {'lease_expires_at': now + self.lease_seconds}}).modified_count
+        return held
+
+    def advance(self, job: Job, state: str, reply: Optional[str] = None) -> bool:
+        """Record that job reached state and release it; False if the lease
+        had been lost, or the thread got a newer message meanwhile"""
+        update = {'state': state, 'lease_owner': None, 'lease_expires_at': None, 'last_error': None,
+                  'updated_at': time.time()}
+        if reply is not None:
+            update['reply'] = reply
+        if self.jobs.update_one(self._owned(job), {'$set': update}).matched_count:
+            job.state = state
+            job.reply = reply if reply is not None else job.reply
+            return True
+        self.release(job)
+        log.warning("job_lease_lost", mailbox=job.mailbox, message_id=job.message_id, state=state)
+        return False
+
+    def save_reply(self, job: Job, reply: str):
+        """Store the reply generated for job, keeping the lease"""
+        self.jobs.update_one(self._owned(job), {'$set': {'state': GENERATED, 'reply': reply,
+                                                         'updated_at': time.time()}})
+        job.state = GENERATED
+        job.reply = reply
+
+    def fail(self, job: Job, error: str) -> bool:
+        """Record a failed attempt: retry later, or move the job to the dead
+        letters after max_attempts. Returns True if it was moved."""
+        now = time.time()
+        attempts = job.attempts + 1
+        job.attempts = attempts
+        if attempts < self.max_attempts:
+            retried = self.jobs.update_one(self._owned(job), {'$set': {
+                'attempts': attempts, 'last_error': error, 'available_at': now + retry_delay(attempts),
+                'lease_owner': None, 'lease_expires_at': None, 'updated_at': now}})
+            if not retried.matched_count:
+                self.release(job)
+            log.warning("job_failed", mailbox=job.mailbox, message_id=job.message_id,
+                        attempts=attempts, error=error)
+            return False
+        document = self.jobs.find_one(self._owned(job))
+        if document is None:
+            self.release(job)
+            return False
+        # Written before the job is deleted: a crash in between leaves a
+        # dead letter for a job that still exists, never neither
+        self.dead.replace_one({'_id': job_key(job.mailbox, job.message_id)}, {
+            'mailbox': job.mailbox, 'message_id': job.message_id, 'thread_id': document['thread_id'],
+            'state': document['state'], 'message': document['message'], 'reply': document.get('reply'),
+            'attempts': attempts, 'last_error': error, 'failed_at': now}, upsert=True)
+        self.jobs.delete_one(self._owned(job))
+        log.error("job_dead_lettered", mailbox=job.mailbox, message_id=job.message_id,
+                  attempts=attempts, error=error)
+        return True
+
+    def release(self, job: Job):
+        """Give a claimed job back without counting an attempt"""
+        self.jobs.update_one(
+            {'_id': job_key(job.mailbox, job.message.thread_id), 'lease_owner': job.owner},
+            {'$set': {'lease_owner': None, 'lease_expires_at': None, 'updated_at': time.time()}})
+
+    def mark(self, mailbox: str, message_ids: Iterable[str], state: str, reply: Optional[str] = None):
+        """Move unleased jobs to state, for work done outside claim/advance (the Batch API)"""
+        update = {'state': state, 'available_at': 0, 'updated_at': time.time()}
+        if reply is not None:
+            update['reply'] = reply
+        self.jobs.update_many({'mailbox': mailbox, 'message_id': {'$in': list(message_ids)},
+                               'lease_owner': None}, {'$set': update})
+
+    def counts(self, mailbox: Optional[str] = None) -> Dict[str, int]:
+        """Jobs per state (and 'dead'), for one mailbox or all of them"""
+        match = {'mailbox': mailbox} if mailbox else {}
+        counts = {group['_id']: group['count'] for group in self.jobs.aggregate(
+            [{'$match': match}, {'$group': {'_id': '$state', 'count': {'$sum': 1}}}])}
+        counts['dead'] = self.dead.count_documents(match)
+        return counts
+
+    def dead_letters(self, mailbox: Optional[str] = None) -> List[Dict]:
+        return list(self.dead.find({'mailbox': mailbox} if mailbox else {},
+                                   {'_id': 0, 'message': 0, 'reply': 0}).sort('failed_at', 1))
+
+    def requeue(self, mailbox: str, message_id: str) -> bool:
+        """Put a dead-lettered message back in the queue with its attempts reset"""
+        document = self.dead.find_one({'mailbox': mailbox, 'message_id': message_id})
+        if document is None:
+            return False
+        self.dead.delete_one({'_id': document['_id']})
+        # Not added back if the thread has a newer message, whose reply answers it
+        self.enqueue(mailbox, [EmailMessage.from_state(document['message'])])
+        return True
+
+    def purge(self, days: float = KEEP_DONE_DAYS) -> int:
+        """Delete jobs finished more than days ago"""
+        return self.jobs.delete_many({'state': {'$in': [DRAFTED, SKIPPED]},
+                                      'updated_at': {'$lt': time.time() - days * 86400}}).deleted_count
+
+    def purge_due(self, interval: float = PURGE_INTERVAL_SECONDS) -> int:
+        """purge(), unless this process already ran it in the last interval
+        seconds; returns how many were deleted"""
+        now = time.monotonic()
+        if self._purged_at is not None and now - self._purged_at < interval:
+            return 0
+        self._purged_at = now
+        purged = self.purge()
+        if purged:
+            log.info("jobs_purged", count=purged)
+        return purged
+
+    def acquire(self, name: str, owner: str, seconds: float) -> bool:
+        """Take or renew the named lease for seconds; False while someone
+        else holds it"""
+        from pymongo.errors import DuplicateKeyError
+
+        now = time.time()
+        try:
+            self.locks.update_one(
+                {'_id': name, '$or': [{'owner': owner}, {'expires_at': {'$lte': now}}]},
+                {'$set': {'owner': owner, 'expires_at': now + seconds}}, upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def give_up(self, name: str, owner: str):
+        self.locks.delete_one({'_id': name, 'owner': owner})
+
+
+class Coordinator:
+    """Syncs mailboxes (sync_only GmailAutoReply) into the queue, while it
+    holds the coordinator lease"""
+
+    LEASE = 'coordinator'
+
+    def __init__(self, mailboxes: List, queue: MongoWorkQueue, interval_minutes: float = 1):
+        self.mailboxes = mailboxes
+        self.queue = queue
+        self.interval = interval_minutes * 60
+        self.owner = worker_id('coordinator')
+        # Several polls may be missed before a standby takes over
+        self.lease_seconds = max(LEASE_SECONDS, 3 * self.interval)
+        self.stopping = threading.Event()
+        self.leading = False
+
+    def sync_once(self) -> int:
+        """List every mailbox once; returns how many messages were enqueued"""
+        enqueued = 0
+        for mailbox in self.mailboxes:
+            started = datetime.datetime.now()
+            try:
+                enqueued += len(mailbox.get_new_messages())
+            except Exception as error:
+                mailbox.log.exception("sync_failed", error=str(error))
+                continue
+            mailbox.last_check_time = started
+        return enqueued
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        for mailbox in self.mailboxes:
+            mailbox.authenticate()
+        log.info("coordinator_started", owner=self.owner, mailboxes=len(self.mailboxes))
+        while not self.stopping.is_set():
+            leading = self.queue.acquire(self.LEASE, self.owner, self.lease_seconds)
+            if leading != self.leading:
+                log.info("coordinator_leading" if leading else "coordinator_standby", owner=self.owner)
+                self.leading = leading
+            if leading:
+                enqueued = self.sync_once()
+                log.debug("sync_finished", enqueued=enqueued, jobs=self.queue.counts())
+                try:
+                    self.queue.purge_due()
+                except Exception as error:
+                    log.warning("purge_failed", error=str(error))
+            self.stopping.wait(self.interval)
+        if self.leading:
+            self.queue.give_up(self.LEASE, self.owner)
+        log.info("coordinator_stopped", owner=self.owner)
+
+
+class Worker:
+    """Claims and runs the jobs of the mailboxes of a MailboxSupervisor,
+    concurrency at a time, heartbeating their leases"""
+
+    def __init__(self, supervisor, queue: MongoWorkQueue, concurrency: int = WORKER_CONCURRENCY):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.mailboxes = {mailbox.name: mailbox for mailbox, _ in supervisor.mailboxes}
+        self.owner = worker_id()
+        self.stopping = threading.Event()
+        # Set once the jobs in progress when stopping have finished: their
+        # leases are heartbeated until then
+        self._drained = threading.Event()
+        # future -> job of the jobs in progress
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def _heartbeat(self):
+        while not self._drained.wait(HEARTBEAT_SECONDS):
+            with self._lock:
+                jobs = [job for future, job in self._running.items() if not future.done()]
+            try:
+                held = self.queue.heartbeat(jobs)
+            except Exception as error:
+                log.warning("heartbeat_failed", error=str(error))
+                continue
+            if held < len(jobs):
+                log.warning("leases_lost", owner=self.owner, running=len(jobs), held=held)
+
+    def _run(self, job: Job):
+        mailbox = self.mailboxes[job.mailbox]
+        try:
+            mailbox.run_job(job)
+        except Exception as error:
+            mailbox.log.exception("job_crashed", message_id=job.message_id, error=str(error))
+            self.queue.fail(job, str(error))
+
+    def stop(self):
+        """Finish the jobs in progress and claim no more"""
+        self.stopping.set()
+
+    def run(self):
+        for mailbox in self.mailboxes.values():
+            mailbox.authenticate()
+        self._drained.clear()
+        threading.Thread(target=self._heartbeat, name='lease-heartbeat', daemon=True).start()
+        log.info("worker_started", owner=self.owner, concurrency=self.concurrency)
+        try:
+            self._claim_loop()
+        finally:
+            self._drained.set()
+        log.info("worker_stopped", owner=self.owner)
+
+    def _claim_loop(self):
+        # Leaving the executor waits for the jobs in progress
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self.stopping.is_set():
+                with self._lock:
+                    free = self.concurrency - len(self._running)
+                if not self._running:
+                    # No job is using a retriever that a switch would replace
+                    for mailbox in self.mailboxes.values():
+                        mailbox.refresh_index()
+                jobs = []
+                if free:
+                    try:
+                        jobs = self.queue.claim(list(self.mailboxes), self.owner, limit=free)
+                    except Exception as error:
+                        log.warning("claim_failed", error=str(error))
+                with self._lock:
+                    for job in jobs:
+                        self._running[executor.submit(self._run, job)] = job
+                    running = list(self._running)
+                if not running:
+                    self.stopping.wait(WORKER_IDLE_SECONDS)
+                    continue
+                # Full: wait for a slot. Otherwise the queue ran out; look
+                # again after a while, or as soon as a job finishes
+                done, _ = wait(running, timeout=None if len(jobs) == free else WORKER_IDLE_SECONDS,
+                               return_when=FIRST_COMPLETED)
+                with self._lock:
+                    for future in done:
+                        del self._running[future]
+
+
+def connect(uri: Optional[str] = None):
+    from pymongo import MongoClient
+
+    client = MongoClient(uri or os.getenv('MONGODB_URI'))
+    return client, MongoWorkQueue(client[DATABASE])
+
+
+def index_registry(client):
+    """The index registry every node of the deployment reads"""
+    from index_versions import MongoIndexRegistry
+
+    return MongoIndexRegistry(client[DATABASE]['index_registry'])
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    from multi_mailbox import load_accounts
+    from metrics import configure_logging, start_metrics_server
+
+    parser = argparse.ArgumentParser(description="Distributed reply coordinator and workers")
+    commands = parser.add_subparsers(dest='command', required=True)
+    coordinator = commands.add_parser('coordinator', help="sync the mailboxes into the job queue")
+    coordinator.add_argument('accounts', nargs='?', default='accounts.json')
+    coordinator.add_argument('--interval-minutes', type=float, default=1)
+    worker = commands.add_parser('worker', help="answer queued jobs")
+    worker.add_argument('accounts', nargs='?', default='accounts.json')
+    worker.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY)
+    commands.add_parser('status', help="jobs per state")
+    commands.add_parser('dead', help="list the dead letters")
+    requeue = commands.add_parser('requeue', help="retry a dead-lettered message")
+    requeue.add_argument('mailbox')
+    requeue.add_argument('message_id')
+    args = parser.parse_args()
+
+    configure_logging()
+    client, queue = connect()
+    try:
+        if args.command in ('coordinator', 'worker'):
+            start_metrics_server()
+            accounts = load_accounts(args.accounts)
+            registry = index_registry(client)
+            supervisor = None
+            if args.command == 'coordinator':
+                # Listing and enqueueing only: no OpenAI or Pinecone client
+                from gmail_auto_response import GmailAutoReply
+                from transport import TransportConfig
+
+                transport = TransportConfig()
+                node = Coordinator([GmailAutoReply(token_path=account['token_path'], name=account.get('name'),
+                                                   transport=transport, index_registry=registry,
+                                                   work_queue=queue, sync_only=True)
+                                    for account in accounts], queue, args.interval_minutes)
+            else:
+                from multi_mailbox import MailboxSupervisor
+
+                supervisor = MailboxSupervisor(accounts, args.concurrency, work_queue=queue,
+                                               index_registry=registry)
+                node = Worker(supervisor, queue, args.concurrency)
+            signal.signal(signal.SIGTERM, lambda signum, frame: node.stop())
+            try:
+                node.run()
+            except KeyboardInterrupt:
+                node.stop()
+            finally:
+                if supervisor is not None:
+                    supervisor.http_client.close()
+        elif args.command == 'status':
+            print(json.dumps(queue.counts(), indent=2))
+        elif args.command == 'dead':
+            for entry in queue.dead_letters():
+                print(json.dumps(entry, default=str))
+        elif not queue.requeue(args.mailbox, args.message_id):
+            raise SystemExit(f"{args.message_id} is not a dead letter of {args.mailbox}")
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
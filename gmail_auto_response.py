@@ -6,25 +6,58 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from dotenv import load_dotenv
+import argparse
+import json
 import time
+import signal
 import datetime
-from typing import List, Dict
-from openai import OpenAI
-import re
-from langdetect import detect
-import httpx
-from pinecone import Pinecone
-from pinecone import ServerlessSpec
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple
 
-from bs4 import BeautifulSoup
+# The Google auth libraries, OpenAI, Pinecone and langdetect are imported
+# where they are first used: together they take well over a second to
+# import, and a restart should be ready to poll almost immediately.
 
 load_dotenv()
 
+from transport import (
+    CACHE_DIR,
+    TransportConfig,
+    build_openai_http_client,
+    build_gmail_service,
+    build_pinecone,
+    open_index,
+    read_cache,
+    write_cache,
+)
+from models import EmailMessage, EmailThread, latest_per_thread, message_body
+from cleaning import clean_body
+from language import LanguageDetector
+from retrieval import Retriever
+from openai_scheduler import OpenAIScheduler
+from prompts import reply_request
+from backlog import BACKLOG_THRESHOLD, BacklogBatcher
+from index_versions import INDEX_ALIAS, IndexVersion, create_index, open_registry
+from local_vectors import LOCAL_INDEX_DIR
+from work_queue import DRAFTED, FETCHED, SKIPPED, WorkQueue, worker_id
+from headers import MessageHeaders, header_map
+from sender_filter import METADATA_HEADERS, SenderFilter, email_address
+from metrics import (
+    MESSAGES,
+    TIME_TO_DRAFT_SECONDS,
+    API_CALLS,
+    api_call,
+    configure_logging,
+    get_logger,
+    record_cache,
+    start_metrics_server,
+    timed,
+)
+
+log = get_logger(__name__)
+
 # Gmail API scopes - Updated to include drafts
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly', 
           'https://www.googleapis.com/auth/gmail.compose']\
@@ -32,25 +65,136 @@ SCOPES = ['https://www.googleapis.com/auth/gmail.readonly',
 PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
 
 
+# The unversioned index; the one in use is the alias's active version
+INDEX_NAME = INDEX_ALIAS
+INDEX_METADATA_CACHE = os.path.join(CACHE_DIR, 'index_metadata.json')
+# Marks the drafts this script creates, so a later reply in the same thread
+# replaces them instead of adding a competing draft
+AUTO_DRAFT_HEADER = 'X-Auto-Reply-Draft'
+
+
+def create_openai_client(http_client):
+    """Create the OpenAI client on a (possibly shared) pooled HTTP client"""
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY not found in environment variables")
+
+    from openai import OpenAI
+
+    return OpenAI(api_key=api_key, http_client=http_client)
+
+
+def connect_index(pc, transport, index_name=INDEX_NAME, skip_index_check=False, version=None,
+                  writable=False):
+    """Create the Pinecone index if needed and return a handle to it.
+
+    A missing index is created with the dimension and metric of version
+    (by default those of the legacy index). The index host is cached on
+    disk after the first check. With skip_index_check the cached host is
+    used directly, which avoids the has_index and describe_index round
+    trips on restart.
+
+    With LOCAL_INDEX_DIR set, the quantized local copy of the index in
+    LOCAL_INDEX_DIR/index_name is loaded instead (see local_vectors.py);
+    it can be queried but not written to, so writers (the indexers) pass
+    writable=True and always get the Pinecone index.
+    """
+    if LOCAL_INDEX_DIR and not writable:
+        from local_vectors import LocalIndex
+
+        return LocalIndex.load(os.path.join(LOCAL_INDEX_DIR, index_name))
+
+    cached = read_cache(INDEX_METADATA_CACHE) or {}
+    metadata = cached.get(index_name)
+    if skip_index_check and metadata:
+        return open_index(pc, index_name, transport, host=metadata['host'])
+
+    create_index(pc, version or IndexVersion(index_name))
+    description = pc.describe_index(index_name)
+    cached[index_name] = {
+        'host': description.host,
+        'dimension': description.dimension,
+        'metric': description.metric
+    }
+    write_cache(INDEX_METADATA_CACHE, cached)
+    index = open_index(pc, index_name, transport, host=description.host)
+    log.info("index_connected", index=index_name)
+    return index
+
+
 class GmailAutoReply:
-    def __init__(self):
+    def __init__(self, token_path='token_client.json', name=None, openai_client=None,
+                 pc=None, index=None, embedding_cache=None, max_workers=1, transport=None,
+                 skip_index_check=False, openai_scheduler=None,
+                 backlog_threshold=BACKLOG_THRESHOLD, index_registry=None, work_queue=None,
+                 sync_only=False, concurrency_limit=None):
+        """Set up one mailbox.
+
+        The OpenAI client, Pinecone client, index and embedding cache can be
+        passed in so several mailboxes share them (see multi_mailbox.py),
+        and so can the OpenAI scheduler, which then budgets for all of them;
+        anything not passed is created from the transport config the first
+        time it is used, so construction itself makes no network calls.
+
+        A poll that finds backlog_threshold or more new messages sends them
+        through the Batch API instead (see backlog.py); 0 disables that.
+
+        Each thread gets one reply per poll, written for its latest message,
+        and a thread that already has a draft from this script gets that
+        draft replaced rather than a second one.
+
+        The index in use is the active version in index_registry; a switch
+        made by index_versions.py is picked up at the start of the next
+        poll, together with the embedding model that goes with it.
+
+        Every message to answer goes through work_queue (by default the
+        SQLite queue in CACHE_DIR) before any work is done on it, so
+        failed replies are retried and none is lost in a crash.
+
+        concurrency_limit, a semaphore shared by several mailboxes, bounds
+        the jobs they run at the same time; max_workers is this mailbox's
+        share of it.
+
+        A sync_only mailbox only lists its messages into work_queue for
+        other processes to answer (distributed.py's coordinator), and needs
+        no OpenAI key.
+        """
+        self.token_path = token_path
+        self.name = name or token_path
+        self.transport = transport or TransportConfig()
         self.service = None
         self.last_check_time = None
         self.processed_message_ids = set()
-        
-        # Initialize OpenAI
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
+        # id -> list entry of the messages whose download failed; tried again
+        # on the next poll even if they are no longer on the first page
+        self._unfetched = {}
+        # thread id -> (draft id, draft message id) of the drafts created here
+        self.thread_drafts = {}
+        # thread id -> ids of the draft messages seen in it by get_thread_history
+        self._thread_draft_messages = {}
+        self.embedding_cache = embedding_cache
+        self.max_workers = max_workers
+        self.backlog_threshold = backlog_threshold
+
+        self.skip_index_check = skip_index_check
+        self._openai_client = openai_client
+        self._scheduler = openai_scheduler
+        self._pc = pc
+        self._index = index
+        self.index_registry = index_registry or open_registry()
+        self._index_version = self.index_registry.active()
+        self._email_address = None
+        self.language_detector = LanguageDetector()
+        self._retriever = None
+        self._backlog = None
+        self._work_queue = work_queue
+        self.concurrency_limit = concurrency_limit
+        # Set by stop() (or SIGTERM): no new job is started once it is
+        self.stopping = threading.Event()
+        self.log = get_logger(__name__, mailbox=self.name)
+        self._client_lock = threading.Lock()
+        if not sync_only and openai_client is None and not os.getenv('OPENAI_API_KEY'):
             raise ValueError("OPENAI_API_KEY not found in environment variables")
-        
-        # Create OpenAI client with explicit configuration
-        self.openai_client = OpenAI(
-            api_key=api_key,
-            http_client=httpx.Client(
-                timeout=httpx.Timeout(30.0),
-                verify=True
-            )
-        )
         self.blocked_senders = {
             "fastbookads@gmail.com",
             "fastamzads@gmail.com",
@@ -65,30 +209,81 @@ class GmailAutoReply:
             "info@fastbookads.com",
             "update@global.metamail.com"
         }
+        self.blocked_domains = {
+            "global.metamail.com",
+            "facebookmail.com",
+        }
         self.blocked_patterns = ["noreply", "no-reply"]
+        # Built once from the lists above; rebuild it if they are changed
+        self.sender_filter = SenderFilter(self.blocked_senders, self.blocked_domains,
+                                          self.blocked_patterns)
+
+
+    @property
+    def openai_client(self):
+        if self._openai_client is None:
+            with self._client_lock:
+                if self._openai_client is None:
+                    self._openai_client = create_openai_client(
+                        build_openai_http_client(self.transport))
+        return self._openai_client
+
+    @property
+    def scheduler(self):
+        """Rate-limit-aware wrapper that every chat completion goes through"""
+        if self._scheduler is None:
+            client = self.openai_client
+            with self._client_lock:
+                if self._scheduler is None:
+                    self._scheduler = OpenAIScheduler(client)
+        return self._scheduler
+
+    @property
+    def pc(self):
+        if self._pc is None:
+            with self._client_lock:
+                if self._pc is None:
+                    self._pc = build_pinecone(PINECONE_API_KEY, self.transport)
+        return self._pc
+
+    @property
+    def index(self):
+        if self._index is None:
+            pc = self.pc
+            with self._client_lock:
+                if self._index is None:
+                    self._index = connect_index(pc, self.transport, index_name=self._index_version.name,
+                                                version=self._index_version,
+                                                skip_index_check=self.skip_index_check)
+        return self._index
+
+    @property
+    def work_queue(self):
+        if self._work_queue is None:
+            with self._client_lock:
+                if self._work_queue is None:
+                    self._work_queue = WorkQueue()
+        return self._work_queue
+
+    @property
+    def worker_id(self) -> str:
+        """Lease owner id of the calling thread"""
+        return worker_id()
+
+    @property
+    def email_address(self):
+        """Address of the authenticated mailbox, fetched on first use"""
+        if self._email_address is None:
+            profile = api_call('gmail', 'getProfile', self.service.users().getProfile(userId='me'))
+            self._email_address = profile['emailAddress']
+        return self._email_address
 
-        PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
-
-        index_name = "email-auto-response"
-        self.pc = Pinecone(api_key=PINECONE_API_KEY)
-
-        if not self.pc.has_index(index_name):
-            self.pc.create_index(
-                name=index_name,
-                vector_type="dense",
-                dimension=1024,
-                metric="dotproduct",
-                spec=ServerlessSpec(
-                    cloud="aws",
-                    region="us-east-1"
-                )
-            )
-        self.index =  self.pc.Index(index_name)
-        print(f"Connected to index '{index_name}'.")
     def refresh_access_token(self, creds):
         """Refresh the access token using refresh token"""
+        from google.auth.transport.requests import Request
+
         try:
-            print("Refreshing access token...")
+            self.log.info("token_refreshing")
             creds.refresh(Request())
             
             # Save updated token
@@ -102,36 +297,41 @@ class GmailAutoReply:
                 'expiry': creds.expiry.isoformat() if creds.expiry else None
             }
             
-            with open("token_client.json", 'a') as f:
+            with open(self.token_path, 'a') as f:
                 json.dump(token_data, f, indent=2)
             
-            print("Access token refreshed successfully")
+            self.log.info("token_refreshed")
             return creds
         except Exception as e:
-            print(f"Error refreshing token: {e}")
+            self.log.error("token_refresh_failed", error=str(e))
             return None
 
     def authenticate(self):
         """Authenticate with Gmail API"""
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         creds = None
-        # The file token.json stores the user's access and refresh tokens.
-        if os.path.exists('token_client.json'):
-            creds = Credentials.from_authorized_user_file('token_client.json', SCOPES)
+        # The token file stores the user's access and refresh tokens.
+        if os.path.exists(self.token_path):
+            creds = Credentials.from_authorized_user_file(self.token_path, SCOPES)
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
-                print("Token refreshed successfully")
+                self.log.info("token_refreshed")
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(
                     'credentials.json', SCOPES)
                 creds = flow.run_local_server(port=0)
             # Save the credentials for the next run
-            with open('token_client.json', 'w') as token:
+            with open(self.token_path, 'w') as token:
                 token.write(creds.to_json())
         
-        self.service = build('gmail', 'v1', credentials=creds)
-        print(self.service.users().getProfile(userId='me').execute()['emailAddress'])
+        # One service shared by all worker threads; each thread gets its own
+        # keep-alive connection underneath (see transport.build_gmail_service)
+        self.service = build_gmail_service(creds, self.transport)
         # results = self.service.users().drafts().list(
         #     userId='me',
         #     maxResults=10
@@ -151,10 +351,20 @@ class GmailAutoReply:
         #     message = draft_message['message']
         #     body = self.extract_message_body(message['payload'])
         #     print(body)
-        print("✅ Successfully authenticated with Gmail API")
+        self.log.info("authenticated")
         
-    def get_new_messages(self) -> List[Dict]:
-        """Get new messages from inbox since last check"""
+    def get_new_messages(self, all_pages: bool = False) -> List[EmailMessage]:
+        """Get new messages from inbox since last check.
+
+        Only the first page of 50 is listed unless all_pages is set, which
+        backlog mode uses to pick up every unread message at once.
+
+        Each message is first fetched with its sender headers only and
+        checked against sender_filter; only the ones worth answering are
+        then downloaded in full and added to the work queue. Messages the
+        queue already has are not fetched again, and one that fails to
+        download is tried again on the next poll.
+        """
         try:
             # Build query to get unread messages
             query = 'is:unread in:inbox'
@@ -166,223 +376,218 @@ class GmailAutoReply:
                 query += f' after:{date_str}'
             
             # Call the Gmail API
-            results = self.service.users().messages().list(
-                userId='me', q=query, maxResults=50).execute()
-            
-            messages = results.get('messages', [])
-            new_messages = []
-            
-            for message in messages:
-                msg_id = message['id']
-                
-                # Skip if we've already processed this message
-                if msg_id in self.processed_message_ids:
+            messages = []
+            page_token = None
+            while True:
+                with timed('list_messages'):
+                    results = api_call('gmail', 'messages.list', self.service.users().messages().list(
+                        userId='me', q=query, maxResults=50, pageToken=page_token))
+                messages.extend(results.get('messages', []))
+                page_token = results.get('nextPageToken')
+                if not all_pages or not page_token:
+                    break
+            listed = {message['id'] for message in messages}
+            # Oldest last, as in the listing
+            messages += [message for message_id, message in self._unfetched.items()
+                         if message_id not in listed]
+            candidates = [message for message in messages
+                          if message['id'] not in self.processed_message_ids]
+            queued = self.work_queue.known(self.name, [message['id'] for message in candidates])
+            candidates = [message for message in candidates if message['id'] not in queued]
+
+            # Headers first: newsletters and notifications stop here
+            headers = self.parallel_map(self._try_fetch(self._fetch_sender_headers), candidates)
+            # thread id -> (internal date, list entry) of its latest message
+            latest = {}
+            # thread id -> ids of its older unread messages
+            older = {}
+            for message, fetched_headers in zip(candidates, headers):
+                if fetched_headers is None:
+                    self._unfetched[message['id']] = message
                     continue
-                    
-                # Get full message details
-                msg_detail = self.service.users().messages().get(
-                    userId='me', id=msg_id, format='full').execute()
-                
-                # Extract message info
-                headers = msg_detail['payload'].get('headers', [])
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
-                date = next((h['value'] for h in headers if h['name'] == 'Date'), 'Unknown Date')
-                message_id = next((h['value'] for h in headers if h['name'] == 'Message-ID'), '')
-                
-                # Get message body
-                body = self.extract_message_body(msg_detail['payload'])
-                
-                message_info = {
-                    'id': msg_id,
-                    'subject': subject,
-                    'sender': sender,
-                    'date': date,
-                    'body': body,
-                    'thread_id': msg_detail['threadId'],
-                    'message_id': message_id
-                }
-                
-                new_messages.append(message_info)
-                self.processed_message_ids.add(msg_id)
-                
+                self._unfetched.pop(message['id'], None)
+                message_headers, internal_date = fetched_headers
+                reason = self.sender_filter.blocked(message_headers)
+                if reason:
+                    self.processed_message_ids.add(message['id'])
+                    self.log.info("sender_blocked", message_id=message['id'],
+                                  sender=email_address(message_headers.sender), rule=reason)
+                    MESSAGES.inc(outcome='blocked')
+                    continue
+                # An older unread message of a thread is answered by the
+                # reply to its latest one, which sees it in the thread history
+                thread_id = message['threadId']
+                current = latest.get(thread_id)
+                if current is None or internal_date > current[0]:
+                    if current is not None:
+                        older.setdefault(thread_id, []).append(current[1]['id'])
+                    latest[thread_id] = (internal_date, message)
+                else:
+                    older.setdefault(thread_id, []).append(message['id'])
+            wanted = [message for _, message in latest.values()]
+
+            # Full payloads only for the messages that will be answered
+            new_messages = []
+            fetched = self.parallel_map(self._try_fetch(self._fetch_message), [message['id'] for message in wanted])
+            for message, full in zip(wanted, fetched):
+                if full is None:
+                    self._unfetched[message['id']] = message
+                else:
+                    new_messages.append(full)
+            # Durable from here on: a crash no longer loses them
+            self.work_queue.enqueue(self.name, new_messages)
+            self.processed_message_ids.update(message.id for message in new_messages)
+            # The older messages are known to the queue once their thread's
+            # latest is in it, so a restart does not answer them again
+            superseded = [(message_id, message.thread_id) for message in new_messages
+                          for message_id in older.get(message.thread_id, ())]
+            if superseded:
+                self.work_queue.supersede(self.name, superseded)
+                self.processed_message_ids.update(message_id for message_id, _ in superseded)
+                MESSAGES.inc(len(superseded), outcome='coalesced')
             return new_messages
             
         except Exception as error:
-            print(f"❌ Error fetching messages: {error}")
+            self.log.error("fetch_messages_failed", error=str(error))
             return []
     
+    def _try_fetch(self, fetch):
+        """fetch, returning None (and logging) instead of raising"""
+        def attempt(item):
+            try:
+                return fetch(item)
+            except Exception as error:
+                self.log.warning("fetch_message_failed", message_id=item if isinstance(item, str) else item['id'],
+                                 error=str(error))
+                return None
+        return attempt
+
+    def _fetch_sender_headers(self, message) -> Tuple[MessageHeaders, int]:
+        """The sender headers of a listed message, and its internal date"""
+        with timed('get_metadata'):
+            metadata = api_call('gmail', 'messages.get', self.service.users().messages().get(
+                userId='me', id=message['id'], format='metadata', metadataHeaders=METADATA_HEADERS))
+        return MessageHeaders.from_message(metadata), int(metadata.get('internalDate', 0))
+
+    def _fetch_message(self, msg_id) -> EmailMessage:
+        with timed('get_message'):
+            msg_detail = api_call('gmail', 'messages.get', self.service.users().messages().get(
+                userId='me', id=msg_id, format='full'))
+        return EmailMessage.from_gmail(msg_detail)
+
+    def parallel_map(self, function, items):
+        """list(map(function, items)), on max_workers threads when there are several"""
+        if self.max_workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return list(executor.map(function, items))
+        return [function(item) for item in items]
+
     def extract_message_body(self, payload):
-        """Recursively extract the body text from message payload."""
-        def get_text_from_parts(parts):
-            for part in parts:
-                if part.get('mimeType') == 'text/plain' and 'data' in part.get('body', {}):
-                    return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-                elif part.get('mimeType', '').startswith('multipart/'):
-                    # Recursively search in subparts
-                    result = get_text_from_parts(part.get('parts', []))
-                    if result:
-                        return result
-            # Fallback: try to get text/html if no text/plain found
-            for part in parts:
-                if part.get('mimeType') == 'text/html' and 'data' in part.get('body', {}):
-                    return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-            return ""
-        
-        if 'parts' in payload:
-            return get_text_from_parts(payload['parts'])
-        else:
-            if payload.get('mimeType') == 'text/plain' and 'data' in payload.get('body', {}):
-                return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='replace')
-            elif payload.get('mimeType') == 'text/html' and 'data' in payload.get('body', {}):
-                return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='replace')
-        return ""
+        """Body text of a message payload (plain text preferred over HTML)."""
+        return message_body(payload)
     
     def clean_email_body(self, body: str) -> str:
         """Clean email body by removing signatures, quoted text, etc."""
-        # Remove common email signatures and quoted text
-        lines = body.split('\n')
-        cleaned_lines = []
-        
-        for line in lines:
-            # Skip lines that look like quoted text
-            if line.strip().startswith('>'):
-                break
-            # Skip lines that look like forwarded messages
-            if 'From:' in line and 'To:' in line:
-                break
-            
-            cleaned_lines.append(line)
-        
-        return '\n'.join(cleaned_lines).strip()
-    def vector_search(self,message):
-        embedding=self.pc.inference.embed(
-            model="llama-text-embed-v2",
-            inputs=[message],
-            parameters={"input_type": "passage", "truncate": "END"}
-        )
+        return clean_body(body)
+
+    def embed(self, text):
+        """Embed text, going through the shared embedding cache when there is one"""
+        version = self._index_version
+        # Mailboxes on different index versions share the cache
+        key = (version.model, text)
+        if self.embedding_cache is not None:
+            vector = self.embedding_cache.get(key)
+            record_cache('embedding', vector is not None)
+            if vector is not None:
+                return vector
+        API_CALLS.inc(service='pinecone', method='embed')
+        with timed('embed'):
+            embedding=self.pc.inference.embed(
+                model=version.model,
+                inputs=[text],
+                parameters=version.parameters
+            )
         vector=embedding[0]['values']
+        if self.embedding_cache is not None:
+            self.embedding_cache.put(key, vector)
+        return vector
 
-        response = self.index.query(
-            top_k=1,
-            vector=vector,
-            include_values=False,
-            include_metadata=True
-        )
+    def refresh_index(self):
+        """Move to the alias's active index version if it has been switched.
 
-        return response.matches
+        Called between polls, when no worker is using the old retriever.
+        """
+        version = self.index_registry.active()
+        if version == self._index_version:
+            return
+        with self._client_lock:
+            previous, self._index_version = self._index_version, version
+            self._index = None
+            self._retriever = None
+        self.log.info("index_switched", index=version.name, model=version.model,
+                      previous=previous.name)
+
+    @property
+    def retriever(self):
+        if self._retriever is None:
+            self._retriever = Retriever(self.index, self.embed)
+        return self._retriever
+
+    @property
+    def backlog(self):
+        if self._backlog is None:
+            self._backlog = BacklogBatcher(self)
+        return self._backlog
+
+    def vector_search(self, message, language=None):
+        """Matches for message above the score threshold, best first"""
+        return self.retriever.search(message, language)
     
-    def generate_ai_response(self, message: Dict, tone: str) -> str:
-        """Generate AI response using OpenAI, in the same language as the incoming email"""
-        try:
-            # Get the full conversation history
-            conversation_history = self.get_thread_history(message['thread_id'])
-            # print("Conversation history: ",conversation_history)
-            # Detect language from the latest message or the whole thread
-            reply_message=self.vector_search(message['body'])[0]['metadata']['reply_message']
-            print(reply_message)
-            try:
-                detected_lang = detect(message['body'])
-            except Exception:
-                detected_lang = 'it'  # fallback
-            if detected_lang.startswith('en'):
-                lang_instruction = "Reply in English."
-            else:
-                lang_instruction = "Rispondi in italiano."
-            print(detected_lang)
-            # with open('message_data.txt', 'r', encoding='utf-8') as f:
-            #     examples = f.read()
-
-            # Create a prompt for the AI
-            prompt = f"""
-You are an email response automation assistant and your real name is Noemi. Your task is to generate email responses that closely match the tone, style, and approach of a provided reference reply.
-
-Instructions:
-1. **Analyze the reference reply_message for:**
-   - Tone (formal, casual, friendly, professional, etc.)
-   - Writing style (concise, detailed, conversational, etc.)
-   - Language patterns and vocabulary choices
-   - Level of formality
-   - Emotional undertone (enthusiastic, neutral, empathetic, etc.)
-
-2. **Generate a response that:**
-   - Mirrors the same tone and style as the reply_message
-   - Uses same sentence structure and language patterns, vocabulary
-   - But use the same language of original message
-   - Maintains consistent formality level
-   - Feels natural and authentic in the established voice
-   - Never use name or signature at the end of message
-
-3. **Ensure the response:**
-   - Is contextually relevant to the original email
-   - Maintains the same level of detail as the reference
-   - Uses similar greeting and closing styles
-   - Follows the same communication approach
-
-CRITICAL RULES - FOLLOW EXACTLY:
-
-1. LANGUAGE CONSISTENCY
-• Response language: {lang_instruction}
-• NEVER mix languages in the same email
-• If language is Italian: ALL text must be Italian (greeting, body, closing)
-• If language is English: ALL text must be English (greeting, body, closing)
-
-2. NAME HANDLING
-• Extract sender's name from the conversation history only
-• If no clear name found, use generic greeting without name
-• NEVER use placeholder names like [Name] or {{Name}}
-• NEVER use names from the reference reply_message
-
-FORMATTING:
-• Plain text only
-• Natural paragraph breaks
-• Keep sentences conversational length
-• No bullet points unless listing specific steps
-• Never use names or sign at the end of message, only use greeting
-• No signature block
-
-
-Reference reply_message: {reply_message}
-Original email to respond to: {message['body']}
-Conversation history: {conversation_history}
-
-
-Generate a response that someone reading both messages would recognize as coming from the same person with the same communication style.
-    """
-
-            # Call OpenAI API   
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are the dedicated Email Specialist for Fast Book Ads (FBA‑Agent) and you reply from either fastbookads@gmail.com or info@fastbookads.com."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=500,
-                temperature=0.7
-            )
-
-            ai_response = response.choices[0].message.content.strip()
-            return ai_response
-        except Exception as error:
-            print(f"❌ Error generating AI response: {error}")
-            return "Thank you for your email. I have received your message and will get back to you soon."
+    def build_reply_request(self, message: EmailMessage) -> Dict:
+        """Chat completion request (model, messages, ...) for a reply to message.
+
+        Shared by the synchronous path and the Batch API backlog mode.
+        """
+        # Get the full conversation history
+        with timed('thread_history'):
+            conversation_history = self.get_thread_history(message.thread_id)
+        # print("Conversation history: ",conversation_history)
+        # Only what the sender wrote: the quoted history is already in
+        # conversation_history and would just add tokens and skew retrieval
+        text = self.clean_email_body(message.body) or message.body
+        # Detect language from the latest message or the whole thread
+        with timed('detect_language'):
+            detected_lang = self.language_detector.detect(text, thread_id=message.thread_id)
+        with timed('retrieve'):
+            reply_message = self.retriever.best_reply(text, language=detected_lang)
+        self.log.debug("reference_reply", message_id=message.id, reply=reply_message)
+        self.log.debug("language_detected", message_id=message.id, language=detected_lang)
+
+        # Static instructions first, so the provider can cache the prefix
+        return reply_request(detected_lang, reply_message, text, conversation_history)
+
+    def generate_reply(self, message: EmailMessage) -> str:
+        """The reply to message, written by OpenAI in the message's language.
+
+        Rate limits and transient errors are retried by the scheduler, so an
+        exception means they ran out.
+        """
+        request = self.build_reply_request(message)
+        with timed('generate'):
+            response = self.scheduler.chat(**request)
+        return response.choices[0].message.content.strip()
 
 
     
     def extract_email_address(self, sender: str) -> str:
         """Extract email address from sender string"""
-        # Use regex to extract email from "Name <email@domain.com>" format
-        match = re.search(r'<(.+?)>', sender)
-        if match:
-            return match.group(1)
-        # If no angle brackets, assume the whole string is the email
-        return sender.strip()
+        return email_address(sender)
     
-    def create_draft_reply(self, original_message: Dict, ai_response: str):
+    def create_draft_reply(self, original_message: EmailMessage, ai_response: str):
         """Create a draft reply using the AI-generated response"""
         try:
             # Extract sender email
-            sender_email = self.extract_email_address(original_message['sender'])
+            sender_email = self.extract_email_address(original_message.sender)
             
             # Create reply subject
             # subject = original_message['subject']
@@ -392,6 +597,7 @@ Generate a response that someone reading both messages would recognize as coming
             # Create the root message as 'related'
             message = MIMEMultipart('related')
             message['to'] = sender_email
+            message[AUTO_DRAFT_HEADER] = 'yes'
             # message['subject'] = subject
             
             # Alternative part for HTML (and optionally plain text)
@@ -428,7 +634,7 @@ Generate a response that someone reading both messages would recognize as coming
                     signature_img.add_header('Content-Disposition', 'inline', filename='signature.png')
                     message.attach(signature_img)
             else:
-                print("⚠️ Warning: signature.png not found in the directory")
+                self.log.warning("signature_missing", path=signature_path)
             
             # Convert to raw message
             raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
@@ -437,165 +643,288 @@ Generate a response that someone reading both messages would recognize as coming
             draft_body = {
                 'message': {
                     'raw': raw_message,
-                    'threadId': original_message['thread_id']
+                    'threadId': original_message.thread_id
                 }
             }
             
             # Save as draft
-            draft = self.service.users().drafts().create(
-                userId='me', body=draft_body).execute()
+            with timed('create_draft'):
+                draft = self.save_draft(original_message.thread_id, draft_body)
             
-            print(f"✅ Draft created for message from {sender_email}")
-            # print(f"   Subject: {subject}")
-            print(f"   Draft ID: {draft['id']}")
+            self.log.info("draft_created", message_id=original_message.id,
+                          sender=sender_email, draft_id=draft['id'])
             return draft
             
         except Exception as error:
-            print(f"❌ Error creating draft: {error}")
+            self.log.error("create_draft_failed", message_id=original_message.id, error=str(error))
             return None
     
-    def process_new_messages(self, messages: List[Dict]):
-        """Process new messages and generate AI replies"""
-        if not messages:
+    def save_draft(self, thread_id, draft_body):
+        """Replace the thread's auto draft with draft_body, or create one"""
+        draft_id = self.auto_draft_id(thread_id)
+        draft = None
+        if draft_id:
+            from googleapiclient.errors import HttpError
+
+            try:
+                draft = api_call('gmail', 'drafts.update', self.service.users().drafts().update(
+                    userId='me', id=draft_id, body={'id': draft_id, **draft_body}))
+                MESSAGES.inc(outcome='draft_replaced')
+            except HttpError as error:
+                # Sent or discarded in the meantime
+                if error.resp.status != 404:
+                    raise
+        if draft is None:
+            draft = api_call('gmail', 'drafts.create', self.service.users().drafts().create(
+                userId='me', body=draft_body))
+        self.thread_drafts[thread_id] = (draft['id'], draft.get('message', {}).get('id'))
+        return draft
+
+    def auto_draft_id(self, thread_id):
+        """Id of the draft this script left in thread_id, if it is still there
+        and untouched; None otherwise.
+
+        Drafts created by this process are remembered; after a restart the
+        thread's drafts (as seen by get_thread_history) are looked up and
+        the one carrying AUTO_DRAFT_HEADER is used.
+        """
+        draft_messages = self._thread_draft_messages.pop(thread_id, ())
+        known = self.thread_drafts.get(thread_id)
+        try:
+            if known:
+                draft_id, message_id = known
+                current = api_call('gmail', 'drafts.get', self.service.users().drafts().get(
+                    userId='me', id=draft_id, format='minimal'))
+                # Gmail gives an edited draft a new message id: leave it alone
+                if current.get('message', {}).get('id') == message_id:
+                    return draft_id
+                del self.thread_drafts[thread_id]
+                return None
+            if draft_messages:
+                return self._find_auto_draft(draft_messages)
+        except Exception as error:
+            # 404: the draft was sent or discarded, which is the usual case
+            if getattr(getattr(error, 'resp', None), 'status', None) != 404:
+                self.log.warning("draft_lookup_failed", thread_id=thread_id, error=str(error))
+            self.thread_drafts.pop(thread_id, None)
+        return None
+
+    def _find_auto_draft(self, draft_messages):
+        page_token = None
+        while True:
+            results = api_call('gmail', 'drafts.list', self.service.users().drafts().list(
+                userId='me', maxResults=100, pageToken=page_token))
+            for draft in results.get('drafts', []):
+                if draft['message']['id'] not in draft_messages:
+                    continue
+                detail = api_call('gmail', 'drafts.get', self.service.users().drafts().get(
+                    userId='me', id=draft['id'], format='metadata'))
+                headers = header_map(detail['message'].get('payload', {}).get('headers', []))
+                if AUTO_DRAFT_HEADER.lower() in headers:
+                    return draft['id']
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return None
+
+    def process_new_messages(self, messages: List[EmailMessage]):
+        """Process new messages and generate AI replies, then retry the
+        queued jobs whose backoff has elapsed"""
+        if messages:
+            self._process_new_messages(messages)
+        self.drain()
+
+    def _process_new_messages(self, messages: List[EmailMessage]):
+        self.log.info("messages_found", count=len(messages))
+
+        # All of them, so the queue knows the older ones of a thread as
+        # superseded by its latest: a later poll, a restart or a retry does
+        # not answer them again
+        self.work_queue.enqueue(self.name, messages)
+        # One reply per thread, for its latest message
+        latest = latest_per_thread(messages)
+        if len(latest) < len(messages):
+            MESSAGES.inc(len(messages) - len(latest), outcome='coalesced')
+            self.log.info("messages_coalesced", count=len(messages), threads=len(latest))
+            messages = latest
+
+        if self.backlog_threshold and len(messages) >= self.backlog_threshold:
+            self.backlog.submit(messages)
             return
-            
-        print(f"\n📧 Found {len(messages)} new message(s):")
-        print("-" * 50)
-        
-        for msg in messages:
-            sender_email = self.extract_email_address(msg['sender'])
-            if self.is_blocked_sender(sender_email):
-                print(f"⏩ Skipping auto-reply for blocked sender: {sender_email}")
-                continue
-            # print(f"From: {msg['sender']}")
-            # print(f"Subject: {msg['subject']}")
-            # print(f"Date: {msg['date']}")
-            # print(f"Body Preview: {msg['body'][:100]}...")
-            # print(f"Message ID: {msg['id']}")
-            
-            # Generate AI response
-            tone = extract_tone_from_examples("message_data.txt", self.openai_client)
-            print("🤖 Generating AI response...")
-            ai_response = self.generate_ai_response(msg, tone)
-            print(ai_response)
-            # Create draft reply
-            print("📝 Creating draft reply...")
-            draft = self.create_draft_reply(msg, ai_response)
-            
-            if draft:
-                print(f"✅ Draft saved successfully!")
-                print(f"AI Response Preview: {ai_response}")
-            
-            print("-" * 50)
-    
+
+        self.parallel_map(self.process_message, messages)
+
+    def drain(self):
+        """Run the due jobs left in the queue: retries, and work a previous
+        process did not finish"""
+        while not self.stopping.is_set():
+            jobs = self.work_queue.claim(self.name, self.worker_id, limit=max(1, self.max_workers) * 2)
+            if not jobs:
+                return
+            self.parallel_map(self.run_job, jobs)
+
+    def process_message(self, msg: EmailMessage):
+        """Generate an AI reply for one message and save it as a draft"""
+        if self.stopping.is_set():
+            return
+        self.work_queue.enqueue(self.name, [msg])
+        jobs = self.work_queue.claim(self.name, self.worker_id, message_ids=[msg.id])
+        if not jobs:
+            # Done, waiting for a retry, batched or leased by another worker
+            self.log.debug("message_not_claimed", message_id=msg.id)
+            return
+        self.run_job(jobs[0])
+
+    def run_job(self, job):
+        """Take a claimed job through its remaining stages"""
+        if self.concurrency_limit is None:
+            return self._run_job(job)
+        with self.concurrency_limit:
+            return self._run_job(job)
+
+    def _run_job(self, job):
+        msg = job.message
+        sender_email = self.extract_email_address(msg.sender)
+        if self.is_blocked_sender(sender_email):
+            self.log.info("sender_blocked", message_id=msg.id, sender=sender_email)
+            MESSAGES.inc(outcome='blocked')
+            self.work_queue.advance(job, SKIPPED)
+            return
+        try:
+            if job.state == FETCHED:
+                ai_response = self.generate_reply(msg)
+                self.log.debug("reply_generated", message_id=msg.id, reply=ai_response)
+                # Kept, so a failed draft does not pay for the reply again
+                self.work_queue.save_reply(job, ai_response)
+            if not self.create_draft_reply(msg, job.reply):
+                raise RuntimeError("draft not saved")
+        except Exception as error:
+            dead = self.work_queue.fail(job, str(error))
+            MESSAGES.inc(outcome='dead_letter' if dead else 'failed')
+            return
+        self.work_queue.advance(job, DRAFTED)
+        MESSAGES.inc(outcome='drafted')
+        if msg.internal_date:
+            TIME_TO_DRAFT_SECONDS.observe(time.time() - msg.internal_date / 1000)
+
     
+    def stop(self):
+        """Finish the jobs in progress, start no new ones and end monitoring"""
+        self.stopping.set()
+
     def start_monitoring(self, interval_minutes: int = 1):
-        """Start monitoring Gmail inbox for new messages"""
-        print(f"🚀 Starting Gmail auto-reply monitoring (checking every {interval_minutes} minute(s))")
-        print("📝 AI responses will be saved as drafts for review")
-        print("Press Ctrl+C to stop monitoring")
-        
+        """Start monitoring Gmail inbox for new messages, until interrupted
+        or stopped by SIGTERM; a failed poll is logged and the next one
+        runs as usual"""
+        self.log.info("monitoring_started", interval_minutes=interval_minutes)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
         # Set initial check time to now
         self.last_check_time = datetime.datetime.now()
-        
+
         try:
-            while True:
-                current_time = datetime.datetime.now()
-                print(f"\n🔍 Checking for new messages at {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
-                
-                # Get new messages
-                new_messages = self.get_new_messages()
-                
-                # Process new messages and generate AI replies
-                self.process_new_messages(new_messages)
-                
-                if not new_messages:
-                    print("✅ No new messages found")
-                
-                # Update last check time
-                self.last_check_time = current_time
-                
+            while not self.stopping.is_set():
+                try:
+                    self.poll_once()
+                except Exception as error:
+                    self.log.exception("monitoring_failed", error=str(error))
 
                 # Wait for the specified interval
-                print(f"⏰ Waiting {interval_minutes} minute(s) until next check...")
-                time.sleep(interval_minutes * 10)
-                
+                self.stopping.wait(interval_minutes * 10)
         except KeyboardInterrupt:
-            print("\n🛑 Monitoring stopped by user")
-        except Exception as error:
-            print(f"❌ Error during monitoring: {error}")
+            self.stop()
+        self.log.info("monitoring_stopped")
+
+    def poll_once(self):
+        """Run one check of the inbox: fetch new messages and draft replies"""
+        current_time = datetime.datetime.now()
+
+        self.refresh_index()
+
+        # Draft the replies of any backlog batch that has finished
+        if self.backlog.pending:
+            with timed('batch_collect'):
+                self.backlog.collect()
+
+        # Get new messages
+        with timed('fetch'):
+            new_messages = self.get_new_messages()
+        
+        # Process new messages and generate AI replies
+        with timed('process'):
+            self.process_new_messages(new_messages)
+        
+        self.log.debug("poll_finished", new_messages=len(new_messages))
+
+        # Forget the jobs finished long ago (at most once an hour)
+        self.work_queue.purge_due()
+        
+        # Update last check time
+        self.last_check_time = current_time
 
     def is_blocked_sender(self, sender_email: str) -> bool:
-        email_lower = sender_email.lower()
-        if email_lower in self.blocked_senders:
-            return True
-        for pattern in self.blocked_patterns:
-            if pattern in email_lower:
-                return True
-        return False
+        return self.sender_filter.blocked_address(sender_email) is not None
 
     def get_thread_history(self, thread_id):
         """Fetch all messages in a thread and build a conversation history string."""
         try:
-            thread = self.service.users().threads().get(userId='me', id=thread_id, format='full').execute()
-            messages = thread.get('messages', [])
+            thread = EmailThread.from_gmail(api_call('gmail', 'threads.get', self.service.users().threads().get(
+                userId='me', id=thread_id, format='full')))
             history = []
-            print(len(messages))
-            for msg in messages:
-                headers = msg['payload'].get('headers', [])
-                sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
-                date = next((h['value'] for h in headers if h['name'] == 'Date'), 'Unknown Date')
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                body = self.extract_message_body(msg['payload'])
+            # Our own unsent draft is not part of the conversation; note it
+            # so the new reply can replace it
+            draft_messages = [msg.id for msg in thread if msg.has_label('DRAFT')]
+            if draft_messages:
+                self._thread_draft_messages[thread_id] = draft_messages
+            for msg in thread:
+                if msg.has_label('DRAFT'):
+                    continue
                 # Optionally clean the body
-                print("Body----------- "+body)
-                clean_body = self.clean_email_body(body)
-                history.append(f"From: {sender}\nDate: {date}\nSubject: {subject}\nMessage:\n{clean_body}\n")
+                cleaned = self.clean_email_body(msg.body)
+                history.append(f"From: {msg.sender}\nDate: {msg.date}\nSubject: {msg.subject}\nMessage:\n{cleaned}\n")
             return "\n---\n".join(history)
         except Exception as error:
-            print(f"❌ Error fetching thread history: {error}")
+            self.log.error("thread_history_failed", thread_id=thread_id, error=str(error))
             return ""
 
-def extract_tone_from_examples(file_path, openai_client):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        examples = f.read()
-    prompt = (
-       """Analyze the writing style and tone of the person who is writing from the "fastbookads@gmail.com" email address in the provided email chat history. Pay attention to:
-        1. Level of formality
-        2. Greeting and closing styles
-        3. Sentence structure and length
-        4. Use of punctuation and formatting
-        5. Vocabulary choices and any recurring phrases
-        6. Level of directness/indirectness
-        7. Use of questions vs. statements
-        8. Emotional tone (friendly, professional, casual, etc.)
-        9. Any distinctive writing patterns or quirks"""
-        f"{examples}\n\nTone description:"
-    )
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are an expert at analyzing writing tone."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=30,
-        temperature=0.2
-    )
-    return response.choices[0].message.content.strip()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Draft AI replies to new Gmail messages")
+    parser.add_argument('--skip-index-check', action='store_true',
+                        default=os.getenv('SKIP_INDEX_CHECK') == '1',
+                        help="connect to the Pinecone index using the cached host "
+                             "instead of checking that it exists")
+    parser.add_argument('--backlog', action='store_true',
+                        help="send every unread message through the OpenAI Batch API "
+                             "before monitoring; drafts appear when the batch completes")
+    parser.add_argument('--backlog-threshold', type=int, default=BACKLOG_THRESHOLD,
+                        help="use the Batch API for any poll with at least this many "
+                             "new messages (0 = never)")
+    return parser.parse_args(argv)
+
 
 def main():
     """Main function to run the Gmail auto-reply system"""
-    auto_reply = GmailAutoReply()
+    args = parse_args()
+    configure_logging()
+    start_metrics_server()
     
     try:
+        auto_reply = GmailAutoReply(skip_index_check=args.skip_index_check,
+                                    backlog_threshold=args.backlog_threshold)
+
+
         # Authenticate with Gmail
         auto_reply.authenticate()
+
+        # Catch up through the Batch API; monitoring collects the results
+        if args.backlog:
+            auto_reply.backlog.submit(auto_reply.get_new_messages(all_pages=True))
         
         # Start monitoring (check every 2 minutes to avoid rate limits)
         auto_reply.start_monitoring(interval_minutes=5)
         
     except Exception as error:
-        print(f"❌ Error: {error}")
+        log.error("startup_failed", error=str(error))
         print("\nMake sure you have:")
         print("1. Created a Google Cloud Project")
         print("2. Enabled the Gmail API")
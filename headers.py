@@ -0,0 +1,129 @@
+"""Header parsing for Gmail API message payloads.
+
+Gmail returns headers as a list of {'name': ..., 'value': ...} dicts.
+Looking each one up with its own next(...) scan costs a pass over the list
+per header, and the scans disagreed on case. header_map() instead walks the
+list once into a case-insensitive dict, and MessageHeaders reads the fields
+the project uses in a single pass, with RFC 2047 encoded words decoded and
+Date parsed into a datetime.
+"""
+import sys
+import datetime
+from functools import lru_cache
+from dataclasses import dataclass
+from email.errors import HeaderParseError
+from email.header import decode_header, make_header
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional
+
+
+def decode_value(value: str) -> str:
+    """Decode RFC 2047 encoded words (=?utf-8?q?...?=); plain values pass through"""
+    if '=?' not in value:
+        return value
+    return _decode_words(value)
+
+
+# Every message in a thread repeats the same encoded Subject (and usually
+# From/To), and decoding one costs far more than the whole header pass
+@lru_cache(maxsize=4096)
+def _decode_words(value):
+    try:
+        return str(make_header(decode_header(value)))
+    except (HeaderParseError, LookupError, UnicodeDecodeError):
+        # Unknown charset or a broken encoded word: keep the raw text
+        return value
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    """Date header as a datetime, or None when missing or malformed"""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def header_map(headers: List[Dict]) -> Dict[str, str]:
+    """Lower-cased header name -> raw value for every header, in one pass.
+
+    Like the scans it replaces, the first occurrence of a repeated header
+    (e.g. Received) wins.
+    """
+    return {header['name'].lower(): header['value'] for header in reversed(headers)}
+
+
+# Lower-cased header name -> MessageHeaders field
+FIELDS = {
+    'subject': 'subject',
+    'from': 'sender',
+    'to': 'to',
+    'date': 'date',
+    'message-id': 'message_id',
+    'in-reply-to': 'in_reply_to',
+    'references': 'references',
+    'list-unsubscribe': 'list_unsubscribe',
+    'precedence': 'precedence',
+    'auto-submitted': 'auto_submitted',
+}
+# Fields that may carry RFC 2047 encoded words; they repeat across a
+# mailbox (same few senders, same subject down a thread) so are interned
+ENCODED_FIELDS = ('subject', 'sender', 'to')
+# Exact spelling seen on the wire ('Message-ID', 'Message-Id', ...) -> field,
+# or '' for headers we don't keep. Filled as spellings show up, so the
+# common case costs one dict lookup per header instead of a .lower().
+_field_for = {}
+_MAX_SPELLINGS = 4096
+
+
+def _field(name):
+    field = FIELDS.get(name.lower(), '')
+    if len(_field_for) < _MAX_SPELLINGS:
+        _field_for[name] = field
+    return field
+
+
+@dataclass(slots=True)
+class MessageHeaders:
+    """The headers of one message the project reads, decoded.
+
+    Missing headers are empty strings, so callers can apply their own
+    placeholder with `or`. sent_at parses Date on access.
+    """
+    subject: str = ''
+    sender: str = ''
+    to: str = ''
+    date: str = ''
+    message_id: str = ''
+    in_reply_to: str = ''
+    references: str = ''
+    list_unsubscribe: str = ''
+    precedence: str = ''
+    auto_submitted: str = ''
+
+    @property
+    def sent_at(self) -> Optional[datetime.datetime]:
+        return parse_date(self.date)
+
+    @classmethod
+    def from_headers(cls, headers: List[Dict]) -> 'MessageHeaders':
+        values = {}
+        lookup = _field_for.get
+        # Reversed, so the first occurrence of a repeated header wins
+        for header in reversed(headers):
+            field = lookup(header['name'])
+            if field is None:
+                field = _field(header['name'])
+            if field:
+                values[field] = header['value']
+        for field in ENCODED_FIELDS:
+            value = values.get(field)
+            if value:
+                values[field] = sys.intern(decode_value(value))
+        return cls(**values)
+
+    @classmethod
+    def from_message(cls, message: Dict) -> 'MessageHeaders':
+        """Headers of a Gmail API message resource (format full or metadata)"""
+        return cls.from_headers(message.get('payload', {}).get('headers', []))
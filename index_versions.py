@@ -0,0 +1,377 @@
+"""Versioned reply indexes with an alias that can be switched and rolled back.
+
+The daemon used to talk to one hard-coded index, email-auto-response, with a
+hard-coded dimension and embedding model, so changing the model meant
+emptying and refilling the index it was serving from. Now:
+
+- every index is a version of an alias (email-auto-response-v2, -v3, ...)
+  built for one embedding model. The model, dimension and metric are in
+  the registry and, where the Pinecone client supports it, in the index's
+  tags;
+- the registry (a JSON file in CACHE_DIR, replaced atomically) says which
+  version of the alias is active and which one was active before it;
+- `rebuild` creates a new version and fills it in bulk from the MongoDB
+  archive (or a Parquet snapshot embedded with the same model) while the
+  active one keeps serving. It then waits until Pinecone reports every
+  vector and switches the alias;
+- GmailAutoReply checks the registry before each poll and moves to the new
+  version (index and query model together) without a restart;
+- `rollback` switches back to the previous version, which is kept until
+  `prune` deletes it.
+
+The file only serves the processes of one host. With INDEX_REGISTRY=mongo
+(always, in distributed.py's mode) the registry is a document of the
+index_registry collection instead, which every node reads;
+`INDEX_REGISTRY=mongo python index_versions.py publish` copies the
+file's entry there once.
+
+With no registry, the alias resolves to the original unversioned index
+and model, so existing deployments keep working unchanged.
+
+Usage: python index_versions.py status
+       python index_versions.py rebuild [--model llama-text-embed-v2] [--snapshot DIR]
+                                        [--no-activate]
+       python index_versions.py activate NAME | rollback | prune [--keep 2] | publish
+"""
+import os
+import time
+import argparse
+import datetime
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from transport import CACHE_DIR, read_cache, write_cache
+from metrics import get_logger
+
+log = get_logger(__name__)
+
+INDEX_ALIAS = os.getenv('INDEX_ALIAS', 'email-auto-response')
+REGISTRY_PATH = os.path.join(CACHE_DIR, 'index_registry.json')
+# 'file' (REGISTRY_PATH) or 'mongo' (the index_registry collection)
+INDEX_REGISTRY = os.getenv('INDEX_REGISTRY', 'file')
+# How long a MongoIndexRegistry trusts the entry it last read
+REGISTRY_REFRESH_SECONDS = float(os.getenv('INDEX_REGISTRY_REFRESH_SECONDS', '10'))
+# Pinecone inference models the indexes can be built with
+EMBED_MODELS = {
+    'llama-text-embed-v2': {'dimension': 1024, 'metric': 'dotproduct',
+                            'parameters': {'input_type': 'passage', 'truncate': 'END'}},
+    'multilingual-e5-large': {'dimension': 1024, 'metric': 'cosine',
+                              'parameters': {'input_type': 'passage', 'truncate': 'END'}},
+}
+DEFAULT_MODEL = 'llama-text-embed-v2'
+# How long rebuild waits for the new version to report every vector
+READY_TIMEOUT_SECONDS = 600
+
+
+@dataclass(slots=True, frozen=True)
+class IndexVersion:
+    """One physical index and the embedding model its vectors come from"""
+    name: str
+    model: str = DEFAULT_MODEL
+    dimension: int = 1024
+    metric: str = 'dotproduct'
+    created_at: str = ''
+
+    @property
+    def parameters(self) -> Dict:
+        return EMBED_MODELS.get(self.model, EMBED_MODELS[DEFAULT_MODEL])['parameters']
+
+    @classmethod
+    def for_model(cls, name: str, model: str) -> 'IndexVersion':
+        spec = EMBED_MODELS[model]
+        return cls(name, model, spec['dimension'], spec['metric'],
+                   datetime.datetime.now(datetime.timezone.utc).isoformat())
+
+
+class IndexRegistry:
+    """alias -> active / previous version, in a JSON file replaced atomically.
+
+    Readers only ever see the old or the new file, so switching the alias is
+    a single os.replace. active() re-reads the file only when its mtime
+    changes, which keeps the per-poll check to one stat call.
+    """
+
+    def __init__(self, path: str = REGISTRY_PATH, alias: str = INDEX_ALIAS):
+        self.path = path
+        self.alias = alias
+        self._mtime = None
+        self._entry = None
+
+    def _load(self) -> Dict:
+        return read_cache(self.path) or {}
+
+    def _save(self, registry: Dict):
+        write_cache(self.path, registry)
+
+    def entry(self) -> Dict:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._mtime or self._entry is None:
+            self._entry = self._load().get(self.alias) or {}
+            self._mtime = mtime
+        return self._entry
+
+    def versions(self) -> List[IndexVersion]:
+        return [IndexVersion(**version) for version in self.entry().get('versions', {}).values()]
+
+    def version(self, name: str) -> IndexVersion:
+        found = self.entry().get('versions', {}).get(name)
+        if found is None:
+            raise KeyError(f"{name} is not a version of {self.alias}")
+        return IndexVersion(**found)
+
+    def active(self) -> IndexVersion:
+        """The version queries should go to; the legacy unversioned index if none"""
+        name = self.entry().get('active')
+        return self.version(name) if name else IndexVersion(self.alias)
+
+    def previous(self) -> Optional[IndexVersion]:
+        name = self.entry().get('previous')
+        return self.version(name) if name else None
+
+    def next_name(self) -> str:
+        numbers = [int(version.name.rsplit('-v', 1)[1]) for version in self.versions()
+                   if version.name.rsplit('-v', 1)[-1].isdigit()]
+        # v1 is the legacy index the alias started as
+        return f"{self.alias}-v{max(numbers, default=1) + 1}"
+
+    def add(self, version: IndexVersion):
+        registry = self._load()
+        entry = registry.setdefault(self.alias, {})
+        versions = entry.setdefault('versions', {})
+        if not versions:
+            # Keep the legacy index as a version, so it can be rolled back to
+            versions[self.alias] = asdict(IndexVersion(self.alias))
+            entry.setdefault('active', self.alias)
+        versions[version.name] = asdict(version)
+        self._save(registry)
+
+    def activate(self, name: str):
+        registry = self._load()
+        entry = registry.get(self.alias, {})
+        if name not in entry.get('versions', {}):
+            raise KeyError(f"{name} is not a version of {self.alias}")
+        if entry.get('active') != name:
+            entry['previous'] = entry.get('active')
+            entry['active'] = name
+            self._save(registry)
+        log.info("index_activated", alias=self.alias, index=name, previous=entry.get('previous'))
+
+    def rollback(self) -> str:
+        """Switch back to the previously active version; returns its name"""
+        previous = self.entry().get('previous')
+        if not previous:
+            raise ValueError(f"{self.alias} has no previous version to roll back to")
+        self.activate(previous)
+        return previous
+
+    def remove(self, name: str):
+        registry = self._load()
+        entry = registry.get(self.alias, {})
+        if name in (entry.get('active'), entry.get('previous')):
+            raise ValueError(f"{name} is active or the rollback target")
+        entry.get('versions', {}).pop(name, None)
+        self._save(registry)
+
+
+class MongoIndexRegistry(IndexRegistry):
+    """IndexRegistry kept in a MongoDB collection, one document per alias,
+    shared by the nodes of every host.
+
+    active() re-reads the document at most every refresh_seconds, so a
+    switch reaches the workers within that time.
+    """
+
+    def __init__(self, collection, alias: str = INDEX_ALIAS,
+                 refresh_seconds: float = REGISTRY_REFRESH_SECONDS):
+        super().__init__(path=None, alias=alias)
+        self.collection = collection
+        self.refresh_seconds = refresh_seconds
+        self._read_at = None
+
+    def _load(self) -> Dict:
+        document = self.collection.find_one({'_id': self.alias})
+        if document is None:
+            return {}
+        document.pop('_id')
+        return {self.alias: document}
+
+    def _save(self, registry: Dict):
+        self.collection.replace_one({'_id': self.alias}, registry.get(self.alias, {}), upsert=True)
+        self._entry = None
+
+    def entry(self) -> Dict:
+        now = time.monotonic()
+        if self._entry is None or now - self._read_at >= self.refresh_seconds:
+            self._entry = self._load().get(self.alias) or {}
+            self._read_at = now
+        return self._entry
+
+
+_registry_client = None
+
+
+def open_registry(alias: str = INDEX_ALIAS) -> IndexRegistry:
+    """The registry INDEX_REGISTRY selects"""
+    global _registry_client
+
+    if INDEX_REGISTRY == 'file':
+        return IndexRegistry(alias=alias)
+    if INDEX_REGISTRY != 'mongo':
+        raise ValueError(f"unsupported INDEX_REGISTRY {INDEX_REGISTRY!r}")
+    if _registry_client is None:
+        from pymongo import MongoClient
+
+        _registry_client = MongoClient(os.getenv('MONGODB_URI'))
+    return MongoIndexRegistry(_registry_client['email_history']['index_registry'], alias)
+
+
+def create_index(pc, version: IndexVersion, alias: str = INDEX_ALIAS):
+    """Create the Pinecone index for version (if missing), tagged with its model"""
+    if pc.has_index(version.name):
+        return
+    from pinecone import ServerlessSpec
+
+    kwargs = dict(name=version.name, vector_type="dense", dimension=version.dimension,
+                  metric=version.metric, spec=ServerlessSpec(cloud="aws", region="us-east-1"))
+    try:
+        pc.create_index(**kwargs, tags={'alias': alias, 'embed_model': version.model})
+    except TypeError:
+        # Index tags need a newer client; the registry still records the model
+        pc.create_index(**kwargs)
+
+
+def vector_count(index) -> int:
+    stats = index.describe_index_stats()
+    return stats['total_vector_count'] if isinstance(stats, dict) else stats.total_vector_count
+
+
+def wait_until_ready(index, expected: int, timeout: float = READY_TIMEOUT_SECONDS, poll: float = 5.0):
+    """Pinecone applies upserts asynchronously: wait until the index reports them all"""
+    deadline = time.monotonic() + timeout
+    while True:
+        count = vector_count(index)
+        if count >= expected:
+            return count
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"index reports {count} of {expected} vectors after {timeout:.0f}s")
+        time.sleep(poll)
+
+
+def rebuild(pc, transport, registry: IndexRegistry, model: str = DEFAULT_MODEL, collection=None,
+            snapshot: Optional[str] = None, activate: bool = True) -> IndexVersion:
+    """Build a new version of the alias for model and (by default) switch to it.
+
+    The vectors come from a corpus snapshot when one is given (it must be
+    embedded with model), else from the MongoDB archive collection. The
+    active version serves queries throughout; a failure leaves it active.
+    """
+    from indexing import ArchiveIndexer
+    from gmail_auto_response import connect_index
+
+    version = IndexVersion.for_model(registry.next_name(), model)
+    create_index(pc, version, registry.alias)
+    registry.add(version)
+    index = connect_index(pc, transport, index_name=version.name, version=version, writable=True)
+    log.info("index_rebuild_started", index=version.name, model=model,
+             source='snapshot' if snapshot else 'archive')
+    if snapshot:
+        from corpus_snapshot import import_snapshot
+
+        count = import_snapshot(index, snapshot, model=model)
+    else:
+        count = ArchiveIndexer(collection, pc, index, version.name, model=model).run(full=True)
+    wait_until_ready(index, count)
+    log.info("index_rebuild_finished", index=version.name, vectors=count)
+    if activate:
+        registry.activate(version.name)
+    return version
+
+
+def prune(pc, registry: IndexRegistry, keep: int = 2) -> List[str]:
+    """Delete all but the newest keep versions, never the active or previous one"""
+    entry = registry.entry()
+    protected = {entry.get('active'), entry.get('previous')}
+    versions = sorted(registry.versions(), key=lambda version: version.created_at, reverse=True)
+    deleted = []
+    for version in versions[keep:]:
+        if version.name in protected:
+            continue
+        if pc.has_index(version.name):
+            pc.delete_index(version.name)
+        registry.remove(version.name)
+        deleted.append(version.name)
+    log.info("index_versions_pruned", alias=registry.alias, deleted=deleted)
+    return deleted
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    from transport import TransportConfig, build_pinecone
+    from metrics import configure_logging
+
+    parser = argparse.ArgumentParser(description="Versioned reply indexes")
+    parser.add_argument('--alias', default=INDEX_ALIAS)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help="list the versions and the active one")
+    build = commands.add_parser('rebuild', help="build a new version and switch to it")
+    build.add_argument('--model', default=DEFAULT_MODEL, choices=sorted(EMBED_MODELS))
+    build.add_argument('--snapshot', help="corpus_snapshot.py dataset to load instead of MongoDB")
+    build.add_argument('--no-activate', action='store_true', help="build only; switch later")
+    activate = commands.add_parser('activate', help="switch the alias to a version")
+    activate.add_argument('name')
+    commands.add_parser('rollback', help="switch back to the previous version")
+    commands.add_parser('publish', help="copy the registry file's entry to MongoDB")
+    cleanup = commands.add_parser('prune', help="delete old versions")
+    cleanup.add_argument('--keep', type=int, default=2)
+    args = parser.parse_args()
+
+    configure_logging()
+    registry = open_registry(args.alias)
+    if args.command == 'status':
+        active = registry.active()
+        for version in registry.versions() or [active]:
+            marker = '*' if version.name == active.name else ' '
+            print(f"{marker} {version.name:<32} {version.model:<24} {version.dimension:>5} "
+                  f"{version.metric:<10} {version.created_at}")
+        return
+    if args.command == 'activate':
+        registry.activate(args.name)
+        return
+    if args.command == 'rollback':
+        print(registry.rollback())
+        return
+    if args.command == 'publish':
+        if not isinstance(registry, MongoIndexRegistry):
+            raise SystemExit("publish copies to MongoDB: set INDEX_REGISTRY=mongo")
+        registry._save(IndexRegistry(alias=args.alias)._load())
+        print(registry.active().name)
+        return
+
+    transport = TransportConfig()
+    pc = build_pinecone(os.environ.get("PINECONE_API_KEY"), transport)
+    if args.command == 'prune':
+        prune(pc, registry, keep=args.keep)
+        return
+    client = None
+    collection = None
+    if not args.snapshot:
+        from pymongo import MongoClient
+
+        client = MongoClient(os.getenv('MONGODB_URI'))
+        collection = client['email_history']['email_history']
+    try:
+        version = rebuild(pc, transport, registry, model=args.model, collection=collection,
+                          snapshot=args.snapshot, activate=not args.no_activate)
+        print(version.name)
+    finally:
+        if client is not None:
+            client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""Reply index built from the MongoDB archive.
+
+mongodb.py and sent_monitor.py already archive INBOX and SENT messages into
+email_history, each document with its thread's messages as context. This
+job streams the (original message, our first reply) pairs straight out of
+that collection instead of re-crawling Gmail thread by thread:
+
+- one server-side cursor, sorted by stored_at, with a projection of the
+  fields the pairs need and the threads without our signature in the
+  second message filtered out on the server (by has_signature, or by
+  $regex on documents stored before bodies were compressed, see
+  body_codec.py);
+- only documents stored since the last run (the stored_at watermark, kept
+  in CACHE_DIR per index), unless --full is given;
+- embeddings requested EMBED_BATCH texts at a time and vectors upserted
+  UPSERT_BATCH at a time, every batch including the last partial one;
+- vector ids are the reply's Gmail message id, so re-indexing a thread
+  overwrites its vector instead of adding another;
+- near-duplicate pairs (templated replies to templated questions) are
+  left out, and their count set on the pair kept for them (dedup.py),
+  unless INDEX_DEDUP=0.
+
+upsert_pairs() and pair_record() are shared with the Gmail crawl in
+vector_search.py, documents() and pair_texts() with corpus_snapshot.py.
+
+Usage: python indexing.py [--full] [--index email-auto-response-v2]
+"""
+import os
+import argparse
+import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from cleaning import clean_body
+from language import classify
+from models import SIGNATURE, vector_metadata
+from body_codec import SIGNATURE_FIELD, BodyCodec, lazy_document
+from dedup import Deduplicator
+from index_versions import DEFAULT_MODEL, EMBED_MODELS
+from transport import CACHE_DIR, read_cache, write_cache
+from metrics import API_CALLS, get_logger, timed
+
+log = get_logger(__name__)
+
+# Model of the legacy index; versioned indexes record their own (index_versions.py)
+EMBED_MODEL = DEFAULT_MODEL
+EMBED_PARAMETERS = EMBED_MODELS[DEFAULT_MODEL]['parameters']
+# Pinecone inference accepts at most 96 inputs per request
+EMBED_BATCH = int(os.getenv('INDEX_EMBED_BATCH', '96'))
+# Two metadata texts of up to 15000 characters per vector: 50 vectors stay
+# under Pinecone's 2 MB upsert request limit
+UPSERT_BATCH = int(os.getenv('INDEX_UPSERT_BATCH', '50'))
+# Documents per getMore; a thread_context carries every message body
+MONGO_BATCH_SIZE = int(os.getenv('MONGO_BATCH_SIZE', '200'))
+INDEX_DEDUP = os.getenv('INDEX_DEDUP', '1') != '0'
+WATERMARK_PATH = os.path.join(CACHE_DIR, 'index_watermarks.json')
+
+# What the pairs need from an archive document
+PROJECTION = {
+    '_id': 0,
+    'thread_id': 1,
+    'stored_at': 1,
+    # Oldest first: the original message and the first reply
+    'thread_context.messages': {'$slice': 2},
+}
+
+# (vector id, text to embed, metadata)
+Pair = Tuple[str, str, Dict]
+
+
+def pair_texts(original_body: str, reply_body: str) -> Tuple[str, str, str]:
+    """Cleaned original and reply text, and the original's language"""
+    original_text = clean_body(original_body) or original_body
+    reply_text = clean_body(reply_body) or reply_body
+    return original_text, reply_text, classify(original_text)[0]
+
+
+def pair_record(reply_id: str, original_body: str, reply_body: str,
+                sent_at: Optional[datetime.datetime]) -> Pair:
+    """Vector id, embedding input and metadata for an original/reply pair"""
+    original_text, reply_text, language = pair_texts(original_body, reply_body)
+    return reply_id, original_text, vector_metadata(original_text, reply_text, sent_at, language)
+
+
+def embed_texts(pc, texts: List[str], model: str = EMBED_MODEL) -> List[List[float]]:
+    """Passage embeddings for texts, EMBED_BATCH per inference call"""
+    parameters = EMBED_MODELS[model]['parameters']
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH):
+        API_CALLS.inc(service='pinecone', method='embed')
+        with timed('embed'):
+            embeddings = pc.inference.embed(model=model, inputs=texts[start:start + EMBED_BATCH],
+                                            parameters=parameters)
+        vectors.extend(embedding['values'] for embedding in embeddings)
+    return vectors
+
+
+def upsert_pairs(pc, index, pairs: Iterable[Pair], on_flush=None, model: str = EMBED_MODEL) -> int:
+    """Embed and upsert pairs in batches; returns how many were upserted.
+
+    on_flush, if given, is called after each batch is safely in the index.
+    """
+    total = 0
+    pending = []
+
+    def flush():
+        nonlocal total
+        if not pending:
+            return
+        embeddings = embed_texts(pc, [text for _, text, _ in pending], model)
+        vectors = [{'id': vector_id, 'values': values, 'metadata': metadata}
+                   for (vector_id, _, metadata), values in zip(pending, embeddings)]
+        API_CALLS.inc(service='pinecone', method='upsert')
+        with timed('upsert'):
+            index.upsert(vectors=vectors)
+        total += len(vectors)
+        pending.clear()
+        if on_flush is not None:
+            on_flush()
+
+    for pair in pairs:
+        pending.append(pair)
+        if len(pending) >= UPSERT_BATCH:
+            flush()
+    flush()
+    return total
+
+
+def document_messages(document: Dict) -> Optional[Tuple[Dict, Dict]]:
+    """The original message and our first reply in an archive document's
+    thread context, or None if the first reply is not ours"""
+    messages = document.get('thread_context', {}).get('messages', [])
+    if len(messages) < 2 or SIGNATURE not in (messages[1].get('body') or ''):
+        return None
+    return messages[0], messages[1]
+
+
+def document_pair(document: Dict) -> Optional[Pair]:
+    """The pair of an archive document's thread, or None if its first reply is not ours"""
+    found = document_messages(document)
+    if found is None:
+        return None
+    original, reply = found
+    return pair_record(reply['message_id'], original.get('body') or '', reply['body'],
+                       reply.get('sent_at'))
+
+
+def read_watermark(index_name: str) -> Optional[datetime.datetime]:
+    value = (read_cache(WATERMARK_PATH) or {}).get(index_name)
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+def write_watermark(index_name: str, stored_at: datetime.datetime):
+    watermarks = read_cache(WATERMARK_PATH) or {}
+    watermarks[index_name] = stored_at.isoformat()
+    write_cache(WATERMARK_PATH, watermarks)
+
+
+class ArchiveIndexer:
+    """Indexes the reply pairs of an email_history collection into a Pinecone index"""
+
+    def __init__(self, collection, pc, index, index_name, model=EMBED_MODEL, codec=None,
+                 dedup=INDEX_DEDUP):
+        self.collection = collection
+        self.dedup = dedup
+        self.codec = codec or BodyCodec.for_collection(collection)
+        self.pc = pc
+        self.index = index
+        self.index_name = index_name
+        self.model = model
+        # stored_at of the last document read from the cursor
+        self._last_stored_at = None
+
+    def documents(self, since: Optional[datetime.datetime] = None) -> Iterator[Dict]:
+        """Projected documents stored at or after since whose thread's first
+        reply may be ours, oldest first, one per thread; bodies are
+        decompressed when read"""
+        query = {
+            'thread_context.message_count': {'$gte': 2},
+            '$or': [{f'thread_context.messages.1.{SIGNATURE_FIELD}': True},
+                    {'thread_context.messages.1.body': {'$regex': SIGNATURE}}],
+        }
+        if since is not None:
+            # $gte: documents sharing the boundary timestamp may not all
+            # have been indexed; upserting one twice is harmless
+            query['stored_at'] = {'$gte': since}
+        seen_threads = set()
+        cursor = (self.collection.find(query, PROJECTION)
+                  .sort('stored_at', 1)
+                  .batch_size(MONGO_BATCH_SIZE))
+        with cursor:
+            for document in cursor:
+                self._last_stored_at = document.get('stored_at') or self._last_stored_at
+                # Every archived message of a thread carries the same context
+                if document['thread_id'] in seen_threads:
+                    continue
+                seen_threads.add(document['thread_id'])
+                yield lazy_document(document, self.codec)
+
+    def pairs(self, since: Optional[datetime.datetime] = None) -> Iterator[Pair]:
+        """Pairs of the documents stored at or after since, oldest first, one per thread"""
+        for document in self.documents(since):
+            pair = document_pair(document)
+            if pair is not None:
+                yield pair
+
+    def run(self, full: bool = False) -> int:
+        """Index new pairs (every pair with full); returns how many were upserted"""
+        # Sorting by stored_at on every run needs the index
+        self.collection.create_index('stored_at')
+        since = None if full else read_watermark(self.index_name)
+        log.info("indexing_started", index=self.index_name,
+                 since=since.isoformat() if since else None)
+
+        def save_watermark():
+            if self._last_stored_at is not None:
+                write_watermark(self.index_name, self._last_stored_at)
+
+        pairs = self.pairs(since)
+        deduplicator = Deduplicator() if self.dedup else None
+        if deduplicator is not None:
+            pairs = deduplicator.filter(pairs)
+        count = upsert_pairs(self.pc, self.index, pairs, on_flush=save_watermark, model=self.model)
+        # Documents after the last pair carried nothing to index
+        save_watermark()
+        if deduplicator is not None:
+            deduplicator.apply(self.index)
+            log.info("indexing_deduplicated", index=self.index_name, **deduplicator.report())
+        log.info("indexing_finished", index=self.index_name, upserted=count)
+        return count
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    from transport import TransportConfig, build_pinecone
+    from metrics import configure_logging
+    from gmail_auto_response import connect_index
+    from index_versions import open_registry
+
+    parser = argparse.ArgumentParser(description="Index reply pairs from the MongoDB archive")
+    parser.add_argument('--full', action='store_true',
+                        help="ignore the watermark and index the whole archive")
+    parser.add_argument('--index', help="index version to fill (default: the active one)")
+    args = parser.parse_args()
+
+    configure_logging()
+    registry = open_registry()
+    version = registry.version(args.index) if args.index else registry.active()
+    transport = TransportConfig()
+    pc = build_pinecone(os.environ.get("PINECONE_API_KEY"), transport)
+    index = connect_index(pc, transport, index_name=version.name, version=version, writable=True)
+    client = MongoClient(os.getenv('MONGODB_URI'))
+    try:
+        collection = client['email_history']['email_history']
+        ArchiveIndexer(collection, pc, index, version.name, model=version.model).run(full=args.full)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""Local reply index with scalar-quantized vectors.
+
+An alternative to querying Pinecone: the reply vectors live in the worker
+process and are searched with NumPy. Each 1024-dimension float32 vector
+takes 4 KB, which adds up to gigabytes per process for a few hundred
+thousand archived replies. So the in-memory copy is quantized:
+
+    float32   4 bytes per value, exact
+    float16   2 bytes per value
+    int8      1 byte per value, plus one float32 scale per vector
+              (max |value| / 127), about 4x smaller than float32
+
+A query is scored against the quantized matrix block by block, so the only
+float32 temporaries are BLOCK_ROWS rows at a time. When the index was
+saved with its float32 originals, the best top_k * RESCORE_FACTOR
+candidates are then re-scored against them. The originals stay on disk,
+memory-mapped, so only the candidates' pages are read. Without them the
+quantized scores decide. bench_quantization.py measures the recall@1 of
+each format against exact float32 dot products.
+
+int8 is the default. NumPy converts float16 to float32 several times more
+slowly than int8, so float16 queries are the slowest of the three.
+
+LocalIndex has the query() interface of a Pinecone index handle, metadata
+filters included, so Retriever works with it unchanged. connect_index uses
+it when LOCAL_INDEX_DIR is set: the index version NAME is then loaded from
+LOCAL_INDEX_DIR/NAME, as written by
+
+    python local_vectors.py build --snapshot snapshots/corpus --out DIR [--dtype int8]
+
+from a corpus_snapshot.py export made with --embed.
+"""
+import os
+import argparse
+from typing import Dict, List
+
+from transport import read_cache, write_cache
+from metrics import get_logger, timed
+
+log = get_logger(__name__)
+
+LOCAL_INDEX_DIR = os.getenv('LOCAL_INDEX_DIR', '')
+LOCAL_VECTOR_DTYPE = os.getenv('LOCAL_VECTOR_DTYPE', 'int8')
+DTYPES = ('float32', 'float16', 'int8')
+# Candidates re-scored in float32, as a multiple of top_k
+RESCORE_FACTOR = int(os.getenv('LOCAL_RESCORE_FACTOR', '4'))
+# Rows converted to float32 at a time while scoring (16 MB at 1024 dimensions)
+BLOCK_ROWS = 4096
+
+
+class QuantizedVectors:
+    """(n, dimension) matrix stored as float32, float16 or int8 codes with
+    per-vector scales, plus optionally the float32 originals for re-scoring"""
+
+    def __init__(self, codes, scales, originals=None):
+        self.codes = codes
+        self.scales = scales
+        self.originals = originals
+
+    @classmethod
+    def quantize(cls, vectors, dtype: str = LOCAL_VECTOR_DTYPE) -> 'QuantizedVectors':
+        import numpy as np
+
+        if dtype not in DTYPES:
+            raise ValueError(f"unsupported vector dtype {dtype!r}, expected one of {DTYPES}")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scales = np.ones(len(vectors), dtype=np.float32)
+        if dtype == 'int8':
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        else:
+            codes = vectors.astype(dtype)
+        return cls(codes, scales)
+
+    @property
+    def dtype(self) -> str:
+        return self.codes.dtype.name
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the quantized matrix (the originals are on disk)"""
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def dequantize(self, rows):
+        import numpy as np
+
+        return self.codes[rows].astype(np.float32) * self.scales[rows, None]
+
+    def scores(self, queries):
+        """(n, m) approximate dot products with the (m, dimension) queries"""
+        import numpy as np
+
+        queries = np.asarray(queries, dtype=np.float32)
+        out = np.empty((len(self.codes), len(queries)), dtype=np.float32)
+        if self.codes.dtype == np.float32:
+            return np.matmul(self.codes, queries.T, out=out)
+        # One float32 buffer reused for every block: converting into it is
+        # about twice as fast as astype, which allocates each time
+        buffer = np.empty((min(BLOCK_ROWS, len(self.codes)), self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.codes), BLOCK_ROWS):
+            block = self.codes[start:start + BLOCK_ROWS]
+            converted = buffer[:len(block)]
+            np.copyto(converted, block, casting='unsafe')
+            np.matmul(converted, queries.T, out=out[start:start + BLOCK_ROWS])
+        if self.dtype == 'int8':
+            out *= self.scales[:, None]
+        return out
+
+    def rescore(self, rows, query):
+        """Exact dot products of the query with the original rows"""
+        import numpy as np
+
+        return np.asarray(self.originals[rows], dtype=np.float32) @ np.asarray(query, dtype=np.float32)
+
+    def save(self, path: str):
+        import numpy as np
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'codes.npy'), self.codes)
+        np.save(os.path.join(path, 'scales.npy'), self.scales)
+        if self.originals is not None:
+            np.save(os.path.join(path, 'originals.npy'), np.asarray(self.originals, dtype=np.float32))
+
+    @classmethod
+    def load(cls, path: str, rescore_originals: bool = True) -> 'QuantizedVectors':
+        import numpy as np
+
+        originals = None
+        originals_path = os.path.join(path, 'originals.npy')
+        if rescore_originals and os.path.exists(originals_path):
+            originals = np.load(originals_path, mmap_mode='r')
+        return cls(np.load(os.path.join(path, 'codes.npy')),
+                   np.load(os.path.join(path, 'scales.npy')), originals)
+
+
+class _QueryResponse:
+    def __init__(self, matches):
+        self.matches = matches
+
+
+class LocalIndex:
+    """Vector ids, quantized vectors and metadata, queried like a Pinecone index"""
+
+    def __init__(self, ids: List[str], vectors: QuantizedVectors, metadata: List[Dict],
+                 rescore_factor: int = RESCORE_FACTOR):
+        self.ids = ids
+        self.vectors = vectors
+        self.metadata = metadata
+        self.rescore_factor = rescore_factor
+        # metadata key -> array of its values, for vectorized filters
+        self._columns = {}
+
+    @classmethod
+    def build(cls, ids, vectors, metadata, dtype: str = LOCAL_VECTOR_DTYPE,
+              keep_originals: bool = False) -> 'LocalIndex':
+        """Index over float32 vectors; with keep_originals they are kept for
+        re-scoring (and saved with the index)"""
+        quantized = QuantizedVectors.quantize(vectors, dtype)
+        if keep_originals:
+            quantized.originals = vectors
+        return cls(list(ids), quantized, list(metadata))
+
+    @classmethod
+    def from_snapshot(cls, path: str, dtype: str = LOCAL_VECTOR_DTYPE, filter=None,
+                      keep_originals: bool = False) -> 'LocalIndex':
+        """Index over a corpus snapshot exported with embeddings"""
+        from corpus_snapshot import embedding_matrix, open_snapshot
+        from models import vector_metadata
+
+        table = open_snapshot(path).to_table(
+            columns=['reply_id', 'original_text', 'reply_text', 'language', 'sent_at', 'embedding'],
+            filter=filter)
+        metadata = [vector_metadata(original, reply, sent_at, language) for original, reply, sent_at, language
+                    in zip(*(table.column(name).to_pylist()
+                             for name in ('original_text', 'reply_text', 'sent_at', 'language')))]
+        return cls.build(table.column('reply_id').to_pylist(), embedding_matrix(table.column('embedding')),
+                         metadata, dtype, keep_originals)
+
+    def save(self, path: str):
+        """Write the index to the directory path, with the float32 originals
+        if it has them"""
+        self.vectors.save(path)
+        write_cache(os.path.join(path, 'ids.json'), self.ids)
+        write_cache(os.path.join(path, 'metadata.json'), self.metadata)
+
+    @classmethod
+    def load(cls, path: str) -> 'LocalIndex':
+        ids = read_cache(os.path.join(path, 'ids.json'))
+        if ids is None:
+            raise FileNotFoundError(f"no local index in {path}")
+        index = cls(ids, QuantizedVectors.load(path), read_cache(os.path.join(path, 'metadata.json')) or [])
+        log.info("local_index_loaded", path=path, vectors=len(ids), dtype=index.vectors.dtype,
+                 megabytes=round(index.vectors.nbytes / 2 ** 20, 1),
+                 rescore=index.vectors.originals is not None)
+        return index
+
+    def _column(self, key):
+        import numpy as np
+
+        column = self._columns.get(key)
+        if column is None:
+            values = [metadata.get(key) for metadata in self.metadata]
+            if all(value is None or isinstance(value, (int, float)) and not isinstance(value, bool)
+                   for value in values):
+                column = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            else:
+                column = np.array(values, dtype=object)
+            self._columns[key] = column
+        return column
+
+    def _mask(self, condition):
+        """Boolean row mask for a Pinecone metadata filter"""
+        import numpy as np
+
+        mask = np.ones(len(self.ids), dtype=bool)
+        for key, test in condition.items():
+            if key == '$and':
+                for part in test:
+                    mask &= self._mask(part)
+                continue
+            if key == '$or':
+                mask &= np.logical_or.reduce([self._mask(part) for part in test])
+                continue
+            column = self._column(key)
+            if not isinstance(test, dict):
+                test = {'$eq': test}
+            for op, expected in test.items():
+                if op == '$eq':
+                    mask &= column == expected
+                elif op == '$ne':
+                    mask &= column != expected
+                elif op == '$in':
+                    mask &= np.isin(column, list(expected))
+                elif op == '$nin':
+                    mask &= ~np.isin(column, list(expected))
+                elif op == '$exists':
+                    present = np.not_equal(column, None) if column.dtype == object else ~np.isnan(column)
+                    mask &= present if expected else ~present
+                elif op in ('$gt', '$gte', '$lt', '$lte'):
+                    if column.dtype == object:
+                        raise ValueError(f"{op} on non-numeric metadata field {key}")
+                    with np.errstate(invalid='ignore'):
+                        mask &= {'$gt': np.greater, '$gte': np.greater_equal, '$lt': np.less,
+                                 '$lte': np.less_equal}[op](column, expected)
+                else:
+                    raise ValueError(f"unsupported filter operator {op}")
+        return mask
+
+    def query(self, top_k, vector=None, filter=None, include_values=False, include_metadata=False,
+              namespace=None, **kwargs):
+        import numpy as np
+
+        if not self.ids:
+            return _QueryResponse([])
+        with timed('local_search'):
+            scores = self.vectors.scores([vector])[:, 0]
+            if filter:
+                scores[~self._mask(filter)] = -np.inf
+            rescore = self.vectors.originals is not None
+            candidates = min(len(scores), top_k * self.rescore_factor if rescore else top_k)
+            rows = np.argpartition(-scores, candidates - 1)[:candidates]
+            rows = rows[np.isfinite(scores[rows])]
+            # Ascending rows read the memory-mapped originals front to back
+            rows.sort()
+        if rescore:
+            with timed('local_rescore'):
+                scores = self.vectors.rescore(rows, vector)
+        else:
+            scores = scores[rows]
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        return _QueryResponse([{
+            'id': self.ids[rows[i]],
+            'score': float(scores[i]),
+            'values': self.vectors.dequantize(rows[i]).tolist() if include_values else [],
+            'metadata': self.metadata[rows[i]] if include_metadata else None,
+        } for i in order])
+
+    def describe_index_stats(self, **kwargs):
+        return {'total_vector_count': len(self.ids), 'dimension': self.vectors.codes.shape[1]}
+
+
+def main():
+    from metrics import configure_logging
+
+    parser = argparse.ArgumentParser(description="Build a quantized local reply index")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="corpus snapshot (with embeddings) -> local index")
+    build.add_argument('--snapshot', default=os.getenv('SNAPSHOT_DIR', os.path.join('snapshots', 'corpus')))
+    build.add_argument('--out', required=True, help="directory, e.g. LOCAL_INDEX_DIR/<index name>")
+    build.add_argument('--dtype', default=LOCAL_VECTOR_DTYPE, choices=DTYPES)
+    build.add_argument('--no-originals', action='store_true',
+                       help="do not keep the float32 vectors on disk for re-scoring")
+    args = parser.parse_args()
+
+    configure_logging()
+    index = LocalIndex.from_snapshot(args.snapshot, args.dtype, keep_originals=not args.no_originals)
+    index.save(args.out)
+    log.info("local_index_built", path=args.out, vectors=len(index.ids), dtype=args.dtype,
+             megabytes=round(index.vectors.nbytes / 2 ** 20, 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+import datetime
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; covers fast Gmail calls up to slow gpt-4o generations
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _label_text(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_label_text(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram with optional labels"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (last slot is +Inf), sum, count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._series.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket{_label_text(self.labelnames, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_label_text(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_label_text(self.labelnames, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'autoreply_stage_seconds', 'Latency of each auto-reply pipeline stage', ['stage'])
+TIME_TO_DRAFT_SECONDS = REGISTRY.histogram(
+    'autoreply_time_to_draft_seconds', 'Time from an email arriving to its draft being saved',
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+API_CALLS = REGISTRY.counter(
+    'autoreply_api_calls_total', 'Calls made to external APIs', ['service', 'method'])
+API_ERRORS = REGISTRY.counter(
+    'autoreply_api_errors_total', 'Failed calls to external APIs', ['service', 'method'])
+TOKENS = REGISTRY.counter(
+    'autoreply_openai_tokens_total', 'OpenAI tokens used', ['kind'])
+CACHE_LOOKUPS = REGISTRY.counter(
+    'autoreply_cache_lookups_total', 'Cache lookups by cache and result', ['cache', 'result'])
+MESSAGES = REGISTRY.counter(
+    'autoreply_messages_total', 'Messages handled by outcome', ['outcome'])
+
+
+@contextmanager
+def timed(stage):
+    """Record how long the with-block takes under the given stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def api_call(service, method, request):
+    """Execute a Gmail-style request (anything with .execute()) and count it"""
+    API_CALLS.inc(service=service, method=method)
+    try:
+        return request.execute()
+    except Exception:
+        API_ERRORS.inc(service=service, method=method)
+        raise
+
+
+def record_cache(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def record_usage(usage):
+    """Add an OpenAI response's token usage to the counters"""
+    if usage is None:
+        return
+    TOKENS.inc(usage.prompt_tokens or 0, kind='prompt')
+    TOKENS.inc(usage.completion_tokens or 0, kind='completion')
+    # Part of prompt_tokens served from the provider's prompt cache
+    details = getattr(usage, 'prompt_tokens_details', None)
+    TOKENS.inc(getattr(details, 'cached_tokens', None) or 0, kind='cached_prompt')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out the application logs
+        pass
+
+
+def start_metrics_server(port=None):
+    """Serve /metrics on a daemon thread; returns the server or None if disabled.
+
+    The port defaults to METRICS_PORT (9108); 0 disables the endpoint.
+    """
+    if port is None:
+        port = int(os.getenv('METRICS_PORT', '9108'))
+    if not port:
+        return None
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, event and fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class EventLogger(logging.LoggerAdapter):
+    """Logger whose keyword arguments become structured fields.
+
+    log.info("draft_created", draft_id=draft['id']) logs the event name with
+    draft_id as a separate JSON field.
+    """
+
+    _RESERVED = ('exc_info', 'stack_info', 'stacklevel', 'extra')
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in self._RESERVED}
+        kwargs['extra'] = {'fields': {**(self.extra or {}), **fields}}
+        return msg, kwargs
+
+
+def get_logger(name, **context):
+    """Structured logger; context fields (e.g. mailbox=...) go on every line"""
+    return EventLogger(logging.getLogger(name), context)
+
+
+def configure_logging(level=None):
+    """Send all logging to stdout as JSON lines, at LOG_LEVEL (default INFO)"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level or os.getenv('LOG_LEVEL', 'INFO'))
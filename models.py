@@ -0,0 +1,235 @@
+"""Message and thread model shared by the auto-reply daemon, the indexer and
+the Mongo archivers.
+
+Each path used to turn Gmail API resources into its own free-form dict,
+with its own header scans and body extraction. EmailMessage and
+EmailThread are built once from the API resource; header values are
+parsed in one pass and interned, and the body is decoded on first use,
+after which the raw payload is dropped. Converters produce the Mongo
+archive document and the Pinecone vector metadata, so the three paths
+store the same fields the same way.
+"""
+import sys
+import base64
+import datetime
+from typing import Dict, List, Optional
+
+from headers import MessageHeaders
+
+# Metadata values are capped well below Pinecone's 40 KB per-vector limit
+METADATA_TEXT_LIMIT = 15000
+# Our replies are recognised by the signature (cleaning removes it)
+SIGNATURE = "Customer Success Assistant"
+
+
+def _decode(data):
+    return base64.urlsafe_b64decode(data).decode('utf-8', errors='replace')
+
+
+def html_to_text(html):
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(html, "html.parser").get_text(separator="\n")
+
+
+def message_body(payload):
+    """Body text of a Gmail payload: the first text/plain part at any depth,
+    else the first text/html part converted to text. Attachments are skipped."""
+    plain = html = None
+    stack = [payload]
+    while stack and plain is None:
+        part = stack.pop()
+        if part.get('filename'):
+            continue
+        mime_type = part.get('mimeType', '')
+        data = part.get('body', {}).get('data')
+        if mime_type == 'text/plain' and data:
+            plain = _decode(data)
+        elif mime_type == 'text/html' and data and html is None:
+            html = _decode(data)
+        # Reversed so parts are visited in document order
+        stack.extend(reversed(part.get('parts', [])))
+    if plain is not None:
+        return plain.strip()
+    if html is not None:
+        return html_to_text(html).strip()
+    return ""
+
+
+class EmailMessage:
+    """One Gmail message: ids, labels, parsed headers and a lazily decoded body"""
+
+    __slots__ = ('id', 'thread_id', 'headers', 'labels', 'snippet', 'internal_date',
+                 '_payload', '_body')
+
+    def __init__(self, id, thread_id, headers=None, labels=(), snippet='', internal_date=0,
+                 payload=None, body=None):
+        self.id = id
+        self.thread_id = thread_id
+        self.headers = headers or MessageHeaders()
+        self.labels = tuple(sys.intern(label) for label in labels)
+        self.snippet = snippet
+        self.internal_date = internal_date
+        self._payload = payload
+        self._body = body
+
+    @classmethod
+    def from_gmail(cls, resource: Dict) -> 'EmailMessage':
+        """From a users.messages resource (as returned by messages.get or threads.get)"""
+        payload = resource.get('payload', {})
+        return cls(
+            id=resource['id'],
+            thread_id=resource['threadId'],
+            headers=MessageHeaders.from_headers(payload.get('headers', [])),
+            labels=resource.get('labelIds', ()),
+            snippet=resource.get('snippet', ''),
+            internal_date=int(resource.get('internalDate', 0)),
+            payload=payload,
+        )
+
+    @property
+    def body(self) -> str:
+        if self._body is None:
+            self._body = message_body(self._payload or {})
+            # The decoded text is all anyone reads; let the payload go
+            self._payload = None
+        return self._body
+
+    @property
+    def subject(self) -> str:
+        return self.headers.subject or 'No Subject'
+
+    @property
+    def sender(self) -> str:
+        return self.headers.sender or 'Unknown Sender'
+
+    @property
+    def date(self) -> str:
+        return self.headers.date or 'Unknown Date'
+
+    @property
+    def message_id(self) -> str:
+        return self.headers.message_id
+
+    @property
+    def sent_at(self) -> Optional[datetime.datetime]:
+        """When Gmail received the message (internalDate), as an aware datetime"""
+        if not self.internal_date:
+            return self.headers.sent_at
+        return datetime.datetime.fromtimestamp(self.internal_date / 1000, datetime.timezone.utc)
+
+    def has_label(self, label) -> bool:
+        return label in self.labels
+
+    def thread_entry(self) -> Dict:
+        """Summary of the message as stored in a document's thread_context"""
+        return {
+            'message_id': self.id,
+            'thread_id': self.thread_id,
+            'subject': self.subject,
+            'sender': self.sender,
+            'to': self.headers.to or 'Unknown Recipient',
+            'date': self.headers.date or None,
+            'sent_at': self.sent_at,
+            'snippet': self.snippet,
+            'body': self.body,
+            'labels': list(self.labels),
+        }
+
+    def to_document(self, thread: 'EmailThread' = None, stored_at=None) -> Dict:
+        """Mongo archive document, with the thread's messages as context if given"""
+        document = self.thread_entry()
+        document['stored_at'] = stored_at or datetime.datetime.now()
+        if thread is not None:
+            document['thread_context'] = {
+                'thread_id': thread.id,
+                'message_count': len(thread),
+                'messages': thread.entries(),
+            }
+        return document
+
+    def to_state(self) -> Dict:
+        """JSON-serializable form, e.g. for work persisted across restarts"""
+        headers = self.headers
+        return {
+            'id': self.id,
+            'thread_id': self.thread_id,
+            'subject': headers.subject,
+            'sender': headers.sender,
+            'to': headers.to,
+            'date': headers.date,
+            'message_id': headers.message_id,
+            'labels': list(self.labels),
+            'internal_date': self.internal_date,
+            'body': self.body,
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict) -> 'EmailMessage':
+        headers = MessageHeaders(subject=state['subject'], sender=state['sender'], to=state['to'],
+                                 date=state['date'], message_id=state['message_id'])
+        return cls(state['id'], state['thread_id'], headers, labels=state['labels'],
+                   internal_date=state['internal_date'], body=state['body'])
+
+    def __repr__(self):
+        return f"EmailMessage(id={self.id!r}, thread_id={self.thread_id!r}, subject={self.subject!r})"
+
+
+class EmailThread:
+    """A Gmail thread: its messages in the order Gmail returns them (oldest first)"""
+
+    __slots__ = ('id', 'messages', '_entries')
+
+    def __init__(self, id, messages):
+        self.id = id
+        self.messages = messages
+        self._entries = None
+
+    @classmethod
+    def from_gmail(cls, resource: Dict) -> 'EmailThread':
+        """From a users.threads resource fetched with format='full'"""
+        return cls(resource['id'],
+                   [EmailMessage.from_gmail(message) for message in resource.get('messages', [])])
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def entries(self) -> List[Dict]:
+        """thread_context entries, oldest first; built once and shared by every
+        document of the thread instead of once per message"""
+        if self._entries is None:
+            entries = [message.thread_entry() for message in self.messages]
+            entries.sort(key=lambda entry: entry['sent_at'].timestamp() if entry['sent_at'] else 0)
+            self._entries = entries
+        return self._entries
+
+
+def latest_per_thread(messages: List[EmailMessage]) -> List[EmailMessage]:
+    """The most recent message of each thread, threads in order of first appearance"""
+    latest = {}
+    for message in messages:
+        current = latest.get(message.thread_id)
+        if current is None or message.internal_date >= current.internal_date:
+            latest[message.thread_id] = message
+    return list(latest.values())
+
+
+def vector_metadata(original_text: str, reply_text: str, sent_at: Optional[datetime.datetime],
+                    language: str) -> Dict:
+    """Pinecone metadata for an (original message, reply) pair; sent_at is
+    when the reply was sent (naive datetimes, as read back from Mongo, are UTC)"""
+    if sent_at is not None and sent_at.tzinfo is None:
+        sent_at = sent_at.replace(tzinfo=datetime.timezone.utc)
+    return {
+        "original_message": original_text[:METADATA_TEXT_LIMIT],
+        "reply_message": reply_text[:METADATA_TEXT_LIMIT],
+        # Used by retrieval.Retriever for filtering and re-ranking
+        "language": language,
+        "sent_at": int(sent_at.timestamp()) if sent_at else 0,
+    }
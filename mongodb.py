@@ -3,17 +3,31 @@ import pickle
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from pymongo import MongoClient
 from datetime import datetime
-import base64
 from email.mime.text import MIMEText
 import json
 import dotenv
+from models import EmailMessage, EmailThread
+from body_codec import archive_codec, encode_document
+from pipeline import fetch_parse
+from transport import TransportConfig, build_gmail_service
 dotenv.load_dotenv()
 # Gmail API scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+def thread_documents(resource, label='INBOX'):
+    """Archive documents, with thread context, for the messages of a thread
+    resource that carry label. Runs in the pipeline's worker processes.
+
+    stored_at is UTC, like sent_monitor.py's: indexing.py reads both
+    through one stored_at watermark.
+    """
+    thread = EmailThread.from_gmail(resource)
+    return [message.to_document(thread, stored_at=datetime.utcnow())
+            for message in thread if message.has_label(label)]
+
+
 class GmailMongoDB:
     def __init__(self, credentials_path='credentials.json', token_path='token.json', mongo_uri=os.getenv('MONGODB_URI')):
         self.credentials_path = credentials_path
@@ -42,7 +56,8 @@ class GmailMongoDB:
             with open('token.json', 'w') as token:
                 token.write(creds.to_json())
 
-        self.gmail_service = build('gmail', 'v1', credentials=creds)
+        # Thread-safe: fetch_and_store_emails fetches threads concurrently
+        self.gmail_service = build_gmail_service(creds, TransportConfig())
         return self.gmail_service
 
     def connect_mongodb(self):
@@ -55,65 +70,19 @@ class GmailMongoDB:
         """Extract email content from Gmail message."""
         if 'payload' not in message:
             return None
+        return EmailMessage.from_gmail(message).to_document(stored_at=datetime.utcnow())
 
-        headers = message['payload']['headers']
-        subject = next((header['value'] for header in headers if header['name'].lower() == 'subject'), 'No Subject')
-        sender = next((header['value'] for header in headers if header['name'].lower() == 'from'), 'Unknown Sender')
-        to = next((header['value'] for header in headers if header['name'].lower() == 'to'), 'Unknown Recipient')
-        date = next((header['value'] for header in headers if header['name'].lower() == 'date'), None)
-
-        # Get email body
-        body = ''
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                if part['mimeType'] == 'text/plain':
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode()
-                    break
-        elif 'body' in message['payload'] and 'data' in message['payload']['body']:
-            body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode()
-
-        return {
-            'message_id': message['id'],
-            'thread_id': message['threadId'],
-            'subject': subject,
-            'sender': sender,
-            'to': to,
-            'date': date,
-            'body': body,
-            'snippet': message.get('snippet', ''),
-            'labels': message.get('labelIds', []),
-            'stored_at': datetime.now()
-        }
-
-    def get_thread_messages(self, thread_id):
-        """Fetch all messages in a thread."""
+    def get_thread(self, thread_id):
+        """Fetch a thread with every message in full."""
         if not self.gmail_service:
             self.authenticate_gmail()
 
-        thread = self.gmail_service.users().threads().get(
-            userId='me', id=thread_id).execute()
-        
-        messages = []
-        for message in thread['messages']:
-            email_data = self.get_email_content(message)
-            if email_data:
-                # Create a version of the message for thread context that includes body
-                thread_message = {
-                    'message_id': email_data['message_id'],
-                    'thread_id': email_data['thread_id'],
-                    'subject': email_data['subject'],
-                    'sender': email_data['sender'],
-                    'to': email_data['to'],
-                    'date': email_data['date'],
-                    'snippet': email_data['snippet'],
-                    'body': email_data['body'],  # Include the body content
-                    'labels': email_data['labels']  # Include labels as well
-                }
-                messages.append(thread_message)
-        
-        # Sort messages by date
-        messages.sort(key=lambda x: x['date'] if x['date'] else '')
-        return messages
+        return EmailThread.from_gmail(self.gmail_service.users().threads().get(
+            userId='me', id=thread_id).execute())
+
+    def get_thread_messages(self, thread_id):
+        """Fetch all messages in a thread, sorted by date."""
+        return self.get_thread(thread_id).entries()
 
     def fetch_and_store_emails(self, max_results=30):
         """Fetch emails from Gmail inbox and store them in MongoDB with thread messages included."""
@@ -134,51 +103,32 @@ class GmailMongoDB:
 
         # Collection for storing emails
         emails_collection = self.db['email_history']
+        # Bodies are stored zstd-compressed (see body_codec.py)
+        codec = archive_codec(self.db)
 
-        # Keep track of processed threads to avoid duplicates
+        # Each thread once, in the order its first message was listed
+        thread_ids = list(dict.fromkeys(message['threadId'] for message in messages))
         processed_threads = set()
 
-        count = 0
-        for message in messages:
-            print(f"Processing email: {message['id']}"+"count: "+str(count))
-            count += 1
-            thread_id = message['threadId']
-            
-            # Skip if we've already processed this thread
-            if thread_id in processed_threads:
-                continue
-
-            # Get all messages in the thread
-            thread_messages = self.get_thread_messages(thread_id)
-            
-            if thread_messages:
-                # Store each message with its thread context
-                for msg in thread_messages:
-                    # Get the full message details for the current message
-                    full_message = self.gmail_service.users().messages().get(
-                        userId='me', 
-                        id=msg['message_id'],
-                        format='full'  # Get full message details
-                    ).execute()
-                    email_data = self.get_email_content(full_message)
-                    
-                    if email_data:
-                        # Add thread context without creating circular references
-                        email_data['thread_context'] = {
-                            'thread_id': thread_id,
-                            'message_count': len(thread_messages),
-                            'messages': thread_messages
-                        }
-                        # Only store if the message is in inbox
-                        if 'INBOX' in email_data['labels']:
-                            emails_collection.update_one(
-                                {'message_id': email_data['message_id']},
-                                {'$set': email_data},
-                                upsert=True
-                            )
-                
-                processed_threads.add(thread_id)
-                print(f"Stored thread {thread_id} with {len(thread_messages)} messages")
+        def fetch_thread(thread_id):
+            # threads.get already returns every message in full, so they
+            # are not fetched again one by one
+            return self.gmail_service.users().threads().get(userId='me', id=thread_id).execute()
+
+        # Fetch on I/O threads, parse on every core (see pipeline.py)
+        documents = fetch_parse(thread_ids, fetch_thread, thread_documents)
+        for count, (thread_id, inbox_documents) in enumerate(zip(thread_ids, documents)):
+            print(f"Processing thread: {thread_id} count: {count}")
+            # Store each inbox message with its thread context
+            for email_data in inbox_documents:
+                emails_collection.update_one(
+                    {'message_id': email_data['message_id']},
+                    {'$set': encode_document(email_data, codec)},
+                    upsert=True
+                )
+
+            processed_threads.add(thread_id)
+            print(f"Stored thread {thread_id} with {len(inbox_documents)} inbox messages")
 
         return len(processed_threads)
 
@@ -0,0 +1,190 @@
+import os
+import sys
+import signal
+import json
+import time
+import datetime
+import threading
+from collections import OrderedDict
+
+from gmail_auto_response import (
+    GmailAutoReply,
+    create_openai_client,
+    connect_index,
+    PINECONE_API_KEY,
+)
+from index_versions import open_registry
+from work_queue import WorkQueue
+from openai_scheduler import OpenAIScheduler
+from transport import TransportConfig, build_openai_http_client, build_pinecone
+from metrics import configure_logging, get_logger, start_metrics_server
+
+log = get_logger(__name__)
+
+# Upper bound on messages being generated at the same time across all mailboxes
+GLOBAL_CONCURRENCY = int(os.getenv('GLOBAL_CONCURRENCY', '4'))
+
+
+class EmbeddingCache:
+    """Thread-safe LRU cache of embeddings keyed by (model, embedded text)"""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        with self._lock:
+            vector = self._entries.get(text)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return vector
+
+    def put(self, text, vector):
+        with self._lock:
+            self._entries[text] = vector
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def load_accounts(path):
+    """Load the list of mailbox configs.
+
+    The file is a JSON list of objects with a ``token_path`` and optionally a
+    ``name`` and ``interval_minutes``, see accounts.example.json.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        accounts = json.load(f)
+    if not accounts:
+        raise ValueError(f"No accounts configured in {path}")
+    for account in accounts:
+        if 'token_path' not in account:
+            raise ValueError(f"Account config without token_path: {account}")
+    return accounts
+
+
+def fair_shares(total, count):
+    """Split ``total`` worker slots as evenly as possible over ``count``
+    mailboxes, at least one each (the total is enforced separately)"""
+    base, extra = divmod(total, count)
+    return [max(1, base + (1 if i < extra else 0)) for i in range(count)]
+
+
+class MailboxSupervisor:
+    """Run several GmailAutoReply mailboxes in one process.
+
+    All mailboxes share one pooled HTTP client for OpenAI, one Pinecone
+    client and index handle (so the index check runs once), and one
+    embedding cache. Each mailbox polls on its own thread and processes its
+    messages with its fair share of the global concurrency limit; a
+    semaphore they share keeps the jobs running at once within the limit,
+    also when there are more mailboxes than slots.
+    """
+
+    def __init__(self, accounts, global_concurrency=GLOBAL_CONCURRENCY, transport=None, work_queue=None,
+                 index_registry=None):
+        self.accounts = accounts
+        shares = fair_shares(global_concurrency, len(accounts))
+
+        self.transport = transport or TransportConfig()
+        # Never keep fewer pooled connections than there are workers
+        self.transport.max_connections = max(self.transport.max_connections, global_concurrency)
+        self.transport.max_keepalive_connections = max(self.transport.max_keepalive_connections,
+                                                       global_concurrency)
+        self.transport.pinecone_pool_maxsize = max(self.transport.pinecone_pool_maxsize,
+                                                   global_concurrency)
+        self.http_client = build_openai_http_client(self.transport)
+        self.openai_client = create_openai_client(self.http_client)
+        # One scheduler, so all mailboxes share the account's rate limits
+        self.openai_scheduler = OpenAIScheduler(self.openai_client)
+        self.pc = build_pinecone(PINECONE_API_KEY, self.transport)
+        # Shared until the alias is switched; each mailbox then reconnects
+        # to the new version on its next poll
+        self.index_registry = index_registry or open_registry()
+        version = self.index_registry.active()
+        self.index = connect_index(self.pc, self.transport, index_name=version.name, version=version,
+                                   skip_index_check=os.getenv('SKIP_INDEX_CHECK') == '1')
+        self.embedding_cache = EmbeddingCache()
+        self.concurrency_limit = threading.BoundedSemaphore(global_concurrency)
+        # One SQLite connection for all mailboxes (or the MongoDB queue of
+        # distributed.py); jobs are kept per mailbox name
+        self.work_queue = work_queue or WorkQueue()
+
+        self.mailboxes = []
+        for account, share in zip(accounts, shares):
+            mailbox = GmailAutoReply(
+                token_path=account['token_path'],
+                name=account.get('name'),
+                openai_client=self.openai_client,
+                openai_scheduler=self.openai_scheduler,
+                pc=self.pc,
+                index=self.index,
+                embedding_cache=self.embedding_cache,
+                max_workers=share,
+                transport=self.transport,
+                index_registry=self.index_registry,
+                work_queue=self.work_queue,
+                concurrency_limit=self.concurrency_limit
+            )
+            self.mailboxes.append((mailbox, account.get('interval_minutes', 1)))
+        self._stop = threading.Event()
+
+    def _run_mailbox(self, mailbox, interval_minutes):
+        mailbox.last_check_time = datetime.datetime.now()
+        while not self._stop.is_set():
+            try:
+                mailbox.poll_once()
+            except Exception as error:
+                mailbox.log.exception("monitoring_failed", error=str(error))
+            self._stop.wait(interval_minutes * 60)
+
+    def stop(self):
+        """Let every mailbox finish the jobs in progress, then stop polling"""
+        self._stop.set()
+        for mailbox, _ in self.mailboxes:
+            mailbox.stop()
+
+    def start(self):
+        """Authenticate every mailbox and poll them all until interrupted or SIGTERM"""
+        for mailbox, _ in self.mailboxes:
+            mailbox.authenticate()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+        threads = []
+        for mailbox, interval_minutes in self.mailboxes:
+            thread = threading.Thread(target=self._run_mailbox, args=(mailbox, interval_minutes),
+                                      name=f"mailbox-{mailbox.name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+            mailbox.log.info("monitoring_started", workers=mailbox.max_workers,
+                             interval_minutes=interval_minutes)
+
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            log.info("monitoring_stopped")
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            self.work_queue.close()
+            self.http_client.close()
+
+
+def main():
+    config_path = sys.argv[1] if len(sys.argv) > 1 else 'accounts.json'
+    configure_logging()
+    start_metrics_server()
+    supervisor = MailboxSupervisor(load_accounts(config_path))
+    supervisor.start()
+
+
+if __name__ == '__main__':
+    main()
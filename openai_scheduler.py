@@ -0,0 +1,170 @@
+import os
+import re
+import time
+import random
+import threading
+
+from metrics import API_CALLS, REGISTRY, get_logger, record_usage, timed
+
+# Starting budgets until the first response tells us the real ones
+# (gpt-4o tier-1 limits); the headers of every response then take over.
+DEFAULT_RPM = int(os.getenv('OPENAI_RPM', '500'))
+DEFAULT_TPM = int(os.getenv('OPENAI_TPM', '30000'))
+MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '6'))
+
+RETRIES = REGISTRY.counter(
+    'autoreply_openai_retries_total', 'OpenAI requests retried, by reason', ['reason'])
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+log = get_logger(__name__)
+
+
+def parse_reset(value):
+    """Seconds from an x-ratelimit-reset-* header such as '6m0s', '1.5s' or '20ms'"""
+    if not value:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in DURATION_PART.findall(value))
+
+
+def retry_after(headers):
+    """Seconds the server asked us to wait, if it said"""
+    if headers is None:
+        return None
+    if headers.get('retry-after-ms'):
+        return float(headers['retry-after-ms']) / 1000
+    if headers.get('retry-after'):
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            return None
+    return None
+
+
+def estimate_tokens(request):
+    """Rough prompt + completion token count, ~4 characters per token"""
+    characters = sum(len(message.get('content') or '') for message in request.get('messages', []))
+    return characters // 4 + request.get('max_tokens', 0)
+
+
+class _Budget:
+    """Remaining allowance for one limit (requests or tokens) until its reset"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.remaining = limit
+        self.reset_at = time.monotonic() + 60.0
+
+    def refill_if_due(self, now):
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + 60.0
+
+    def update(self, limit, remaining, reset_seconds, now):
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            self.remaining = remaining
+        if reset_seconds is not None:
+            self.reset_at = now + reset_seconds
+
+
+class OpenAIScheduler:
+    """Queues chat completions to stay inside the requests- and tokens-per-minute limits.
+
+    Every response's x-ratelimit-* headers update the remaining budgets;
+    callers block until their request fits. 429s, 5xx errors, timeouts and
+    connection errors are retried with exponential backoff and jitter,
+    honouring retry-after, and the last error is raised once retries are
+    exhausted. Thread-safe, so one scheduler can serve every mailbox.
+    """
+
+    def __init__(self, client, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, max_retries=MAX_RETRIES,
+                 base_delay=1.0, max_delay=60.0):
+        # Retries happen here, where they can respect the shared budget
+        self.client = client.with_options(max_retries=0)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = _Budget(rpm)
+        self._tokens = _Budget(tpm)
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def _acquire(self, tokens):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._requests.refill_if_due(now)
+                self._tokens.refill_if_due(now)
+                # A single request larger than the whole budget can never fit;
+                # let it through once the window is full rather than block forever
+                token_need = min(tokens, self._tokens.limit)
+                if (now >= self._paused_until and self._requests.remaining >= 1
+                        and self._tokens.remaining >= token_need):
+                    self._requests.remaining -= 1
+                    self._tokens.remaining -= tokens
+                    return
+                wake_at = max(self._paused_until,
+                              min(self._requests.reset_at, self._tokens.reset_at))
+                self._condition.wait(max(0.01, wake_at - now))
+
+    def _update(self, headers):
+        def number(name):
+            value = headers.get(name)
+            return int(value) if value and value.isdigit() else None
+
+        with self._condition:
+            now = time.monotonic()
+            self._requests.update(number('x-ratelimit-limit-requests'),
+                                  number('x-ratelimit-remaining-requests'),
+                                  parse_reset(headers.get('x-ratelimit-reset-requests')), now)
+            self._tokens.update(number('x-ratelimit-limit-tokens'),
+                                number('x-ratelimit-remaining-tokens'),
+                                parse_reset(headers.get('x-ratelimit-reset-tokens')), now)
+            self._condition.notify_all()
+
+    def _pause(self, seconds):
+        """Hold back every caller, not just the one that got the 429"""
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _backoff(self, attempt, error):
+        import openai
+
+        response = getattr(error, 'response', None)
+        delay = retry_after(response.headers if response is not None else None)
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+        if isinstance(error, openai.RateLimitError):
+            self._pause(delay)
+        return delay
+
+    def chat(self, **request):
+        """chat.completions.create with budgeting and retries"""
+        import openai
+
+        tokens = estimate_tokens(request)
+        for attempt in range(self.max_retries + 1):
+            with timed('rate_limit_wait'):
+                self._acquire(tokens)
+            API_CALLS.inc(service='openai', method='chat.completions')
+            try:
+                raw = self.client.chat.completions.with_raw_response.create(**request)
+            except (openai.RateLimitError, openai.InternalServerError,
+                    openai.APITimeoutError, openai.APIConnectionError) as error:
+                if attempt == self.max_retries:
+                    raise
+                reason = 'rate_limit' if isinstance(error, openai.RateLimitError) else 'server'
+                RETRIES.inc(reason=reason)
+                delay = self._backoff(attempt, error)
+                log.warning("openai_retry", attempt=attempt + 1, reason=reason,
+                            delay=round(delay, 2), error=str(error))
+                time.sleep(delay)
+                continue
+            self._update(raw.headers)
+            response = raw.parse()
+            record_usage(response.usage)
+            return response
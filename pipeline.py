@@ -0,0 +1,81 @@
+"""Fetch/parse pipeline for backfills and archive runs.
+
+Turning a Gmail thread into text (base64 decoding, BeautifulSoup for
+HTML-only messages, the cleaning regexes, language detection) is CPU-bound,
+while fetching it is a network round trip. Done one after the other on one
+thread, each waits for the other. fetch_parse() overlaps them:
+
+- I/O threads fetch the raw API resources, a bounded number at a time;
+- fetched resources are grouped into chunks and parsed in a process pool on
+  every core. Chunks keep the pickling and IPC overhead to one round trip
+  per chunk_size resources.
+
+Results come back in input order. The parse function is sent to the worker
+processes, so it must be a module-level function (or a functools.partial of
+one) and return picklable values. With processes=0 the parsing happens in
+the calling thread, which is the better choice for a few dozen threads.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '8'))
+# 0 parses in the calling thread
+PARSE_PROCESSES = int(os.getenv('PARSE_PROCESSES', str(os.cpu_count() or 1)))
+PARSE_CHUNK_SIZE = int(os.getenv('PARSE_CHUNK_SIZE', '16'))
+
+
+def _parse_chunk(parse, chunk):
+    return [parse(resource) for resource in chunk]
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _bounded(executor, function, items, window, *args):
+    """executor.map with at most window calls in flight, so a 10,000-item
+    run does not hold every fetched payload in memory at once"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, *args, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def fetch_parse(items, fetch, parse, fetch_workers=None, processes=None, chunk_size=None):
+    """Yield parse(fetch(item)) for each item, in order.
+
+    fetch runs on fetch_workers threads and must be thread-safe (see
+    transport.build_gmail_service). An exception from either stage is raised
+    here when its result is reached.
+    """
+    fetch_workers = fetch_workers or FETCH_WORKERS
+    processes = PARSE_PROCESSES if processes is None else processes
+    chunk_size = chunk_size or PARSE_CHUNK_SIZE
+
+    with (ProcessPoolExecutor(processes) if processes else nullcontext()) as parse_pool:
+        if parse_pool is not None:
+            # The workers are forked on first use; fork them now, before the
+            # fetch threads exist, rather than from a multi-threaded process
+            parse_pool.submit(int).result()
+        with ThreadPoolExecutor(fetch_workers) as fetch_pool:
+            resources = _bounded(fetch_pool, fetch, items, fetch_workers * 2)
+            if parse_pool is None:
+                for resource in resources:
+                    yield parse(resource)
+                return
+            # Two chunks per worker: one being parsed, one queued
+            for results in _bounded(parse_pool, _parse_chunk, _chunks(resources, chunk_size),
+                                    processes * 2, parse):
+                yield from results
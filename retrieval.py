@@ -0,0 +1,111 @@
+import os
+import time
+
+from language import WORD_PATTERN, classify
+from metrics import API_CALLS, timed
+
+# Candidates fetched per query; re-ranking happens locally on these
+TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '10'))
+# Matches whose vector score is below this are never used as a reference
+MIN_SCORE = float(os.getenv('RETRIEVAL_MIN_SCORE', '0.3'))
+# Only consider replies sent in the last N days (0 = no recency filter)
+MAX_AGE_DAYS = int(os.getenv('RETRIEVAL_MAX_AGE_DAYS', '0'))
+# Age at which the recency feature has dropped to one half
+HALF_LIFE_DAYS = 180.0
+
+# Weights for: vector score, language match, recency, word overlap
+RERANK_WEIGHTS = (1.0, 0.5, 0.1, 0.3)
+
+
+def build_filter(language=None, max_age_days=0, now=None):
+    """Pinecone metadata filter for the language and recency constraints.
+
+    Vectors indexed before language was stored in the metadata pass the
+    language condition; the re-ranker classifies them instead.
+    """
+    conditions = []
+    if language:
+        conditions.append({"$or": [{"language": {"$eq": language}}, {"language": {"$exists": False}}]})
+    if max_age_days:
+        cutoff = (now or time.time()) - max_age_days * 86400
+        conditions.append({"sent_at": {"$gte": int(cutoff)}})
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def word_set(text):
+    return set(WORD_PATTERN.findall(text.lower()))
+
+
+def rerank(query_text, matches, language=None, now=None, weights=RERANK_WEIGHTS):
+    """Order matches by a weighted sum of cheap features.
+
+    The features are gathered into one (n, 4) matrix and scored with a single
+    matrix-vector product. Vectors indexed before language and sent_at were
+    stored in the metadata get their language classified from the stored
+    original message and a neutral recency.
+    """
+    import numpy as np
+
+    if not matches:
+        return []
+    now = now or time.time()
+    query_words = word_set(query_text)
+    features = np.zeros((len(matches), 4), dtype=np.float32)
+    for i, match in enumerate(matches):
+        metadata = match['metadata'] or {}
+        original = metadata.get('original_message', '')
+        match_language = metadata.get('language') or classify(original)[0]
+        sent_at = metadata.get('sent_at')
+        original_words = word_set(original)
+        union = len(query_words | original_words)
+
+        features[i, 0] = match['score']
+        features[i, 1] = 1.0 if language is None or match_language == language else 0.0
+        features[i, 2] = (now - sent_at) / 86400 if sent_at else HALF_LIFE_DAYS
+        features[i, 3] = len(query_words & original_words) / union if union else 0.0
+
+    features[:, 2] = np.exp2(-features[:, 2] / HALF_LIFE_DAYS)
+    scores = features @ np.asarray(weights, dtype=np.float32)
+    return [matches[i] for i in np.argsort(-scores, kind='stable')]
+
+
+class Retriever:
+    """Top-k vector search with metadata filters and local re-ranking"""
+
+    def __init__(self, index, embed, top_k=TOP_K, min_score=MIN_SCORE, max_age_days=MAX_AGE_DAYS):
+        self.index = index
+        self.embed = embed
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_age_days = max_age_days
+
+    def query(self, vector, metadata_filter):
+        API_CALLS.inc(service='pinecone', method='query')
+        with timed('vector_query'):
+            response = self.index.query(
+                top_k=self.top_k,
+                vector=vector,
+                filter=metadata_filter,
+                include_values=False,
+                include_metadata=True
+            )
+        return response.matches
+
+    def search(self, text, language=None):
+        """Return matches above the score threshold, best first"""
+        vector = self.embed(text)
+        matches = self.query(vector, build_filter(language, self.max_age_days))
+        matches = [match for match in matches if match['score'] >= self.min_score]
+        with timed('rerank'):
+            return rerank(text, matches, language)
+
+    def best_reply(self, text, language=None):
+        """The reference reply for text, or None when nothing is close enough"""
+        matches = self.search(text, language)
+        if not matches:
+            return None
+        return matches[0]['metadata'].get('reply_message')
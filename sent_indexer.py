@@ -0,0 +1,226 @@
+"""Keep the reply index up to date with the replies sent from the mailbox.
+
+The index otherwise only changes when a backfill (vector_search.py) or an
+archive run (indexing.py) is started by hand, so the replies sent every day
+never reach retrieval. This job follows the SENT label through the Gmail
+history API instead:
+
+- each poll asks for the messages added to SENT since the last history id;
+- every new reply of ours (recognised by the signature, as in indexing.py)
+  is paired with the customer message it answers: the latest message
+  before it in its thread that we did not send;
+- near-duplicates of a pair already seen in the same poll are left out
+  and counted on it, as in indexing.py (dedup.py), unless INDEX_DEDUP=0;
+  a poll's clusters do not reach back to the pairs indexed before it;
+- the pairs are embedded and upserted in micro-batches of at most
+  UPSERT_BATCH, with the reply's message id as vector id, the same id the
+  other jobs use, so a reply indexed twice is overwritten, not duplicated;
+- the history id of the last upserted reply is written to CACHE_DIR after
+  every batch, per index, so a restart resumes after it.
+
+The job follows the alias's active index version (index_versions.py). A
+new version starts from the history id of the version it replaced, which
+its rebuild already covered. Gmail keeps about a week of history: if the
+stored history id has expired, the job restarts from the current one and
+logs it, and `indexing.py` fills the gap from the archive.
+
+Usage: python sent_indexer.py [--once] [--token token_client.json]
+"""
+import os
+import time
+import argparse
+from typing import Dict, Iterator, Optional, Tuple
+
+from dedup import Deduplicator
+from indexing import INDEX_DEDUP, Pair, pair_record, upsert_pairs
+from index_versions import open_registry
+from models import SIGNATURE, EmailMessage, EmailThread
+from transport import CACHE_DIR, TransportConfig, read_cache, write_cache
+from metrics import api_call, get_logger, timed
+
+log = get_logger(__name__)
+
+SENT_POLL_SECONDS = int(os.getenv('SENT_POLL_SECONDS', '60'))
+HISTORY_PATH = os.path.join(CACHE_DIR, 'sent_history.json')
+HISTORY_PAGE_SIZE = 500
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+
+
+def read_history_id(index_name: str) -> Optional[int]:
+    value = (read_cache(HISTORY_PATH) or {}).get(index_name)
+    return int(value) if value else None
+
+
+def write_history_id(index_name: str, history_id: int):
+    history_ids = read_cache(HISTORY_PATH) or {}
+    history_ids[index_name] = str(history_id)
+    write_cache(HISTORY_PATH, history_ids)
+
+
+def answered_message(thread: EmailThread, reply: EmailMessage) -> Optional[EmailMessage]:
+    """The message reply answers: the latest one before it in the thread
+    that is neither sent by us nor a draft"""
+    answered = None
+    for message in thread:
+        if message.id == reply.id:
+            return answered
+        if not (message.has_label('SENT') or message.has_label('DRAFT')):
+            answered = message
+    return None
+
+
+class SentIndexer:
+    """Indexes the replies added to SENT since the last poll"""
+
+    def __init__(self, service, pc, transport=None, registry=None, dedup=INDEX_DEDUP):
+        self.service = service
+        self.dedup = dedup
+        self.pc = pc
+        self.transport = transport or TransportConfig()
+        self.registry = registry or open_registry()
+        self.version = None
+        self.index = None
+        # History id of the change the pairs generator is at
+        self._position = None
+
+    def _connect(self):
+        """Follow the alias's active version; returns the history id to start from"""
+        from gmail_auto_response import connect_index
+
+        version = self.registry.active()
+        if version != self.version:
+            previous = self.version
+            self.index = connect_index(self.pc, self.transport, index_name=version.name, version=version,
+                                       writable=True)
+            self.version = version
+            if previous is not None:
+                log.info("sent_index_switched", index=version.name, previous=previous.name)
+        start = read_history_id(version.name)
+        if start is None:
+            previous = self.registry.previous()
+            start = read_history_id(previous.name) if previous is not None else None
+        return start
+
+    def current_history_id(self) -> int:
+        profile = api_call('gmail', 'getProfile', self.service.users().getProfile(userId='me'))
+        return int(profile['historyId'])
+
+    def sent_changes(self, start: int) -> Iterator[Tuple[int, str, str]]:
+        """(history id, message id, thread id) of the messages added to SENT
+        after start, oldest first"""
+        page_token = None
+        while True:
+            response = api_call('gmail', 'history.list', self.service.users().history().list(
+                userId='me', startHistoryId=str(start), labelId='SENT', historyTypes=['messageAdded'],
+                maxResults=HISTORY_PAGE_SIZE, pageToken=page_token))
+            for record in response.get('history', []):
+                history_id = int(record.get('id', response['historyId']))
+                for added in record.get('messagesAdded', []):
+                    message = added['message']
+                    if 'SENT' in message.get('labelIds', ()):
+                        yield history_id, message['id'], message['threadId']
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                self._position = max(self._position or start, int(response['historyId']))
+                return
+
+    def pairs(self, start: int) -> Iterator[Pair]:
+        """Pairs of our replies sent after start, oldest first"""
+        threads: Dict[str, EmailThread] = {}
+        for history_id, message_id, thread_id in self.sent_changes(start):
+            self._position = history_id
+            try:
+                # Replies sent together in one thread share the fetch
+                if thread_id not in threads:
+                    with timed('thread_fetch'):
+                        threads[thread_id] = EmailThread.from_gmail(api_call(
+                            'gmail', 'threads.get', self.service.users().threads().get(
+                                userId='me', id=thread_id, format='full')))
+            except Exception as error:
+                # Deleted since it was sent; nothing to index
+                log.warning("sent_fetch_failed", message_id=message_id, error=str(error))
+                continue
+            thread = threads[thread_id]
+            reply = next((entry for entry in thread if entry.id == message_id), None)
+            if reply is None or SIGNATURE not in reply.body:
+                continue
+            original = answered_message(thread, reply)
+            if original is None:
+                continue
+            yield pair_record(reply.id, original.body, reply.body, reply.sent_at)
+
+    def poll_once(self) -> int:
+        """Index the replies sent since the last poll; returns how many were upserted"""
+        start = self._connect()
+        index_name = self.version.name
+        if start is None:
+            # First run: the archive jobs cover what was sent before now
+            write_history_id(index_name, self.current_history_id())
+            log.info("sent_indexing_started", index=index_name)
+            return 0
+        self._position = None
+
+        def save_position():
+            if self._position is not None:
+                write_history_id(index_name, self._position)
+
+        pairs = self.pairs(start)
+        deduplicator = Deduplicator() if self.dedup else None
+        if deduplicator is not None:
+            pairs = deduplicator.filter(pairs)
+        try:
+            count = upsert_pairs(self.pc, self.index, pairs, on_flush=save_position,
+                                 model=self.version.model)
+        except Exception as error:
+            if getattr(getattr(error, 'resp', None), 'status', None) != 404:
+                raise
+            # startHistoryId is older than the history Gmail keeps
+            log.warning("sent_history_expired", index=index_name, history_id=start)
+            write_history_id(index_name, self.current_history_id())
+            return 0
+        save_position()
+        if deduplicator is not None and deduplicator.apply(self.index):
+            log.info("sent_replies_deduplicated", index=index_name, **deduplicator.report())
+        if count:
+            log.info("sent_replies_indexed", index=index_name, upserted=count)
+        return count
+
+    def run(self, interval: float = SENT_POLL_SECONDS):
+        while True:
+            try:
+                self.poll_once()
+            except Exception as error:
+                log.exception("sent_indexing_failed", error=str(error))
+            time.sleep(interval)
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+    from transport import build_gmail_service, build_pinecone
+    from metrics import configure_logging
+
+    parser = argparse.ArgumentParser(description="Index replies as they are sent")
+    parser.add_argument('--token', default='token_client.json')
+    parser.add_argument('--once', action='store_true', help="poll once and exit")
+    args = parser.parse_args()
+
+    configure_logging()
+    creds = Credentials.from_authorized_user_file(args.token, SCOPES)
+    if not creds.valid and creds.refresh_token:
+        creds.refresh(Request())
+    transport = TransportConfig()
+    indexer = SentIndexer(build_gmail_service(creds, transport),
+                          build_pinecone(os.environ.get("PINECONE_API_KEY"), transport), transport)
+    if args.once:
+        indexer.poll_once()
+    else:
+        indexer.run()
+
+
+if __name__ == '__main__':
+    main()
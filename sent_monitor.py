@@ -6,10 +6,11 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from pymongo import MongoClient
 from datetime import datetime
-import base64
 from email.mime.text import MIMEText
 import json
 import dotenv
+from models import EmailMessage, EmailThread
+from body_codec import archive_codec, encode_document
 dotenv.load_dotenv()
 # Gmail API scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
@@ -56,65 +57,19 @@ class GmailMongoDB:
         """Extract email content from Gmail message."""
         if 'payload' not in message:
             return None
+        return EmailMessage.from_gmail(message).to_document(stored_at=datetime.utcnow())
 
-        headers = message['payload']['headers']
-        subject = next((header['value'] for header in headers if header['name'].lower() == 'subject'), 'No Subject')
-        sender = next((header['value'] for header in headers if header['name'].lower() == 'from'), 'Unknown Sender')
-        to = next((header['value'] for header in headers if header['name'].lower() == 'to'), 'Unknown Recipient')
-        date = next((header['value'] for header in headers if header['name'].lower() == 'date'), None)
-
-        # Get email body
-        body = ''
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                if part['mimeType'] == 'text/plain':
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode()
-                    break
-        elif 'body' in message['payload'] and 'data' in message['payload']['body']:
-            body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode()
-
-        return {
-            'message_id': message['id'],
-            'thread_id': message['threadId'],
-            'subject': subject,
-            'sender': sender,
-            'to': to,
-            'date': date,
-            'body': body,
-            'snippet': message.get('snippet', ''),
-            'labels': message.get('labelIds', []),
-            'stored_at': datetime.utcnow()
-        }
-
-    def get_thread_messages(self, thread_id):
-        """Fetch all messages in a thread."""
+    def get_thread(self, thread_id):
+        """Fetch a thread with every message in full."""
         if not self.gmail_service:
             self.authenticate_gmail()
 
-        thread = self.gmail_service.users().threads().get(
-            userId='me', id=thread_id).execute()
-        
-        messages = []
-        for message in thread['messages']:
-            email_data = self.get_email_content(message)
-            if email_data:
-                # Create a version of the message for thread context that includes body
-                thread_message = {
-                    'message_id': email_data['message_id'],
-                    'thread_id': email_data['thread_id'],
-                    'subject': email_data['subject'],
-                    'sender': email_data['sender'],
-                    'to': email_data['to'],
-                    'date': email_data['date'],
-                    'snippet': email_data['snippet'],
-                    'body': email_data['body'],  # Include the body content
-                    'labels': email_data['labels']  # Include labels as well
-                }
-                messages.append(thread_message)
-        
-        # Sort messages by date
-        messages.sort(key=lambda x: x['date'] if x['date'] else '')
-        return messages
+        return EmailThread.from_gmail(self.gmail_service.users().threads().get(
+            userId='me', id=thread_id).execute())
+
+    def get_thread_messages(self, thread_id):
+        """Fetch all messages in a thread, sorted by date."""
+        return self.get_thread(thread_id).entries()
 
     def fetch_and_store_emails(self, max_results=30):
         """Fetch emails from Gmail SENT and store them in MongoDB with thread messages included."""
@@ -135,6 +90,8 @@ class GmailMongoDB:
 
         # Collection for storing emails
         emails_collection = self.db['email_history']
+        # Bodies are stored zstd-compressed (see body_codec.py)
+        codec = archive_codec(self.db)
 
         # Keep track of processed threads to avoid duplicates
         processed_threads = set()
@@ -149,37 +106,24 @@ class GmailMongoDB:
             if thread_id in processed_threads:
                 continue
 
-            # Get all messages in the thread
-            thread_messages = self.get_thread_messages(thread_id)
+            # Get all messages in the thread; threads.get already returns
+            # them in full, so they are not fetched again one by one
+            thread = self.get_thread(thread_id)
             
-            if thread_messages:
+            if len(thread):
                 # Store each message with its thread context
-                for msg in thread_messages:
-                    # Get the full message details for the current message
-                    full_message = self.gmail_service.users().messages().get(
-                        userId='me', 
-                        id=msg['message_id'],
-                        format='full'  # Get full message details
-                    ).execute()
-                    email_data = self.get_email_content(full_message)
-                    
-                    if email_data:
-                        # Add thread context without creating circular references
-                        email_data['thread_context'] = {
-                            'thread_id': thread_id,
-                            'message_count': len(thread_messages),
-                            'messages': thread_messages
-                        }
-                        # Only store if the message is in inbox
-                        if 'SENT' in email_data['labels']:
-                            emails_collection.update_one(
-                                {'message_id': email_data['message_id']},
-                                {'$set': email_data},
-                                upsert=True
-                            )
+                for message in thread:
+                    # Only store if the message is in SENT
+                    if message.has_label('SENT'):
+                        email_data = message.to_document(thread, stored_at=datetime.utcnow())
+                        emails_collection.update_one(
+                            {'message_id': email_data['message_id']},
+                            {'$set': encode_document(email_data, codec)},
+                            upsert=True
+                        )
                 
                 processed_threads.add(thread_id)
-                print(f"Stored thread {thread_id} with {len(thread_messages)} messages")
+                print(f"Stored thread {thread_id} with {len(thread)} messages")
 
         return len(processed_threads)
 
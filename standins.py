@@ -0,0 +1,743 @@
+"""Local stand-ins for Gmail, OpenAI and Pinecone.
+
+Used by the offline benchmarks so the pipeline can be measured without live
+accounts. Gmail and OpenAI are real HTTP servers on 127.0.0.1, so the real
+googleapiclient and openai clients (and their connection pools) are
+exercised end to end. Pinecone is an in-process object with the same
+interface as the client, because its wire protocol is not practical to
+reproduce. All three inject a configurable latency and error rate and count
+every call they receive.
+"""
+import os
+import re
+import json
+import time
+import base64
+import random
+import hashlib
+import datetime
+import threading
+from collections import Counter
+from email import message_from_bytes
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DIMENSION = 1024
+OWN_ADDRESS = 'info@fastbookads.com'
+SIGNATURE = "\n\nNoemi\nCustomer Success Assistant\nfastbookads.com <http://bit.ly/emailstand\n"
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'message_data.txt')
+
+
+class Faults:
+    """Injected latency and error rate shared by a stand-in's endpoints"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            extra = self._random.uniform(0, self.jitter) if self.jitter else 0.0
+            fail = self._random.random() < self.error_rate
+        if self.latency or extra:
+            time.sleep(self.latency + extra)
+        return fail
+
+
+def load_paragraphs(path=CORPUS_PATH):
+    """Paragraphs of the anonymizable message_data.txt dump, used as synthetic bodies"""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n', text)]
+    return [p for p in paragraphs if len(p) > 40]
+
+
+def encode_body(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+class Mailbox:
+    """In-memory Gmail mailbox that the Gmail stand-in serves"""
+
+    def __init__(self, seed=0, bulk_ratio=0.0, follow_up_ratio=0.0):
+        self.messages = {}
+        self.threads = {}
+        self.drafts = {}
+        self.history = []
+        self.bulk_ratio = bulk_ratio
+        self.follow_up_ratio = follow_up_ratio
+        self._customer_threads = []
+        self._next_draft = 1
+        self._random = random.Random(seed)
+        self._paragraphs = load_paragraphs()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def _new_id(self):
+        value = f"{self._next_id:016x}"
+        self._next_id += 1
+        return value
+
+    def _body(self, paragraphs=2):
+        return "\n\n".join(self._random.choice(self._paragraphs) for _ in range(paragraphs))
+
+    def add_message(self, thread_id, sender, to, subject, body, labels, extra_headers=(),
+                    internal_date=None):
+        with self._lock:
+            message_id = self._new_id()
+            thread_id = thread_id or message_id
+            internal_date = internal_date or int(time.time() * 1000)
+            headers = [
+                {'name': 'From', 'value': sender},
+                {'name': 'To', 'value': to},
+                {'name': 'Subject', 'value': subject},
+                {'name': 'Date', 'value': format_datetime(
+                    datetime.datetime.fromtimestamp(internal_date / 1000, datetime.timezone.utc))},
+                {'name': 'Message-ID', 'value': f"<{message_id}@standin.local>"},
+            ] + [{'name': name, 'value': value} for name, value in extra_headers]
+            self.messages[message_id] = {
+                'id': message_id,
+                'threadId': thread_id,
+                'labelIds': list(labels),
+                'snippet': body[:100],
+                'internalDate': str(internal_date),
+                'historyId': str(self._next_id),
+                'payload': {
+                    'mimeType': 'multipart/alternative',
+                    'headers': headers,
+                    'parts': [
+                        {'mimeType': 'text/plain', 'filename': '', 'body': {'data': encode_body(body)}},
+                        {'mimeType': 'text/html', 'filename': '',
+                         'body': {'data': encode_body('<div>' + body.replace('\n', '<br>') + '</div>')}},
+                    ]
+                }
+            }
+            self.threads.setdefault(thread_id, []).append(message_id)
+            self.history.append((int(self._next_id), message_id))
+            return self.messages[message_id]
+
+    def deliver(self, count):
+        """New unread customer messages, a bulk_ratio share of them newsletters
+        and a follow_up_ratio share sent into one of the last customer threads"""
+        delivered = []
+        for i in range(count):
+            if self._customer_threads and self._random.random() < self.follow_up_ratio:
+                thread_id, sender, subject = self._random.choice(self._customer_threads[-10:])
+                delivered.append(self.add_message(
+                    thread_id, sender, OWN_ADDRESS, f"Re: {subject}", self._body(1),
+                    ['INBOX', 'UNREAD']))
+            elif self._random.random() < self.bulk_ratio:
+                delivered.append(self.add_message(
+                    None, 'Newsletter <news@mail.zapier.com>', OWN_ADDRESS, 'Weekly digest',
+                    self._body(4), ['INBOX', 'UNREAD'],
+                    extra_headers=[('List-Unsubscribe', '<mailto:unsub@mail.zapier.com>'),
+                                   ('Precedence', 'bulk')]))
+            else:
+                n = self._random.randrange(10000)
+                message = self.add_message(
+                    None, f"Customer {n} <customer{n}@example.com>", OWN_ADDRESS,
+                    f"Richiesta {n}", self._body(), ['INBOX', 'UNREAD'])
+                self._customer_threads.append((message['threadId'], f"Customer {n} <customer{n}@example.com>",
+                                               f"Richiesta {n}"))
+                delivered.append(message)
+        return delivered
+
+    def save_draft(self, draft_id, thread_id, raw):
+        """Create (draft_id None) or replace a draft. Like Gmail, every save
+        gives the draft a new message, which shows up in its thread."""
+        with self._lock:
+            if draft_id is None:
+                draft_id = f"r{self._next_draft}"
+                self._next_draft += 1
+            else:
+                self.discard_draft(draft_id)
+            message_id = self._new_id()
+            parsed = message_from_bytes(base64.urlsafe_b64decode(raw)) if raw else {}
+            message = {
+                'id': message_id,
+                'threadId': thread_id or message_id,
+                'labelIds': ['DRAFT'],
+                'snippet': '',
+                'internalDate': str(int(time.time() * 1000)),
+                'payload': {'mimeType': 'message/rfc822', 'parts': [],
+                            'headers': [{'name': name, 'value': value}
+                                        for name, value in (parsed.items() if raw else [])]},
+            }
+            self.messages[message_id] = message
+            self.threads.setdefault(message['threadId'], []).append(message_id)
+            self.drafts[draft_id] = {'id': draft_id, 'message': message}
+            return self.drafts[draft_id]
+
+    def discard_draft(self, draft_id):
+        draft = self.drafts.pop(draft_id, None)
+        if draft is not None:
+            message = self.messages.pop(draft['message']['id'])
+            self.threads[message['threadId']].remove(message['id'])
+
+    def seed_history(self, count):
+        """Answered threads (customer message + signed reply) for the indexing job"""
+        for i in range(count):
+            original = self.add_message(
+                None, f"Customer {i} <customer{i}@example.com>", OWN_ADDRESS, f"Domanda {i}",
+                self._body(), ['INBOX'])
+            self.add_message(
+                original['threadId'], f"Fast Book Ads <{OWN_ADDRESS}>", f"customer{i}@example.com",
+                f"Re: Domanda {i}", self._body(1) + SIGNATURE, ['SENT'],
+                extra_headers=[('In-Reply-To', f"<{original['id']}@standin.local>")])
+
+
+class StandinServer(ThreadingHTTPServer):
+    """Threaded HTTP/1.1 server with fault injection and per-route call counts"""
+
+    daemon_threads = True
+
+    def __init__(self, faults=None):
+        self.faults = faults or Faults()
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+        handler = type('Handler', (_Handler,), {'standin': self})
+        super().__init__(('127.0.0.1', 0), handler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, route):
+        with self._calls_lock:
+            self.calls[route] += 1
+
+    def route(self, method, path, query, body):
+        """Return (status, payload, headers); implemented by subclasses"""
+        raise NotImplementedError
+
+    def error_response(self):
+        return 500, {'error': {'code': 500, 'message': 'injected failure'}}, {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    standin = None
+
+    def _handle(self, method):
+        parsed = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if self.standin.faults.delay():
+            status, payload, headers = self.standin.error_response()
+            self.standin.count('error')
+        else:
+            status, payload, headers = self.standin.route(
+                method, parsed.path, parse_qs(parsed.query), raw)
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', headers.pop('Content-Type', 'application/json'))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _metadata_view(message, header_names):
+    wanted = {name.lower() for name in header_names}
+    payload = message['payload']
+    return {
+        **{key: value for key, value in message.items() if key != 'payload'},
+        'payload': {
+            'mimeType': payload['mimeType'],
+            'headers': [h for h in payload['headers'] if not wanted or h['name'].lower() in wanted]
+        }
+    }
+
+
+class GmailStandin(StandinServer):
+    """Serves the subset of the Gmail v1 REST API the project uses"""
+
+    PREFIX = '/gmail/v1/users/me/'
+
+    def __init__(self, mailbox, faults=None):
+        self.mailbox = mailbox
+        super().__init__(faults)
+
+    def route(self, method, path, query, body):
+        if not path.startswith(self.PREFIX):
+            return 404, {'error': {'code': 404, 'message': path}}, {}
+        parts = path[len(self.PREFIX):].split('/')
+        resource, item = parts[0], parts[1] if len(parts) > 1 else None
+        self.count(f"{resource}.{method}{'' if item is None else '.item'}")
+        mailbox = self.mailbox
+        first = lambda name, default=None: query.get(name, [default])[0]
+
+        if resource == 'profile':
+            return 200, {'emailAddress': OWN_ADDRESS,
+                         'historyId': str(mailbox.history[-1][0] if mailbox.history else 1)}, {}
+
+        if resource == 'messages' and item is None:
+            labels = set(query.get('labelIds', []))
+            q = first('q', '')
+            if 'is:unread' in q:
+                labels.add('UNREAD')
+            if 'in:inbox' in q:
+                labels.add('INBOX')
+            found = [{'id': m['id'], 'threadId': m['threadId']}
+                     for m in reversed(list(mailbox.messages.values()))
+                     if labels <= set(m['labelIds'])]
+            start = int(first('pageToken') or 0)
+            end = start + int(first('maxResults', 100))
+            page = {'messages': found[start:end]}
+            if end < len(found):
+                page['nextPageToken'] = str(end)
+            return 200, page, {}
+
+        if resource == 'messages':
+            message = mailbox.messages.get(item)
+            if message is None:
+                return 404, {'error': {'code': 404, 'message': 'not found'}}, {}
+            if first('format') == 'metadata':
+                return 200, _metadata_view(message, query.get('metadataHeaders', [])), {}
+            return 200, message, {}
+
+        if resource == 'threads' and item is None:
+            labels = set(query.get('labelIds', []))
+            found = [{'id': thread_id} for thread_id, ids in mailbox.threads.items()
+                     if any(labels <= set(mailbox.messages[i]['labelIds']) for i in ids)]
+            return 200, {'threads': found[:int(first('maxResults', 100))]}, {}
+
+        if resource == 'threads':
+            ids = mailbox.threads.get(item)
+            if ids is None:
+                return 404, {'error': {'code': 404, 'message': 'not found'}}, {}
+            # A draft may be replaced while the thread is being read
+            messages = [mailbox.messages[i] for i in list(ids) if i in mailbox.messages]
+            if first('format') == 'metadata':
+                messages = [_metadata_view(m, query.get('metadataHeaders', [])) for m in messages]
+            return 200, {'id': item, 'messages': messages}, {}
+
+        if resource == 'drafts':
+            return self._drafts(method, item, query, body)
+
+        if resource == 'history':
+            start = int(first('startHistoryId', '0'))
+            label = first('labelId')
+            records = [{'id': str(history_id),
+                        'messagesAdded': [{'message': {'id': i, 'threadId': mailbox.messages[i]['threadId'],
+                                                       'labelIds': mailbox.messages[i]['labelIds']}}]}
+                       for history_id, i in mailbox.history
+                       if history_id > start and i in mailbox.messages
+                       and (label is None or label in mailbox.messages[i]['labelIds'])]
+            latest = mailbox.history[-1][0] if mailbox.history else start
+            return 200, {'history': records, 'historyId': str(latest)}, {}
+
+        return 404, {'error': {'code': 404, 'message': path}}, {}
+
+    def _drafts(self, method, item, query, body):
+        mailbox = self.mailbox
+        if item is not None and item not in mailbox.drafts:
+            return 404, {'error': {'code': 404, 'message': 'not found'}}, {}
+        if method == 'POST' or method == 'PUT':
+            message = json.loads(body or b'{}').get('message', {})
+            draft = mailbox.save_draft(item, message.get('threadId'), message.get('raw', ''))
+            return 200, {'id': draft['id'], 'message': {'id': draft['message']['id'],
+                                                        'threadId': draft['message']['threadId']}}, {}
+        if method == 'DELETE':
+            mailbox.discard_draft(item)
+            return 204, b'', {}
+        if item is not None:
+            draft = mailbox.drafts[item]
+            message = draft['message']
+            if query.get('format', ['full'])[0] == 'minimal':
+                message = {key: value for key, value in message.items() if key != 'payload'}
+            return 200, {'id': draft['id'], 'message': message}, {}
+        return 200, {'drafts': [{'id': d['id'], 'message': {'id': d['message']['id'],
+                                                            'threadId': d['message']['threadId']}}
+                                for d in mailbox.drafts.values()]}, {}
+
+
+def gmail_service(url):
+    """A real googleapiclient Gmail service pointed at a GmailStandin.
+
+    Like transport.build_gmail_service, every thread gets its own
+    connection, so the service can be shared by worker threads.
+    """
+    import httplib2
+    import googleapiclient
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.http import HttpRequest
+
+    local = threading.local()
+
+    def http_for_thread():
+        if not hasattr(local, 'http'):
+            local.http = httplib2.Http()
+        return local.http
+
+    def request_builder(http, *args, **kwargs):
+        return HttpRequest(http_for_thread(), *args, **kwargs)
+
+    path = os.path.join(os.path.dirname(googleapiclient.__file__),
+                        'discovery_cache', 'documents', 'gmail.v1.json')
+    with open(path, 'r', encoding='utf-8') as f:
+        document = json.load(f)
+    document['rootUrl'] = url
+    document['baseUrl'] = url
+    return build_from_document(document, http=http_for_thread(), requestBuilder=request_builder)
+
+
+class OpenAIStandin(StandinServer):
+    """Serves /v1/chat/completions with canned replies and rate-limit headers,
+    plus the /v1/files and /v1/batches endpoints the Batch API mode uses.
+
+    A batch completes on its batch_polls-th retrieve; each request in it
+    fails with the injected error rate so partial results can be exercised.
+    """
+
+    def __init__(self, faults=None, reply="Ciao! Grazie per il messaggio, ti rispondo a breve :)",
+                 batch_polls=2):
+        self.reply = reply
+        self.tokens = Counter()
+        self.batch_polls = batch_polls
+        self.files = {}
+        self.batches = {}
+        self.prefixes = set()
+        self._store_lock = threading.Lock()
+        super().__init__(faults)
+
+    def error_response(self):
+        # Mix of rate limiting and server errors, like the real API under load
+        if random.random() < 0.5:
+            return 429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}}, {
+                'retry-after-ms': '50'}
+        return 500, {'error': {'message': 'injected failure', 'type': 'server_error'}}, {}
+
+    def route(self, method, path, query, body):
+        parts = path.strip('/').split('/')
+        # Count files and batches by route, not by id
+        if parts[1:2] in (['files'], ['batches']) and len(parts) > 2:
+            self.count(f"{method} /{'/'.join(parts[:2] + ['{id}'] + parts[3:])}")
+        else:
+            self.count(f"{method} {path}")
+        if path == '/v1/chat/completions':
+            return self.chat_completion(json.loads(body))
+        if parts[:2] == ['v1', 'files']:
+            if method == 'POST' and len(parts) == 2:
+                return self.upload_file(body)
+            if len(parts) == 4 and parts[3] == 'content' and parts[2] in self.files:
+                return 200, self.files[parts[2]]['content'], {'Content-Type': 'application/octet-stream'}
+            if len(parts) == 3 and parts[2] in self.files:
+                return 200, self.files[parts[2]]['object'], {}
+        if parts[:2] == ['v1', 'batches']:
+            if method == 'POST' and len(parts) == 2:
+                return self.create_batch(json.loads(body))
+            if len(parts) == 3 and parts[2] in self.batches:
+                return 200, self.retrieve_batch(parts[2]), {}
+        return 404, {'error': {'message': path}}, {}
+
+    def store_file(self, content, filename, purpose):
+        with self._store_lock:
+            file_id = f"file-{len(self.files) + 1:06d}"
+            self.files[file_id] = {'content': content, 'object': {
+                'id': file_id, 'object': 'file', 'bytes': len(content),
+                'created_at': int(time.time()), 'filename': filename,
+                'purpose': purpose, 'status': 'processed'}}
+        return self.files[file_id]['object']
+
+    def upload_file(self, body):
+        """multipart/form-data upload with 'purpose' and 'file' fields"""
+        from email.parser import BytesParser
+        from email.policy import HTTP
+
+        boundary = body.split(b'\r\n', 1)[0][2:].decode()
+        form = BytesParser(policy=HTTP).parsebytes(
+            f'Content-Type: multipart/form-data; boundary="{boundary}"\r\n\r\n'.encode() + body)
+        fields = {part.get_param('name', header='content-disposition'): part
+                  for part in form.iter_parts()}
+        upload = fields['file']
+        return 200, self.store_file(upload.get_payload(decode=True), upload.get_filename(),
+                                    fields['purpose'].get_content().strip()), {}
+
+    def create_batch(self, request):
+        now = int(time.time())
+        with self._store_lock:
+            batch_id = f"batch_{len(self.batches) + 1:06d}"
+            self.batches[batch_id] = {
+                'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'],
+                'input_file_id': request['input_file_id'],
+                'completion_window': request['completion_window'],
+                'metadata': request.get('metadata'), 'status': 'validating',
+                'created_at': now, 'output_file_id': None, 'error_file_id': None,
+                'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+                '_polls': 0,
+            }
+        return 200, self.public_batch(batch_id), {}
+
+    def public_batch(self, batch_id):
+        return {key: value for key, value in self.batches[batch_id].items()
+                if not key.startswith('_')}
+
+    def retrieve_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        batch['_polls'] += 1
+        if batch['status'] == 'validating':
+            batch['status'] = 'in_progress'
+        if batch['status'] == 'in_progress' and batch['_polls'] >= self.batch_polls:
+            self.run_batch(batch)
+        return self.public_batch(batch_id)
+
+    def run_batch(self, batch):
+        """Answer every request in the input file, splitting output and errors"""
+        output, errors = [], []
+        content = self.files[batch['input_file_id']]['content'].decode('utf-8')
+        for n, line in enumerate(content.splitlines()):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if random.random() < self.faults.error_rate:
+                errors.append({'id': f"batch_req_{n}", 'custom_id': item['custom_id'],
+                               'response': {'status_code': 500, 'request_id': f"req_{n}",
+                                            'body': {'error': {'message': 'injected failure'}}},
+                               'error': None})
+                continue
+            _, completion, _ = self.chat_completion(item['body'])
+            output.append({'id': f"batch_req_{n}", 'custom_id': item['custom_id'],
+                           'response': {'status_code': 200, 'request_id': f"req_{n}",
+                                        'body': completion},
+                           'error': None})
+
+        def jsonl(records):
+            return ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+        if output:
+            batch['output_file_id'] = self.store_file(
+                jsonl(output), f"{batch['id']}_output.jsonl", 'batch_output')['id']
+        if errors:
+            batch['error_file_id'] = self.store_file(
+                jsonl(errors), f"{batch['id']}_error.jsonl", 'batch_output')['id']
+        batch['request_counts'] = {'total': len(output) + len(errors),
+                                   'completed': len(output), 'failed': len(errors)}
+        batch['status'] = 'completed'
+        batch['completed_at'] = int(time.time())
+
+    def cached_prefix_tokens(self, text):
+        """Emulate OpenAI prompt caching: the longest previously seen prefix,
+        in 128-token steps from 1024 tokens, at ~4 characters per token"""
+        cached, matching = 0, True
+        with self._store_lock:
+            for tokens in range(1024, len(text) // 4 + 1, 128):
+                key = hashlib.md5(text[:tokens * 4].encode()).digest()
+                matching = matching and key in self.prefixes
+                if matching:
+                    cached = tokens
+                self.prefixes.add(key)
+        return cached
+
+    def chat_completion(self, request):
+        prompt = ''.join(m.get('content') or '' for m in request['messages'])
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(self.reply) // 4
+        cached_tokens = self.cached_prefix_tokens(prompt)
+        self.tokens['prompt'] += prompt_tokens
+        self.tokens['cached_prompt'] += cached_tokens
+        self.tokens['completion'] += completion_tokens
+        return 200, {
+            'id': f"chatcmpl-{hashlib.md5(json.dumps(request).encode()).hexdigest()[:12]}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'gpt-4o'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': self.reply}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens,
+                      'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+        }, {
+            'x-ratelimit-limit-requests': '10000',
+            'x-ratelimit-remaining-requests': '9999',
+            'x-ratelimit-reset-requests': '6ms',
+            'x-ratelimit-limit-tokens': '2000000',
+            'x-ratelimit-remaining-tokens': str(2000000 - prompt_tokens),
+            'x-ratelimit-reset-tokens': '1ms',
+        }
+
+
+def pseudo_embedding(text, dimension=DIMENSION):
+    """Deterministic hashed bag-of-words vector, normalized like a real embedding"""
+    import numpy as np
+
+    vector = np.zeros(dimension, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        vector[int(hashlib.md5(word.encode()).hexdigest()[:8], 16) % dimension] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def _matches_filter(metadata, condition):
+    if not condition:
+        return True
+    for key, test in condition.items():
+        if key == '$and':
+            if not all(_matches_filter(metadata, c) for c in test):
+                return False
+            continue
+        if key == '$or':
+            if not any(_matches_filter(metadata, c) for c in test):
+                return False
+            continue
+        value = metadata.get(key)
+        if not isinstance(test, dict):
+            test = {'$eq': test}
+        for op, expected in test.items():
+            if op == '$exists':
+                if (value is not None) != expected:
+                    return False
+                continue
+            if value is None:
+                return False
+            if op == '$eq' and value != expected or op == '$ne' and value == expected:
+                return False
+            if op == '$gte' and value < expected or op == '$lte' and value > expected:
+                return False
+            if op == '$gt' and value <= expected or op == '$lt' and value >= expected:
+                return False
+            if op == '$in' and value not in expected or op == '$nin' and value in expected:
+                return False
+    return True
+
+
+class _QueryResponse:
+    def __init__(self, matches):
+        self.matches = matches
+
+
+class IndexStandin:
+    """In-memory stand-in for a Pinecone Index handle"""
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.vectors = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors, namespace=None, **kwargs):
+        self.owner.call('upsert')
+        with self._lock:
+            for vector in vectors:
+                self.vectors[vector['id']] = (vector['values'], dict(vector.get('metadata') or {}))
+        return {'upserted_count': len(vectors)}
+
+    def query(self, top_k, vector=None, filter=None, include_values=False, include_metadata=False,
+              namespace=None, **kwargs):
+        import numpy as np
+
+        self.owner.call('query')
+        with self._lock:
+            items = [(vid, values, metadata) for vid, (values, metadata) in self.vectors.items()
+                     if _matches_filter(metadata, filter)]
+        if not items:
+            return _QueryResponse([])
+        scores = np.asarray([values for _, values, _ in items], dtype=np.float32) @ np.asarray(
+            vector, dtype=np.float32)
+        order = np.argsort(-scores)[:top_k]
+        return _QueryResponse([{
+            'id': items[i][0],
+            'score': float(scores[i]),
+            'values': items[i][1] if include_values else [],
+            'metadata': items[i][2] if include_metadata else None,
+        } for i in order])
+
+    def fetch(self, ids, namespace=None, **kwargs):
+        self.owner.call('fetch')
+        with self._lock:
+            return {'vectors': {i: {'id': i, 'values': self.vectors[i][0],
+                                    'metadata': self.vectors[i][1]}
+                                for i in ids if i in self.vectors}}
+
+    def update(self, id, values=None, set_metadata=None, namespace=None, **kwargs):
+        self.owner.call('update')
+        with self._lock:
+            if id in self.vectors:
+                current, metadata = self.vectors[id]
+                metadata.update(set_metadata or {})
+                self.vectors[id] = (values if values is not None else current, metadata)
+
+    def delete(self, ids=None, delete_all=False, namespace=None, **kwargs):
+        self.owner.call('delete')
+        with self._lock:
+            if delete_all:
+                self.vectors.clear()
+            for i in ids or ():
+                self.vectors.pop(i, None)
+
+    def describe_index_stats(self, **kwargs):
+        return {'total_vector_count': len(self.vectors), 'dimension': DIMENSION}
+
+
+class _IndexDescription:
+    def __init__(self, name):
+        self.name = name
+        self.host = f"{name}.standin.local"
+        self.dimension = DIMENSION
+        self.metric = 'dotproduct'
+
+
+class PineconeStandin:
+    """In-process stand-in for the Pinecone client (control plane, inference, indexes)"""
+
+    def __init__(self, faults=None):
+        self.faults = faults or Faults()
+        self.calls = Counter()
+        self.indexes = {}
+        self._lock = threading.Lock()
+        self.inference = self
+
+    def call(self, route):
+        with self._lock:
+            self.calls[route] += 1
+        if self.faults.delay():
+            self.calls['error'] += 1
+            raise RuntimeError(f"injected Pinecone failure in {route}")
+
+    def embed(self, model, inputs, parameters=None):
+        self.call('embed')
+        return [{'values': pseudo_embedding(text)} for text in inputs]
+
+    def has_index(self, name):
+        return name in self.indexes
+
+    def create_index(self, name, **kwargs):
+        self.indexes.setdefault(name, IndexStandin(self, name))
+
+    def delete_index(self, name):
+        self.indexes.pop(name, None)
+
+    def describe_index(self, name):
+        return _IndexDescription(name)
+
+    def list_indexes(self):
+        return [_IndexDescription(name) for name in self.indexes]
+
+    def Index(self, name='', host='', **kwargs):
+        name = name or host.split('.')[0]
+        with self._lock:
+            return self.indexes.setdefault(name, IndexStandin(self, name))
@@ -0,0 +1,102 @@
+"""Tests for cleaning.clean_body, on excerpts shaped like message_data.txt.
+
+Run with: python -m pytest -q
+"""
+from cleaning import clean_body
+
+SIGNATURE_BLOCK = (
+    "Noemi\n"
+    "Customer Success Assistant\n"
+    "fastbookads.com<http://bit.ly/emailstand\n"
+    "[https://ci3.googleusercontent.com/mail-sig/AIorK4xORbJ3gHU85ywcC_9TH8QIxf5pyNM8I0JVJhpky4]\n"
+)
+
+
+def test_empty():
+    assert clean_body('') == ''
+    assert clean_body(None) == ''
+
+
+def test_italian_reply_header_wrapped():
+    body = ("Perfetto, grazie mille!\n\n"
+            "Il giorno mer 21 mag 2025 alle ore 12:51 Fast Book Ads <info@fastbookads.com\n"
+            "ha scritto:\n\n"
+            "> Ciao Claudio,\n> ecco il preventivo.\n")
+    assert clean_body(body) == "Perfetto, grazie mille!"
+
+
+def test_italian_reply_header_address_on_next_line():
+    body = ("Ciao Federico, ok\n\n"
+            " Il giorno gio 15 mag 2025 alle ore 21:36 Maria Furlotti <\n"
+            " selfbook1937@gmail.com ha scritto:\n\n"
+            "Buongiorno Maria, il video è pronto.\n")
+    assert clean_body(body) == "Ciao Federico, ok"
+
+
+def test_italian_reply_header_numeric_date():
+    body = "Va bene.\n\nIl 12/05/2025, Luca ha scritto:\ntesto precedente"
+    assert clean_body(body) == "Va bene."
+
+
+def test_english_reply_header():
+    body = ("Thanks, that works.\n\n"
+            "On Wed, May 21, 2025 at 12:51 PM Fast Book Ads <info@fastbookads.com> wrote:\n"
+            "> Hi Ann,\n> here is the quote.\n")
+    assert clean_body(body) == "Thanks, that works."
+
+
+def test_forwarded_block():
+    body = ("Vedi sotto.\n\n"
+            "---------- Forwarded message ---------\n"
+            "Da: Amazon KDP <kdp@amazon.com>\nOggetto: Il tuo libro\n")
+    assert clean_body(body) == "Vedi sotto."
+
+
+def test_outlook_header():
+    body = "Ok.\n\nDa: Luca <luca@example.com>\nInviato: lunedì 12 maggio 2025\nTesto"
+    assert clean_body(body) == "Ok."
+
+
+def test_answers_between_quoted_lines_survive():
+    body = "> Quante copie?\nCento.\n> E il formato?\nCartaceo.\n"
+    assert clean_body(body) == "Cento.\nCartaceo."
+
+
+def test_mobile_footer():
+    assert clean_body("Arrivo alle 10.\n\nInviato da iPhone\n") == "Arrivo alle 10."
+
+
+def test_signature_removed():
+    body = "Ciao Maurizio,\n\nti confermo la tua intuizione.\n\n" + SIGNATURE_BLOCK
+    assert clean_body(body) == "Ciao Maurizio,\n\nti confermo la tua intuizione."
+
+
+def test_signature_with_brand_lines():
+    body = ("Resto a disposizione.\n\nFederico\nCustomer Success Assistant\n"
+            "Fast Book Ads Team\n*fastbookads.com* <https://bit.ly/emailstand\n")
+    assert clean_body(body) == "Resto a disposizione."
+
+
+def test_tracking_residue():
+    body = ("Scrivici pure <mailto:info@fastbookads.com> o visita il sito "
+            "<https://bit.ly/emailstand> e [https://ci3.googleusercontent.com/mail-sig/AIorK4x] grazie")
+    cleaned = clean_body(body)
+    assert 'bit.ly' not in cleaned
+    assert 'mail-sig' not in cleaned
+    assert 'mailto' not in cleaned
+    assert cleaned.startswith("Scrivici pure")
+    assert cleaned.endswith("grazie")
+
+
+def test_blank_lines_collapsed():
+    assert clean_body("Uno\n\n> quoted\n\n\n\nDue") == "Uno\n\nDue"
+
+
+def test_italian_prose_is_not_a_reply_header():
+    body = 'Il mio nome è Luca. Il prezzo era alto.\nIl mio editore ha scritto: ok\nsecond line'
+    assert clean_body(body) == body
+
+
+def test_english_prose_is_not_a_reply_header():
+    body = 'Hello,\nOn my dashboard I wrote: test campaign\nbut nothing shows.\nThanks, Ann'
+    assert clean_body(body) == body
@@ -0,0 +1,417 @@
+"""Tests for distributed.py and the MongoDB index registry.
+
+They run against FakeDatabase, an in-memory stand-in for the part of the
+pymongo collection API that MongoWorkQueue and MongoIndexRegistry use,
+or against a real mongod when MONGODB_TEST_URI is set; each test then
+uses a database of its own and drops it.
+
+Run with: python -m pytest -q test_distributed.py
+          MONGODB_TEST_URI=mongodb://localhost:27017 python -m pytest -q test_distributed.py
+"""
+import os
+import copy
+import time
+import uuid
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('pymongo')
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import distributed
+from distributed import Coordinator, MongoWorkQueue, Worker
+from headers import MessageHeaders
+from index_versions import MongoIndexRegistry, IndexVersion
+from models import EmailMessage
+from work_queue import DRAFTED
+
+MONGODB_TEST_URI = os.getenv('MONGODB_TEST_URI')
+
+
+def _value(document, path):
+    for key in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def _equals(value, expected):
+    return value == expected or (isinstance(value, list) and expected in value)
+
+
+def _matches(document, query):
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(_matches(document, branch) for branch in condition):
+                return False
+            continue
+        value = _value(document, key)
+        if not (isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition)):
+            if not _equals(value, condition):
+                return False
+            continue
+        for op, argument in condition.items():
+            if op == '$in':
+                matched = any(_equals(value, item) for item in argument)
+            elif op == '$ne':
+                matched = not _equals(value, argument)
+            elif op == '$lte':
+                matched = value is not None and value <= argument
+            elif op == '$lt':
+                matched = value is not None and value < argument
+            else:
+                raise NotImplementedError(op)
+            if not matched:
+                return False
+    return True
+
+
+class FakeCursor(list):
+    def sort(self, key, direction=1):
+        return FakeCursor(sorted(self, key=lambda document: document[key], reverse=direction < 0))
+
+
+class FakeCollection:
+    """The collection methods distributed.py and index_versions.py call,
+    atomic per call like MongoDB's, on a list of dicts"""
+
+    def __init__(self):
+        self.documents = []
+        self._lock = threading.Lock()
+
+    def create_index(self, keys):
+        pass
+
+    def _find(self, query, sort=None):
+        found = [document for document in self.documents if _matches(document, query)]
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda document: document[key], reverse=direction < 0)
+        return found
+
+    @staticmethod
+    def _update(document, update, inserting=False):
+        before = copy.deepcopy(document)
+        for key, value in update.get('$set', {}).items():
+            document[key] = copy.deepcopy(value)
+        if inserting:
+            document.update(copy.deepcopy(update.get('$setOnInsert', {})))
+        for key, value in update.get('$addToSet', {}).items():
+            values = document.setdefault(key, [])
+            if value not in values:
+                values.append(value)
+        return document != before
+
+    def _upsert(self, query, update):
+        if '_id' in query and any(document['_id'] == query['_id'] for document in self.documents):
+            raise DuplicateKeyError(f"duplicate _id {query['_id']!r}", 11000)
+        document = {key: value for key, value in query.items()
+                    if not key.startswith('$') and not isinstance(value, dict)}
+        document.setdefault('_id', uuid.uuid4().hex)
+        self._update(document, update, inserting=True)
+        self.documents.append(document)
+        return document
+
+    def find_one(self, query):
+        with self._lock:
+            found = self._find(query)
+            return copy.deepcopy(found[0]) if found else None
+
+    def find(self, query, projection=None):
+        with self._lock:
+            found = copy.deepcopy(self._find(query))
+        if projection:
+            if any(projection.values()):
+                keep = {key for key, value in projection.items() if value}
+                if projection.get('_id', 1):
+                    keep.add('_id')
+                found = [{key: value for key, value in document.items() if key in keep}
+                         for document in found]
+            else:
+                found = [{key: value for key, value in document.items() if key not in projection}
+                         for document in found]
+        return FakeCursor(found)
+
+    def find_one_and_update(self, query, update, sort=None, return_document=ReturnDocument.BEFORE):
+        with self._lock:
+            found = self._find(query, sort)
+            if not found:
+                return None
+            before = copy.deepcopy(found[0])
+            self._update(found[0], update)
+            return copy.deepcopy(found[0]) if return_document == ReturnDocument.AFTER else before
+
+    def update_one(self, query, update, upsert=False):
+        with self._lock:
+            found = self._find(query)
+            if found:
+                return SimpleNamespace(matched_count=1, modified_count=int(self._update(found[0], update)),
+                                       upserted_id=None)
+            if not upsert:
+                return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+            return SimpleNamespace(matched_count=0, modified_count=0,
+                                   upserted_id=self._upsert(query, update)['_id'])
+
+    def update_many(self, query, update):
+        with self._lock:
+            found = self._find(query)
+            modified = sum(self._update(document, update) for document in found)
+        return SimpleNamespace(matched_count=len(found), modified_count=modified)
+
+    def replace_one(self, query, replacement, upsert=False):
+        with self._lock:
+            found = self._find(query)
+            if found:
+                document_id = found[0]['_id']
+                found[0].clear()
+                found[0].update(copy.deepcopy(replacement), _id=document_id)
+                return SimpleNamespace(matched_count=1)
+            if upsert:
+                self._upsert(query, {'$set': replacement})
+            return SimpleNamespace(matched_count=0)
+
+    def delete_one(self, query):
+        with self._lock:
+            found = self._find(query)
+            if found:
+                self.documents.remove(found[0])
+            return SimpleNamespace(deleted_count=len(found[:1]))
+
+    def delete_many(self, query):
+        with self._lock:
+            found = self._find(query)
+            self.documents = [document for document in self.documents if document not in found]
+        return SimpleNamespace(deleted_count=len(found))
+
+    def count_documents(self, query):
+        with self._lock:
+            return len(self._find(query))
+
+    def aggregate(self, pipeline):
+        """$match, then a $group counting documents per field"""
+        [match, group] = pipeline
+        counts = {}
+        with self._lock:
+            for document in self._find(match['$match']):
+                key = _value(document, group['$group']['_id'].lstrip('$'))
+                counts[key] = counts.get(key, 0) + 1
+        return [{'_id': key, 'count': count} for key, count in counts.items()]
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+
+@pytest.fixture(scope='module')
+def client():
+    if not MONGODB_TEST_URI:
+        yield None
+        return
+    import pymongo
+
+    client = pymongo.MongoClient(MONGODB_TEST_URI, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        client.close()
+        pytest.skip(f"no mongod at {MONGODB_TEST_URI}")
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def db(client):
+    if client is None:
+        yield FakeDatabase()
+        return
+    name = f"test_distributed_{uuid.uuid4().hex[:8]}"
+    yield client[name]
+    client.drop_database(name)
+
+
+def message(message_id, thread_id, internal_date):
+    return EmailMessage(message_id, thread_id, MessageHeaders(subject='Domanda', sender='c@example.com'),
+                        internal_date=internal_date, body=f"body of {message_id}")
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_enqueue_and_claim(db):
+    queue = MongoWorkQueue(db)
+    assert queue.enqueue('box', [message('m1', 't1', 1), message('m2', 't2', 2)]) == 2
+    assert queue.enqueue('box', [message('m1', 't1', 1)]) == 0
+    jobs = queue.claim('box', 'a', limit=5)
+    assert sorted(job.message_id for job in jobs) == ['m1', 'm2']
+    assert queue.claim('box', 'b', limit=5) == []
+    assert queue.claim('other', 'b', limit=5) == []
+    assert queue.advance(jobs[0], DRAFTED)
+    assert queue.counts('box') == {'fetched': 1, 'drafted': 1, 'dead': 0}
+
+
+def test_older_message_is_answered_by_the_thread_job(db):
+    queue = MongoWorkQueue(db)
+    queue.enqueue('box', [message('m2', 't1', 2)])
+    assert queue.enqueue('box', [message('m1', 't1', 1)]) == 0
+    assert queue.known('box', ['m1', 'm2', 'm3']) == {'m1', 'm2'}
+    [job] = queue.claim('box', 'a')
+    assert job.message_id == 'm2'
+
+
+def test_superseded_messages_are_known_to_a_new_queue(db):
+    queue = MongoWorkQueue(db)
+    queue.enqueue('box', [message('m3', 't1', 3)])
+    queue.supersede('box', [('m2', 't1')])
+    queue = MongoWorkQueue(db)
+    assert queue.known('box', ['m2', 'm3']) == {'m2', 'm3'}
+    assert queue.enqueue('box', [message('m2', 't1', 2)]) == 0
+    [job] = queue.claim('box', 'a', limit=5)
+    assert job.message_id == 'm3'
+
+
+def test_newer_message_supersedes_the_lease(db):
+    queue = MongoWorkQueue(db)
+    queue.enqueue('box', [message('m1', 't1', 1)])
+    [job] = queue.claim('box', 'a')
+    assert queue.enqueue('box', [message('m2', 't1', 2)]) == 1
+    # The reply to m1 is stale: a's lease is given back, not advanced
+    assert not queue.advance(job, DRAFTED)
+    [job] = queue.claim('box', 'b')
+    assert job.message_id == 'm2'
+    assert queue.advance(job, DRAFTED)
+
+
+def test_heartbeat_keeps_the_lease(db):
+    queue = MongoWorkQueue(db, lease_seconds=0.5)
+    queue.enqueue('box', [message('m1', 't1', 1)])
+    [job] = queue.claim('box', 'a')
+    for _ in range(3):
+        time.sleep(0.3)
+        assert queue.heartbeat([job]) == 1
+        assert queue.claim('box', 'b') == []
+    time.sleep(0.6)
+    [taken] = queue.claim('box', 'b')
+    assert queue.heartbeat([job]) == 0
+    assert not queue.advance(job, DRAFTED)
+    assert queue.advance(taken, DRAFTED)
+
+
+def test_failures_end_in_dead_letters(db):
+    queue = MongoWorkQueue(db, max_attempts=2)
+    queue.enqueue('box', [message('m1', 't1', 1)])
+    [job] = queue.claim('box', 'a')
+    assert not queue.fail(job, 'timeout')
+    assert queue.claim('box', 'a') == []
+    queue.jobs.update_many({}, {'$set': {'available_at': 0}})
+    [job] = queue.claim('box', 'a')
+    assert queue.fail(job, 'timeout')
+    assert queue.counts() == {'dead': 1}
+    assert queue.enqueue('box', [message('m1', 't1', 1)]) == 0
+    assert queue.requeue('box', 'm1')
+    [job] = queue.claim('box', 'a')
+    assert job.attempts == 0
+
+
+def test_coordinator_lease_fails_over(db):
+    queue = MongoWorkQueue(db)
+    assert queue.acquire(Coordinator.LEASE, 'a', 0.5)
+    assert not queue.acquire(Coordinator.LEASE, 'b', 0.5)
+    assert queue.acquire(Coordinator.LEASE, 'a', 0.5)
+    # a died: its lease runs out and b takes over
+    time.sleep(0.6)
+    assert queue.acquire(Coordinator.LEASE, 'b', 0.5)
+    assert not queue.acquire(Coordinator.LEASE, 'a', 0.5)
+
+
+class StubMailbox:
+    """The parts of GmailAutoReply the coordinator and workers use"""
+
+    def __init__(self, name, queue, messages=(), seconds=0.0):
+        self.name = name
+        self.queue = queue
+        self.messages = list(messages)
+        self.seconds = seconds
+        self.last_check_time = None
+        self.advanced = []
+        self.log = distributed.log
+
+    def authenticate(self):
+        pass
+
+    def refresh_index(self):
+        pass
+
+    def get_new_messages(self):
+        messages, self.messages = self.messages, []
+        self.queue.enqueue(self.name, messages)
+        return messages
+
+    def run_job(self, job):
+        time.sleep(self.seconds)
+        self.advanced.append(self.queue.advance(job, DRAFTED))
+
+
+def test_standby_coordinator_takes_over(db):
+    queue = MongoWorkQueue(db)
+    first = Coordinator([StubMailbox('box', queue, [message('m1', 't1', 1)])], queue, interval_minutes=0.002)
+    second = Coordinator([StubMailbox('box', queue, [message('m2', 't2', 2)])], queue, interval_minutes=0.002)
+    first.owner, second.owner = 'first', 'second'
+    threads = [threading.Thread(target=node.run) for node in (first, second)]
+    threads[0].start()
+    wait_for(lambda: first.leading)
+    threads[1].start()
+    time.sleep(0.3)
+    assert not second.leading
+    assert queue.known('box', ['m1', 'm2']) == {'m1'}
+    # Stopping gives the lease up: no need to wait for it to expire
+    first.stop()
+    threads[0].join()
+    wait_for(lambda: second.leading)
+    wait_for(lambda: queue.known('box', ['m2']) == {'m2'})
+    second.stop()
+    threads[1].join()
+
+
+def test_worker_heartbeats_until_its_jobs_finish(db, monkeypatch):
+    monkeypatch.setattr(distributed, 'HEARTBEAT_SECONDS', 0.1)
+    queue = MongoWorkQueue(db, lease_seconds=0.4)
+    queue.enqueue('box', [message('m1', 't1', 1)])
+    mailbox = StubMailbox('box', queue, seconds=1.2)
+
+    class Supervisor:
+        mailboxes = [(mailbox, 1)]
+
+    worker = Worker(Supervisor, queue, concurrency=2)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    wait_for(lambda: worker._running)
+    # Stopped while the job runs for three times its lease
+    worker.stop()
+    time.sleep(0.6)
+    assert queue.claim('box', 'other') == []
+    thread.join()
+    assert mailbox.advanced == [True]
+    assert queue.counts('box') == {'drafted': 1, 'dead': 0}
+
+
+def test_mongo_index_registry_is_shared(db):
+    admin = MongoIndexRegistry(db['index_registry'], 'replies', refresh_seconds=0)
+    node = MongoIndexRegistry(db['index_registry'], 'replies', refresh_seconds=0)
+    assert node.active() == IndexVersion('replies')
+    admin.add(IndexVersion.for_model('replies-v2', 'multilingual-e5-large'))
+    admin.activate('replies-v2')
+    assert node.active().name == 'replies-v2'
+    assert node.active().metric == 'cosine'
+    assert node.previous().name == 'replies'
+    assert admin.rollback() == 'replies'
+    assert node.active().name == 'replies'
+    assert node.next_name() == 'replies-v3'
@@ -0,0 +1,178 @@
+"""Tests for work_queue.WorkQueue: one job per thread, and what it remembers
+across a restart (a new WorkQueue on the same file).
+
+Run with: python -m pytest -q
+"""
+import os
+import json
+import sqlite3
+
+os.environ.setdefault('METRICS_PORT', '0')
+
+from headers import MessageHeaders
+from index_versions import IndexRegistry
+from models import EmailMessage
+from work_queue import DRAFTED, FETCHED, WorkQueue
+
+
+def message(message_id, thread_id, internal_date):
+    return EmailMessage(message_id, thread_id, MessageHeaders(subject='Domanda', sender='c@example.com'),
+                        internal_date=internal_date, body=f"body of {message_id}")
+
+
+def test_older_message_is_known_but_not_queued(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite3'))
+    assert queue.enqueue('box', [message('m2', 't1', 2)]) == 1
+    assert queue.enqueue('box', [message('m1', 't1', 1)]) == 0
+    assert queue.known('box', ['m1', 'm2', 'm3']) == {'m1', 'm2'}
+    [job] = queue.claim('box', 'a', limit=5)
+    assert job.message_id == 'm2'
+
+
+def test_newer_message_supersedes_the_lease(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite3'))
+    queue.enqueue('box', [message('m1', 't1', 1)])
+    [job] = queue.claim('box', 'a')
+    assert queue.enqueue('box', [message('m2', 't1', 2)]) == 1
+    # The reply to m1 is stale: a's lease is given back, not advanced
+    assert not queue.advance(job, DRAFTED)
+    [job] = queue.claim('box', 'b')
+    assert job.message_id == 'm2'
+    assert queue.advance(job, DRAFTED)
+    assert queue.counts('box') == {DRAFTED: 1, 'dead': 0}
+
+
+def test_retry_of_a_superseded_message_never_runs(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite3'), max_attempts=3)
+    queue.enqueue('box', [message('m1', 't1', 1)])
+    [job] = queue.claim('box', 'a')
+    assert not queue.fail(job, 'timeout')
+    queue.enqueue('box', [message('m2', 't1', 2)])
+    [job] = queue.claim('box', 'a', limit=5)
+    assert job.message_id == 'm2' and job.attempts == 0
+    assert queue.advance(job, DRAFTED)
+    # m1's backoff runs out: there is nothing left to retry
+    queue._db.execute('UPDATE jobs SET available_at = 0')
+    assert queue.claim('box', 'a', limit=5) == []
+
+
+def test_superseded_messages_are_known_after_a_restart(tmp_path):
+    path = str(tmp_path / 'queue.sqlite3')
+    queue = WorkQueue(path)
+    queue.enqueue('box', [message('m3', 't1', 3)])
+    queue.supersede('box', [('m2', 't1')])
+    queue.close()
+
+    queue = WorkQueue(path)
+    assert queue.known('box', ['m2', 'm3']) == {'m2', 'm3'}
+    assert queue.enqueue('box', [message('m2', 't1', 2)]) == 0
+    [job] = queue.claim('box', 'a', limit=5)
+    assert job.message_id == 'm3'
+
+
+def test_per_message_queue_is_migrated(tmp_path):
+    path = str(tmp_path / 'queue.sqlite3')
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE jobs (mailbox TEXT NOT NULL, message_id TEXT NOT NULL, thread_id TEXT NOT NULL,
+            state TEXT NOT NULL, message TEXT NOT NULL, reply TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, available_at REAL NOT NULL,
+            lease_owner TEXT, lease_expires_at REAL, created_at REAL NOT NULL,
+            updated_at REAL NOT NULL, PRIMARY KEY (mailbox, message_id));
+        CREATE INDEX jobs_due ON jobs (mailbox, state, available_at);
+    """)
+    for message_id, internal_date, state in (('m2', 2, FETCHED), ('m1', 1, FETCHED), ('m0', 0, DRAFTED)):
+        db.execute('INSERT INTO jobs (mailbox, message_id, thread_id, state, message, available_at,'
+                   ' created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, 0, 0)',
+                   ('box', message_id, 't1', state,
+                    json.dumps(message(message_id, 't1', internal_date).to_state())))
+    db.commit()
+    db.close()
+
+    queue = WorkQueue(path)
+    assert queue.known('box', ['m0', 'm1', 'm2']) == {'m0', 'm1', 'm2'}
+    [job] = queue.claim('box', 'a', limit=5)
+    assert job.message_id == 'm2'
+
+
+def make_auto_reply(gmail, path, tmp_path):
+    from gmail_auto_response import GmailAutoReply
+    from standins import gmail_service
+
+    auto_reply = GmailAutoReply(name='box', work_queue=WorkQueue(path), backlog_threshold=0,
+                                index_registry=IndexRegistry(str(tmp_path / 'registry.json')),
+                                sync_only=True)
+    auto_reply.service = gmail_service(gmail.url)
+    return auto_reply
+
+
+def test_older_unread_message_is_not_answered_after_a_restart(tmp_path):
+    from standins import GmailStandin, Mailbox
+
+    mailbox = Mailbox()
+    gmail = GmailStandin(mailbox).start()
+    try:
+        newer = mailbox.add_message('t1', 'c@example.com', 'me@example.com', 'Domanda', 'seconda',
+                                    ['INBOX', 'UNREAD'], internal_date=2000)
+        older = mailbox.add_message('t1', 'c@example.com', 'me@example.com', 'Domanda', 'prima',
+                                    ['INBOX', 'UNREAD'], internal_date=1000)
+        path = str(tmp_path / 'queue.sqlite3')
+        first = make_auto_reply(gmail, path, tmp_path)
+        assert [msg.id for msg in first.get_new_messages()] == [newer['id']]
+        first.work_queue.close()
+
+        restarted = make_auto_reply(gmail, path, tmp_path)
+        assert restarted.get_new_messages() == []
+        assert restarted.work_queue.known('box', [older['id'], newer['id']]) == {older['id'], newer['id']}
+    finally:
+        gmail.shutdown()
+
+
+def test_thread_is_answered_once_across_polls_and_a_restart(tmp_path):
+    from openai import OpenAI
+    from gmail_auto_response import GmailAutoReply, INDEX_NAME
+    from standins import GmailStandin, Mailbox, OpenAIStandin, PineconeStandin, gmail_service
+    from transport import TransportConfig, build_openai_http_client
+
+    mailbox = Mailbox()
+    gmail = GmailStandin(mailbox).start()
+    openai_standin = OpenAIStandin().start()
+    pinecone = PineconeStandin()
+    path = str(tmp_path / 'queue.sqlite3')
+
+    def start():
+        transport = TransportConfig()
+        auto_reply = GmailAutoReply(
+            name='box', openai_client=OpenAI(api_key='standin', base_url=openai_standin.url + 'v1',
+                                             http_client=build_openai_http_client(transport)),
+            pc=pinecone, index=pinecone.Index(INDEX_NAME), transport=transport, backlog_threshold=0,
+            index_registry=IndexRegistry(str(tmp_path / 'registry.json')), work_queue=WorkQueue(path))
+        auto_reply.service = gmail_service(gmail.url)
+        return auto_reply
+
+    def replies():
+        return openai_standin.calls['POST /v1/chat/completions']
+
+    try:
+        older = mailbox.add_message('t1', 'c@example.com', 'me@example.com', 'Domanda', 'prima',
+                                    ['INBOX', 'UNREAD'], internal_date=1000)
+        newer = mailbox.add_message('t1', 'c@example.com', 'me@example.com', 'Domanda', 'seconda',
+                                    ['INBOX', 'UNREAD'], internal_date=2000)
+        first = start()
+        messages = [first._fetch_message(entry['id']) for entry in (older, newer)]
+        first.process_new_messages(messages)
+        assert replies() == 1 and len(mailbox.drafts) == 1
+        first.work_queue.close()
+
+        # Both are still unread: the next process neither downloads nor
+        # answers them, even when the older one reaches it on its own
+        restarted = start()
+        downloads = gmail.calls['messages.GET.item']
+        restarted.poll_once()
+        assert gmail.calls['messages.GET.item'] == downloads
+        restarted.process_new_messages(messages[:1])
+        assert replies() == 1 and len(mailbox.drafts) == 1
+        assert restarted.work_queue.counts('box') == {DRAFTED: 1, 'dead': 0}
+    finally:
+        gmail.shutdown()
+        openai_standin.shutdown()
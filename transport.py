@@ -0,0 +1,131 @@
+import os
+import json
+import threading
+import importlib.util
+
+# httpx, httplib2, googleapiclient and pinecone are imported inside the
+# functions that need them so that importing this module stays cheap.
+
+CACHE_DIR = os.getenv('CACHE_DIR', '.cache')
+GMAIL_DISCOVERY_CACHE = os.path.join(CACHE_DIR, 'gmail_v1_discovery.json')
+
+
+def http2_available():
+    """HTTP/2 in httpx needs the optional h2 package (pip install httpx[http2])"""
+    return importlib.util.find_spec('h2') is not None
+
+
+class TransportConfig:
+    """Pool sizes, keep-alive and per-host timeouts for the outbound HTTP clients.
+
+    Every value can be overridden from the environment, see .env.example.
+    """
+
+    def __init__(self):
+        self.max_connections = int(os.getenv('HTTP_MAX_CONNECTIONS', '20'))
+        self.max_keepalive_connections = int(os.getenv('HTTP_MAX_KEEPALIVE', '10'))
+        self.keepalive_expiry = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '120'))
+        self.http2 = os.getenv('HTTP2', '1') == '1' and http2_available()
+        self.connect_timeout = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+        self.openai_timeout = float(os.getenv('OPENAI_TIMEOUT', '60'))
+        self.gmail_timeout = float(os.getenv('GMAIL_TIMEOUT', '30'))
+        self.pinecone_pool_threads = int(os.getenv('PINECONE_POOL_THREADS', '4'))
+        self.pinecone_pool_maxsize = int(os.getenv('PINECONE_POOL_MAXSIZE', '10'))
+
+
+def build_openai_http_client(config):
+    """Pooled, keep-alive httpx client for api.openai.com.
+
+    httpx.Client is thread-safe, so one instance can be shared by every
+    worker and mailbox in the process.
+    """
+    import httpx
+
+    return httpx.Client(
+        http2=config.http2,
+        timeout=httpx.Timeout(config.openai_timeout, connect=config.connect_timeout),
+        limits=httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry
+        ),
+        verify=True
+    )
+
+
+def build_gmail_service(creds, config):
+    """Gmail service that is safe to share between threads.
+
+    httplib2.Http is not thread-safe, so instead of one connection for the
+    whole service every thread gets its own authorized Http, which it keeps
+    (and keeps alive) across requests. This avoids a new TLS handshake per
+    call while never sharing a connection between threads.
+
+    The discovery document is cached on disk so a restart does not have to
+    load and parse it again from the client library.
+    """
+    import httplib2
+    import google_auth_httplib2
+    from googleapiclient.discovery import build, build_from_document
+    from googleapiclient.http import HttpRequest
+
+    local = threading.local()
+
+    def http_for_thread():
+        http = getattr(local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(
+                creds, http=httplib2.Http(timeout=config.gmail_timeout))
+            local.http = http
+        return http
+
+    def request_builder(http, *args, **kwargs):
+        return HttpRequest(http_for_thread(), *args, **kwargs)
+
+    if os.path.exists(GMAIL_DISCOVERY_CACHE):
+        with open(GMAIL_DISCOVERY_CACHE, 'r', encoding='utf-8') as f:
+            return build_from_document(f.read(), http=http_for_thread(),
+                                       requestBuilder=request_builder)
+
+    service = build('gmail', 'v1', http=http_for_thread(), requestBuilder=request_builder)
+    write_cache(GMAIL_DISCOVERY_CACHE, service._rootDesc)
+    return service
+
+
+def read_cache(path):
+    """Return the cached JSON at path, or None if it is missing or unreadable"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(path, data):
+    """Atomically write data as JSON to path"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def build_pinecone(api_key, config):
+    """Pinecone client whose data-plane calls share a pool of worker threads"""
+    from pinecone import Pinecone
+
+    return Pinecone(api_key=api_key, pool_threads=config.pinecone_pool_threads)
+
+
+def open_index(pc, index_name, config, host=None):
+    """Index handle with a connection pool large enough for all workers.
+
+    Passing the index host skips the describe_index call Pinecone otherwise
+    makes to resolve it.
+    """
+    return pc.Index(
+        index_name,
+        host=host or '',
+        pool_threads=config.pinecone_pool_threads,
+        connection_pool_maxsize=config.pinecone_pool_maxsize
+    )
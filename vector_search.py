@@ -6,21 +6,26 @@ import re
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from bs4 import BeautifulSoup
 import json
 from tqdm import tqdm
 from dotenv import load_dotenv # Import the dotenv library
 
 from pinecone import Pinecone
-from pinecone import ServerlessSpec
 
 from openai import OpenAI
 import re
 from langdetect import detect
 import httpx
 
+from models import EmailThread, message_body
+from cleaning import clean_body
+from indexing import EMBED_MODEL, INDEX_DEDUP, pair_record, upsert_pairs
+from dedup import Deduplicator
+from index_versions import EMBED_MODELS, create_index, open_registry
+from pipeline import fetch_parse
+from transport import TransportConfig, build_gmail_service
+
 load_dotenv()
 PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
 
@@ -45,98 +50,28 @@ def get_gmail_service():
         with open("token.json", "w") as token:
             token.write(creds.to_json())
             
-    return build("gmail", "v1", credentials=creds)
+    # Thread-safe: the backfill fetches threads from several threads at once
+    return build_gmail_service(creds, TransportConfig())
 def get_message_body(payload):
     """
-    A robust function to recursively search for the email body.
-    Prioritizes 'text/plain', falls back to 'text/html', and handles nested parts.
-    Returns the clean text content.
+    The email body of a payload: 'text/plain' first, falling back to
+    'text/html' converted to text, at any nesting depth (see models.message_body).
     """
-    body = ""
-    html_body = ""
-
-    def search_parts(parts):
-        nonlocal body, html_body
-        for part in parts:
-            # If we've already found the plain text body, we can stop.
-            if body:
-                return
-
-            mime_type = part.get('mimeType')
-            part_body = part.get('body')
-            
-            # Skip attachments
-            if part.get('filename'):
-                continue
-
-            if mime_type == 'text/plain':
-                if part_body and part_body.get('data'):
-                    body = base64.urlsafe_b64decode(part_body['data']).decode('utf-8')
-            elif mime_type == 'text/html':
-                if part_body and part_body.get('data'):
-                    html_body = base64.urlsafe_b64decode(part_body['data']).decode('utf-8')
-            elif 'parts' in part:
-                # This part is a container for other parts, search them recursively
-                search_parts(part['parts'])
-
-    if 'parts' in payload:
-        search_parts(payload['parts'])
-    elif 'body' in payload and 'data' in payload['body']:
-        # For simple, non-multipart emails
-        if payload['mimeType'] == 'text/plain':
-            body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-        elif payload['mimeType'] == 'text/html':
-            html_body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-
-    # If we found a plain text body, use it.
-    if body:
-        return body.strip()
-    # Otherwise, fall back to the HTML body and clean it up.
-    elif html_body:
-        soup = BeautifulSoup(html_body, "html.parser")
-        return soup.get_text(separator="\n").strip()
-    
-    # If no body is found at all
-    return "No textual body found."
+    return message_body(payload) or "No textual body found."
 def clean_reply_body(body_text):
     """
-    Removes quoted text from an email body.
+    Removes quoted text, forwarded blocks, the signature and tracking links
+    from an email body (see cleaning.clean_body).
     """
-    # Pattern for "On [date], [person] wrote:"
-    # This is a common header for replies.
-    header_pattern = re.compile(r"On.*wrote:", re.IGNORECASE)
-    match = header_pattern.search(body_text)
-    if match:
-        # Cut the body at the start of the quote header
-        body_text = body_text[:match.start()]
-
-    # Pattern for other separators like "--- Original Message ---"
-    separator_pattern = re.compile(r"---.*Original Message.*---", re.IGNORECASE)
-    match = separator_pattern.search(body_text)
-    if match:
-        body_text = body_text[:match.start()]
-
-    # Split the body into lines and remove lines starting with '>'
-    lines = body_text.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        # Also catches "> >" etc.
-        if not line.strip().startswith('>'):
-            cleaned_lines.append(line)
-    
-    # Join the lines back and trim whitespace
-    return "\n".join(cleaned_lines).strip()
-def parse_and_print_message(message_data, message_title):
-    """Parses a single message object from the API and prints its details."""
-    
-    # The payload contains headers, body, etc.
-    payload = message_data['payload']
-    headers = payload['headers']
+    return clean_body(body_text)
+def parse_and_print_message(message, message_title):
+    """Returns the body of a models.EmailMessage without quoted history,
+    signature or tracking links."""
     
     # Extract headers
-    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-    sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'N/A')
-    date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'N/A')
+    subject = message.subject
+    sender = message.headers.sender or 'N/A'
+    date = message.headers.date or 'N/A'
 
     # print("="*60)
     # print(f"--- {message_title} ---")
@@ -146,13 +81,11 @@ def parse_and_print_message(message_data, message_title):
     # print("="*60)
 
     # --- Parse the Message Body ---
-    full_body = get_message_body(payload)
+    full_body = message.body or "No textual body found."
     
     # *** NOW, CLEAN THE BODY BEFORE PRINTING ***
-    # We only apply cleaning if it's a reply message
-    cleaned_body = full_body
-    if message_title == "FIRST REPLY":
-        cleaned_body = clean_reply_body(full_body)
+    # Originals are cleaned too: queries are, and it is fewer tokens to embed
+    cleaned_body = clean_reply_body(full_body) or full_body
 
     return cleaned_body
     # print("\nBody (Cleaned):")
@@ -160,7 +93,26 @@ def parse_and_print_message(message_data, message_title):
     # print("\n")
 
 
-def find_first_conversation_with_reply(service,pc,index):
+def parse_reply_pair(resource):
+    """(vector id, original body, vector metadata) for a thread resource with
+    2+ messages whose first reply is ours, else None (see indexing.pair_record).
+
+    Runs in the pipeline's worker processes: decoding, cleaning and language
+    detection are the CPU-bound part of indexing.
+    """
+    thread = EmailThread.from_gmail(resource)
+    if len(thread) < 2:
+        return None
+    original_message = thread[0]
+    first_reply = thread[1]
+    # Our replies are recognised by the signature, which cleaning removes
+    if first_reply.body.find("Customer Success Assistant") == -1:
+        return None
+    return pair_record(first_reply.id, original_message.body or "No textual body found.",
+                       first_reply.body, first_reply.sent_at)
+
+
+def find_first_conversation_with_reply(service,pc,index,model=EMBED_MODEL):
     """Finds the first thread with 2+ messages and prints the first message and its reply."""
     try:
         # 1. Get the list of threads from the inbox
@@ -172,52 +124,24 @@ def find_first_conversation_with_reply(service,pc,index):
             print("No threads found in the inbox.")
             return
 
-        records=[]
-        count=0
-
-        # 2. Loop through threads to find one with more than one message
-        for thread_info in threads:
-            thread_id = thread_info['id']
-            thread_data = service.users().threads().get(userId='me', id=thread_id).execute()
-            
-            messages_in_thread = thread_data.get('messages', [])
-
-            if len(messages_in_thread) >= 2:
-                # print(f"Found a suitable conversation (Thread ID: {thread_id}). Processing...\n")
-                
-                original_message = messages_in_thread[0]
-                first_reply = messages_in_thread[1]
-
-                # 3. Parse and print the original message and the reply
-                original_message_body = parse_and_print_message(original_message, "ORIGINAL MESSAGE")
-                first_reply_body = parse_and_print_message(first_reply, "FIRST REPLY")
-                if(first_reply_body.find("Customer Success Assistant") != -1):
-                    # print(original_message_body)
-                    # print("\n--------------------------------")
-                    # print(first_reply_body)
-                    # print("\n--------------------------------")
-                    count+=1
-                    print(count)
-                    embedding=pc.inference.embed(
-                        model="llama-text-embed-v2",
-                        inputs=[original_message_body],
-                        parameters={"input_type": "passage", "truncate": "END"}
-                    )
-                    # print(embedding[0]['values'])
-                    records.append({
-                        "id":str(count),
-                        "values": embedding[0]['values'],
-                        "metadata":{
-                            "original_message":original_message_body[:15000],
-                            "reply_message": first_reply_body[:15000]
-                        }
-                    })
-                    if(count%10==0):
-                        print("Upserting....")
-                        index.upsert(
-                            vectors=records
-                        )
-                        records=[]
+        def fetch_thread(thread_info):
+            return service.users().threads().get(userId='me', id=thread_info['id']).execute()
+
+        # 2. Fetch threads on I/O threads, parse them on every core, and keep
+        # the ones whose first reply is ours (see pipeline.py)
+        pairs = (pair for pair in fetch_parse(threads, fetch_thread, parse_reply_pair)
+                 if pair is not None)
+        # 3. Leave out the near-duplicates of templated replies (see dedup.py)
+        deduplicator = Deduplicator() if INDEX_DEDUP else None
+        if deduplicator is not None:
+            pairs = deduplicator.filter(pairs)
+        # 4. Embed and upsert in batches, ids being the reply's message id
+        count = upsert_pairs(pc, index, pairs, on_flush=lambda: print("Upserting...."),
+                             model=model)
+        print(count)
+        if deduplicator is not None:
+            deduplicator.apply(index)
+            print(deduplicator.report())
 
         print("Successfully upserting")
         
@@ -230,11 +154,11 @@ def find_first_conversation_with_reply(service,pc,index):
     except HttpError as error:
         print(f"An error occurred: {error}")
 
-def vector_search(message,pc,index):
+def vector_search(message,pc,index,model=EMBED_MODEL):
     embedding=pc.inference.embed(
-        model="llama-text-embed-v2",
+        model=model,
         inputs=[message],
-        parameters={"input_type": "passage", "truncate": "END"}
+        parameters=EMBED_MODELS[model]['parameters']
     )
     vector=embedding[0]['values']
 
@@ -255,27 +179,19 @@ if __name__ == "__main__":
     PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
     pc = Pinecone(api_key=PINECONE_API_KEY)
 
-    index_name = "email-auto-response"
+    version = open_registry().active()
+    index_name = version.name
     pc = Pinecone(api_key=PINECONE_API_KEY)
 
-    if not pc.has_index(index_name):
-        pc.create_index(
-            name=index_name,
-            vector_type="dense",
-            dimension=1024,
-            metric="dotproduct",
-            spec=ServerlessSpec(
-                cloud="aws",
-                region="us-east-1"
-            )
-        )
+    create_index(pc, version)
     index = pc.Index(index_name)
     print(f"Connected to index '{index_name}'.")
 
 
     message="""Hello,my name is Anthon, I want to get your service"""
 
-    reply_message=vector_search(message,pc,index)[0]['metadata']['reply_message']
+    matches=vector_search(message,pc,index,version.model)
+    reply_message=matches[0]['metadata']['reply_message'] if matches else ""
     print(reply_message)
 
     try:
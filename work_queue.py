@@ -0,0 +1,483 @@
+"""Durable queue of the messages being answered, in SQLite.
+
+Without it, a message was marked as processed when it was fetched, before
+any work happened: if the process died, or generating or drafting the
+reply failed, the message was never answered. Now every message to
+answer is written here first and moves through these stages:
+
+    fetched     listed and downloaded; the reply is still to be written
+    generated   the reply text is stored; the draft is still to be saved
+    batched     handed to a Batch API batch (backlog.py), which drafts it
+    drafted     done
+    skipped     done without a reply (blocked sender)
+
+There is one job per thread, for its latest message, as in
+distributed.py's MongoWorkQueue: a message newer than the job's replaces
+it (a drafted job is answered again), one older is only recorded as
+known, being answered by the reply to the newer one, which sees it in the
+thread history. Every message id the queue has seen is kept in
+job_messages, so after a restart known() still tells the inbox listing
+which messages are answered, or superseded, and a retry never writes a
+reply to a message older than the thread's latest.
+
+Jobs are claimed with a lease before any work. A claim only succeeds on a
+job that nobody else holds, so two workers never answer the same message.
+A process that dies leaves its leases behind, and they expire after
+LEASE_SECONDS. A failed stage is retried after an exponential backoff.
+After MAX_ATTEMPTS failures the job is moved to the dead_letters table,
+with its last error, for someone to look at. The text generated for a
+job is kept, so a retry only repeats the stage that failed. Saving a
+draft replaces the thread's existing auto draft, so repeating that stage
+does not add a second one.
+
+The database is in WAL mode, so a reader (e.g. `python work_queue.py
+status`) never blocks the daemon. One WorkQueue can be shared by the
+threads and mailboxes of one process.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import sqlite3
+import argparse
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from models import EmailMessage
+from transport import CACHE_DIR
+from metrics import get_logger
+
+log = get_logger(__name__)
+
+QUEUE_PATH = os.getenv('WORK_QUEUE_PATH', os.path.join(CACHE_DIR, 'work_queue.sqlite3'))
+# A claimed job is given back to the queue if not finished within this
+LEASE_SECONDS = float(os.getenv('QUEUE_LEASE_SECONDS', '300'))
+MAX_ATTEMPTS = int(os.getenv('QUEUE_MAX_ATTEMPTS', '5'))
+RETRY_BASE_SECONDS = float(os.getenv('QUEUE_RETRY_BASE_SECONDS', '30'))
+RETRY_MAX_SECONDS = 3600.0
+# Finished jobs are kept this long, so a message still unread in the inbox
+# is recognised as answered
+KEEP_DONE_DAYS = 30
+# How often the poll loop purges them
+PURGE_INTERVAL_SECONDS = 3600.0
+
+FETCHED = 'fetched'
+GENERATED = 'generated'
+BATCHED = 'batched'
+DRAFTED = 'drafted'
+SKIPPED = 'skipped'
+# States a worker can claim
+PENDING = (FETCHED, GENERATED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    mailbox TEXT NOT NULL,
+    thread_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    internal_date INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    message TEXT NOT NULL,
+    reply TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (mailbox, thread_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (mailbox, state, available_at);
+CREATE INDEX IF NOT EXISTS jobs_message ON jobs (mailbox, message_id);
+CREATE TABLE IF NOT EXISTS job_messages (
+    mailbox TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    thread_id TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    PRIMARY KEY (mailbox, message_id)
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    mailbox TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    thread_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    message TEXT NOT NULL,
+    reply TEXT,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at REAL NOT NULL,
+    PRIMARY KEY (mailbox, message_id)
+);
+"""
+
+# Queues written before jobs were kept per thread had one per message: the
+# latest message of each thread becomes its job
+MIGRATE_PER_MESSAGE = """
+BEGIN IMMEDIATE;
+DROP INDEX IF EXISTS jobs_due;
+ALTER TABLE jobs RENAME TO jobs_per_message;
+""" + SCHEMA + """
+INSERT OR IGNORE INTO job_messages (mailbox, message_id, thread_id, recorded_at)
+    SELECT mailbox, message_id, thread_id, created_at FROM jobs_per_message;
+INSERT OR REPLACE INTO jobs (mailbox, thread_id, message_id, internal_date, state, message, reply,
+                             attempts, last_error, available_at, created_at, updated_at)
+    SELECT mailbox, thread_id, message_id, COALESCE(json_extract(message, '$.internal_date'), 0), state,
+           message, reply, attempts, last_error, available_at, created_at, updated_at
+    FROM jobs_per_message ORDER BY COALESCE(json_extract(message, '$.internal_date'), 0), created_at;
+DROP TABLE jobs_per_message;
+COMMIT;
+"""
+
+
+def worker_id(name: str = '') -> str:
+    """Lease owner id of the calling thread (and name, if given): a lease
+    taken over by another thread of the process is lost like any other"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}" + (f":{name}" if name else '')
+
+
+def retry_delay(attempts: int, base: float = RETRY_BASE_SECONDS) -> float:
+    """Exponential backoff with full jitter after the given number of failures"""
+    return random.uniform(0.5, 1.0) * min(RETRY_MAX_SECONDS, base * 2 ** (attempts - 1))
+
+
+@dataclass(slots=True)
+class Job:
+    mailbox: str
+    message_id: str
+    state: str
+    message: EmailMessage
+    reply: Optional[str]
+    attempts: int
+    owner: str
+
+
+class WorkQueue:
+    """The jobs of every mailbox, in one SQLite file"""
+
+    def __init__(self, path: str = QUEUE_PATH, lease_seconds: float = LEASE_SECONDS,
+                 max_attempts: int = MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # One connection, used by one thread at a time; autocommit, with
+        # explicit transactions where a read and a write must be atomic
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # WAL keeps committed transactions through a crash with NORMAL too
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(jobs)')]
+        if columns and 'internal_date' not in columns:
+            self._db.executescript(MIGRATE_PER_MESSAGE)
+            log.info("work_queue_migrated", path=path)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._purged_at = None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _transaction(self, statements):
+        """Run statements(cursor) in one write transaction"""
+        with self._lock:
+            cursor = self._db.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(cursor)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return result
+
+    def _enqueue(self, cursor, mailbox: str, message: EmailMessage, now: float, state: str = FETCHED,
+                 reply: Optional[str] = None) -> bool:
+        """Make message the job of its thread unless it is known, dead, or
+        older than the thread's job; True if it became the job"""
+        key = (mailbox, message.id)
+        if cursor.execute('SELECT 1 FROM dead_letters WHERE mailbox = ? AND message_id = ?', key).fetchone():
+            return False
+        cursor.execute('INSERT OR IGNORE INTO job_messages (mailbox, message_id, thread_id, recorded_at)'
+                       ' VALUES (?, ?, ?, ?)', (*key, message.thread_id, now))
+        if not cursor.rowcount:
+            return False
+        internal_date = message.internal_date or 0
+        fields = (message.id, internal_date, state, json.dumps(message.to_state()), reply, now, now)
+        cursor.execute(
+            'INSERT OR IGNORE INTO jobs (message_id, internal_date, state, message, reply, available_at,'
+            ' updated_at, mailbox, thread_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (*fields, mailbox, message.thread_id, now))
+        if cursor.rowcount:
+            return True
+        # The lease, if any, is kept: its holder finds the message changed
+        # when it finishes, and gives the job back
+        cursor.execute(
+            'UPDATE jobs SET message_id = ?, internal_date = ?, state = ?, message = ?, reply = ?,'
+            ' attempts = 0, last_error = NULL, available_at = ?, updated_at = ?'
+            ' WHERE mailbox = ? AND thread_id = ? AND internal_date <= ?',
+            (*fields, mailbox, message.thread_id, internal_date))
+        return cursor.rowcount == 1
+
+    def enqueue(self, mailbox: str, messages: Iterable[EmailMessage]) -> int:
+        """Make each message the fetched job of its thread, unless the queue
+        knows it, it is dead, or the thread's job is for a later message.
+        Returns how many jobs were added or replaced."""
+        messages = list(messages)
+        if not messages:
+            return 0
+        now = time.time()
+        return self._transaction(lambda cursor: sum(
+            self._enqueue(cursor, mailbox, message, now) for message in messages))
+
+    def supersede(self, mailbox: str, messages: Iterable[Tuple[str, str]]):
+        """Record (message id, thread id) pairs as known without a job of
+        their own: a newer message of their thread, queued separately,
+        answers them"""
+        now = time.time()
+        rows = [(mailbox, message_id, thread_id, now) for message_id, thread_id in messages]
+        if rows:
+            self._transaction(lambda cursor: cursor.executemany(
+                'INSERT OR IGNORE INTO job_messages (mailbox, message_id, thread_id, recorded_at)'
+                ' VALUES (?, ?, ?, ?)', rows))
+
+    def known(self, mailbox: str, message_ids: Iterable[str]) -> Set[str]:
+        """The ids among message_ids that are queued, superseded, done or dead"""
+        message_ids = list(message_ids)
+        found = set()
+        with self._lock:
+            # SQLite allows 999 parameters per statement in older builds
+            for start in range(0, len(message_ids), 900):
+                chunk = message_ids[start:start + 900]
+                marks = ','.join('?' * len(chunk))
+                for table in ('job_messages', 'dead_letters'):
+                    found.update(row[0] for row in self._db.execute(
+                        f'SELECT message_id FROM {table} WHERE mailbox = ? AND message_id IN ({marks})',
+                        [mailbox, *chunk]))
+        return found
+
+    def claim(self, mailbox: str, owner: str, limit: int = 1,
+              message_ids: Optional[List[str]] = None) -> List[Job]:
+        """Lease up to limit due jobs of mailbox (only those for a message in
+        message_ids, if given), oldest first"""
+        now = time.time()
+        query = ('SELECT thread_id, message_id, state, message, reply, attempts FROM jobs'
+                 ' WHERE mailbox = ? AND state IN (?, ?) AND available_at <= ?'
+                 ' AND (lease_expires_at IS NULL OR lease_expires_at <= ?)')
+        params = [mailbox, *PENDING, now, now]
+        if message_ids is not None:
+            if not message_ids:
+                return []
+            query += f" AND message_id IN ({','.join('?' * len(message_ids))})"
+            params.extend(message_ids)
+        query += ' ORDER BY created_at LIMIT ?'
+        params.append(limit)
+
+        def lease(cursor):
+            rows = cursor.execute(query, params).fetchall()
+            cursor.executemany(
+                'UPDATE jobs SET lease_owner = ?, lease_expires_at = ?, updated_at = ?'
+                ' WHERE mailbox = ? AND thread_id = ?',
+                [(owner, now + self.lease_seconds, now, mailbox, row[0]) for row in rows])
+            return rows
+
+        return [Job(mailbox, message_id, state, EmailMessage.from_state(json.loads(message)), reply,
+                    attempts, owner)
+                for _, message_id, state, message, reply, attempts in self._transaction(lease)]
+
+    @staticmethod
+    def _owned(job: Job):
+        """WHERE clause and parameters matching job while its claimer still
+        holds it for its message"""
+        return (' WHERE mailbox = ? AND thread_id = ? AND message_id = ? AND lease_owner = ?',
+                (job.mailbox, job.message.thread_id, job.message_id, job.owner))
+
+    @staticmethod
+    def _release(cursor, job: Job):
+        cursor.execute(
+            'UPDATE jobs SET lease_owner = NULL, lease_expires_at = NULL, updated_at = ?'
+            ' WHERE mailbox = ? AND thread_id = ? AND lease_owner = ?',
+            (time.time(), job.mailbox, job.message.thread_id, job.owner))
+
+    def advance(self, job: Job, state: str, reply: Optional[str] = None) -> bool:
+        """Record that job reached state and release it; False if the lease
+        had been lost to another worker, which then owns the job, or the
+        thread got a newer message meanwhile"""
+        now = time.time()
+        where, params = self._owned(job)
+
+        def update(cursor):
+            cursor.execute(
+                'UPDATE jobs SET state = ?, reply = COALESCE(?, reply), lease_owner = NULL,'
+                ' lease_expires_at = NULL, last_error = NULL, updated_at = ?' + where,
+                (state, reply, now, *params))
+            if cursor.rowcount == 1:
+                return True
+            self._release(cursor, job)
+            return False
+
+        advanced = self._transaction(update)
+        if advanced:
+            job.state = state
+            job.reply = reply if reply is not None else job.reply
+        else:
+            log.warning("job_lease_lost", mailbox=job.mailbox, message_id=job.message_id, state=state)
+        return advanced
+
+    def save_reply(self, job: Job, reply: str):
+        """Store the reply generated for job, keeping the lease"""
+        where, params = self._owned(job)
+        self._transaction(lambda cursor: cursor.execute(
+            'UPDATE jobs SET state = ?, reply = ?, updated_at = ?' + where,
+            (GENERATED, reply, time.time(), *params)))
+        job.state = GENERATED
+        job.reply = reply
+
+    def fail(self, job: Job, error: str) -> bool:
+        """Record a failed attempt: retry later, or move the job to
+        dead_letters after max_attempts. Returns True if it was moved."""
+        now = time.time()
+        attempts = job.attempts + 1
+        where, params = self._owned(job)
+
+        def update(cursor):
+            if attempts >= self.max_attempts:
+                cursor.execute(
+                    'INSERT OR REPLACE INTO dead_letters (mailbox, message_id, thread_id, state, message,'
+                    ' reply, attempts, last_error, failed_at) SELECT mailbox, message_id, thread_id, state,'
+                    ' message, reply, ?, ?, ? FROM jobs' + where, (attempts, error, now, *params))
+                if not cursor.rowcount:
+                    self._release(cursor, job)
+                    return False
+                cursor.execute('DELETE FROM jobs' + where, params)
+                # Known as dead from now on; requeue() enqueues it again
+                cursor.execute('DELETE FROM job_messages WHERE mailbox = ? AND message_id = ?',
+                               (job.mailbox, job.message_id))
+                return True
+            cursor.execute(
+                'UPDATE jobs SET attempts = ?, last_error = ?, available_at = ?, lease_owner = NULL,'
+                ' lease_expires_at = NULL, updated_at = ?' + where,
+                (attempts, error, now + retry_delay(attempts), now, *params))
+            if not cursor.rowcount:
+                self._release(cursor, job)
+            return False
+
+        dead = self._transaction(update)
+        job.attempts = attempts
+        if dead:
+            log.error("job_dead_lettered", mailbox=job.mailbox, message_id=job.message_id,
+                      attempts=attempts, error=error)
+        else:
+            log.warning("job_failed", mailbox=job.mailbox, message_id=job.message_id,
+                        attempts=attempts, error=error)
+        return dead
+
+    def release(self, job: Job):
+        """Give a claimed job back without counting an attempt"""
+        self._transaction(lambda cursor: self._release(cursor, job))
+
+    def mark(self, mailbox: str, message_ids: Iterable[str], state: str, reply: Optional[str] = None):
+        """Move the unleased jobs of message_ids to state, for work done
+        outside claim/advance (the Batch API); a job that has moved on to a
+        newer message is left alone"""
+        now = time.time()
+        rows = [(state, reply, now, mailbox, message_id) for message_id in message_ids]
+        self._transaction(lambda cursor: cursor.executemany(
+            'UPDATE jobs SET state = ?, reply = COALESCE(?, reply), available_at = 0, updated_at = ?'
+            ' WHERE mailbox = ? AND message_id = ? AND lease_owner IS NULL', rows))
+
+    def counts(self, mailbox: Optional[str] = None) -> Dict[str, int]:
+        """Jobs per state (and 'dead'), for one mailbox or all of them"""
+        where, params = ('WHERE mailbox = ?', [mailbox]) if mailbox else ('', [])
+        with self._lock:
+            counts = dict(self._db.execute(f'SELECT state, COUNT(*) FROM jobs {where} GROUP BY state',
+                                           params).fetchall())
+            counts['dead'] = self._db.execute(f'SELECT COUNT(*) FROM dead_letters {where}',
+                                              params).fetchone()[0]
+        return counts
+
+    def dead_letters(self, mailbox: Optional[str] = None) -> List[Dict]:
+        where, params = ('WHERE mailbox = ?', [mailbox]) if mailbox else ('', [])
+        with self._lock:
+            cursor = self._db.execute(
+                f'SELECT mailbox, message_id, thread_id, state, attempts, last_error, failed_at'
+                f' FROM dead_letters {where} ORDER BY failed_at', params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def requeue(self, mailbox: str, message_id: str) -> bool:
+        """Put a dead-lettered job back in the queue with its attempts reset
+        (unless its thread has a newer message, whose reply answers it)"""
+        now = time.time()
+
+        def move(cursor):
+            row = cursor.execute('SELECT state, message, reply FROM dead_letters'
+                                 ' WHERE mailbox = ? AND message_id = ?', (mailbox, message_id)).fetchone()
+            if row is None:
+                return False
+            cursor.execute('DELETE FROM dead_letters WHERE mailbox = ? AND message_id = ?',
+                           (mailbox, message_id))
+            state, message, reply = row
+            self._enqueue(cursor, mailbox, EmailMessage.from_state(json.loads(message)), now, state, reply)
+            return True
+
+        return self._transaction(move)
+
+    def purge(self, days: float = KEEP_DONE_DAYS) -> int:
+        """Delete jobs finished more than days ago, and the messages known
+        only through them"""
+        cutoff = time.time() - days * 86400
+
+        def delete(cursor):
+            purged = cursor.execute('DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?',
+                                    (DRAFTED, SKIPPED, cutoff)).rowcount
+            cursor.execute(
+                'DELETE FROM job_messages WHERE recorded_at < ? AND NOT EXISTS (SELECT 1 FROM jobs'
+                ' WHERE jobs.mailbox = job_messages.mailbox AND jobs.thread_id = job_messages.thread_id)',
+                (cutoff,))
+            return purged
+
+        return self._transaction(delete)
+
+    def purge_due(self, interval: float = PURGE_INTERVAL_SECONDS) -> int:
+        """purge(), unless it already ran in the last interval seconds: the
+        poll loop of every mailbox calls this. Returns how many were deleted"""
+        now = time.monotonic()
+        with self._lock:
+            if self._purged_at is not None and now - self._purged_at < interval:
+                return 0
+            self._purged_at = now
+        purged = self.purge()
+        if purged:
+            log.info("jobs_purged", count=purged)
+        return purged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the reply work queue")
+    parser.add_argument('--path', default=QUEUE_PATH)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help="jobs per state")
+    commands.add_parser('dead', help="list the dead letters")
+    requeue = commands.add_parser('requeue', help="retry a dead-lettered message")
+    requeue.add_argument('mailbox')
+    requeue.add_argument('message_id')
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.path)
+    if args.command == 'status':
+        print(json.dumps(queue.counts(), indent=2))
+    elif args.command == 'dead':
+        for entry in queue.dead_letters():
+            print(json.dumps(entry))
+    elif not queue.requeue(args.mailbox, args.message_id):
+        sys.exit(f"{args.message_id} is not a dead letter of {args.mailbox}")
+    queue.close()
+
+
+if __name__ == '__main__':
+    main()